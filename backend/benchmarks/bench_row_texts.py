@@ -0,0 +1,82 @@
+﻿"""
+Row-to-text / metadata building: per-row (iloc) reference vs the column-wise
+implementation in services.ingest. Checks both produce identical output.
+
+    cd backend && python -m benchmarks.bench_row_texts --rows 100000 1000000
+"""
+import argparse
+import time
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+from services.ingest import row_to_text, _safe_meta_value, dataframe_to_texts, dataframe_to_metadata
+
+def legacy_texts(df: pd.DataFrame, table: str) -> List[str]:
+    return [row_to_text(df.iloc[i], table) for i in range(len(df))]
+
+def legacy_metadata(df: pd.DataFrame, table: str, texts: List[str], max_cols: int = 8) -> List[Dict]:
+    cols = list(df.columns)[:max_cols]
+    metas: List[Dict] = []
+    for i in range(len(df)):
+        md: Dict = {"table": table, "text": str(texts[i])[:800]}
+        for c in cols:
+            val = _safe_meta_value(df.iloc[i][c])
+            if val is None:
+                continue
+            if isinstance(val, str) and len(val) > 256:
+                val = val[:256]
+            if isinstance(val, list):
+                val = [str(x)[:128] for x in val[:20]]
+            md[c] = val
+        metas.append(md)
+    return metas
+
+def sample_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    products = np.array(["latte", "espresso", "mocha", "cappuccino", "flat white", "cold brew"])
+    qty = rng.integers(1, 6, rows).astype(float)
+    qty[rng.random(rows) < 0.01] = np.nan
+    return pd.DataFrame({
+        "date": pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 730, rows), unit="D"),
+        "product": products[rng.integers(0, len(products), rows)],
+        "customer": [f"c{n}" for n in rng.integers(0, 5000, rows)],
+        "qty": qty,
+        "price": rng.choice([2.5, 3.0, 3.5, 4.25], rows),
+        "store_id": rng.integers(1, 40, rows),
+        "loyalty": rng.random(rows) < 0.3,
+    })
+
+def _time(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+def run(rows: int, legacy_max: int) -> Dict:
+    df = sample_frame(rows)
+    table = "demo__coffee_sales"
+    texts, t_texts = _time(dataframe_to_texts, df, table)
+    metas, t_meta = _time(dataframe_to_metadata, df, table, texts)
+    res = {"rows": rows, "texts_s": round(t_texts, 3), "metadata_s": round(t_meta, 3)}
+    if rows <= legacy_max:
+        ref_texts, lt = _time(legacy_texts, df, table)
+        ref_metas, lm = _time(legacy_metadata, df, table, ref_texts)
+        assert texts == ref_texts, "texts differ from per-row reference"
+        assert metas == ref_metas, "metadata differs from per-row reference"
+        res.update({
+            "legacy_texts_s": round(lt, 3), "legacy_metadata_s": round(lm, 3),
+            "speedup": round((lt + lm) / (t_texts + t_meta), 1),
+        })
+    return res
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    ap.add_argument("--legacy-max", type=int, default=1_000_000,
+                    help="skip the (slow) per-row reference above this many rows")
+    args = ap.parse_args()
+    for n in args.rows:
+        print(run(n, args.legacy_max))
+
+if __name__ == "__main__":
+    main()
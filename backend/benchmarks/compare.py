@@ -0,0 +1,53 @@
+﻿"""
+Side-by-side view of two benchmarks.run reports.
+
+    cd backend && python -m benchmarks.compare base.json new.json [--threshold 10]
+
+Timings (*_ms, *_s, seconds) are lower-is-better, rates (*_per_s) higher;
+changes beyond --threshold percent in the wrong direction are flagged.
+"""
+import argparse
+import json
+from typing import Dict, Iterator, Tuple
+
+def _leaves(d: Dict, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            yield from _leaves(v, key)
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield key, float(v)
+
+def _higher_is_better(key: str) -> bool:
+    return key.endswith("_per_s")
+
+def _is_timing(key: str) -> bool:
+    return key.endswith(("_ms", "_s", ".seconds")) and not key.endswith("_per_s")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("base")
+    ap.add_argument("new")
+    ap.add_argument("--threshold", type=float, default=10.0, help="percent change to flag as a regression")
+    args = ap.parse_args()
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"base {base['meta'].get('commit')}  ->  new {new['meta'].get('commit')}")
+    old = dict(_leaves(base["results"]))
+    regressions = 0
+    for key, value in _leaves(new["results"]):
+        if key not in old or not (_is_timing(key) or _higher_is_better(key)):
+            continue
+        ref = old[key]
+        change = (value - ref) / ref * 100 if ref else 0.0
+        worse = -change if _higher_is_better(key) else change
+        flag = "  REGRESSION" if worse > args.threshold else ""
+        regressions += bool(flag)
+        print(f"{key:60s} {ref:>12.3f} {value:>12.3f} {change:>+8.1f}%{flag}")
+    if regressions:
+        raise SystemExit(f"{regressions} metric(s) regressed by more than {args.threshold:.0f}%")
+
+if __name__ == "__main__":
+    main()
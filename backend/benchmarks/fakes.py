@@ -0,0 +1,111 @@
+﻿"""
+Local stand-ins for the network services, so benchmarks measure this code
+and not Gemini or Pinecone: a deterministic embedder, a canned LLM, and
+`install()` which points the services at them and at the local NumPy
+vector store in a scratch directory.
+"""
+import asyncio
+import os
+import tempfile
+import time
+import zlib
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+class FakeEmbeddings(Embeddings):
+    """
+    Feature-hashed bag of words, L2-normalized: the same text always gets
+    the same vector and texts sharing words score higher, so retrieval
+    behaves plausibly. `latency` seconds are spent per call (not per text)
+    to mimic a batched API round trip.
+    """
+    def __init__(self, dim: int = 768, latency: float = 0.0):
+        self.dim, self.latency = dim, latency
+
+    def _vec(self, text_: str) -> List[float]:
+        v = np.zeros(self.dim, dtype=np.float32)
+        for tok in text_.lower().split():
+            h = zlib.crc32(tok.encode("utf-8"))
+            v[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        n = np.linalg.norm(v)
+        return (v / n if n else v).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text_: str) -> List[float]:
+        return self.embed_documents([text_])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._vec(t) for t in texts]
+
+    async def aembed_query(self, text_: str) -> List[float]:
+        return (await self.aembed_documents([text_]))[0]
+
+class _Message:
+    def __init__(self, content: str):
+        self.content = content
+
+class FakeLLM:
+    """Answers with a fixed sentence after `latency` seconds, streamed in `tokens` pieces."""
+    ANSWER = "Based on the retrieved rows, sales were steady across the period."
+
+    def __init__(self, latency: float = 0.0, tokens: int = 8):
+        self.latency, self.tokens = latency, tokens
+
+    def _pieces(self) -> List[str]:
+        words = self.ANSWER.split(" ")
+        step = max(1, len(words) // self.tokens)
+        return [" ".join(words[i:i + step]) + " " for i in range(0, len(words), step)]
+
+    def invoke(self, prompt: str) -> _Message:
+        time.sleep(self.latency)
+        return _Message(self.ANSWER)
+
+    async def ainvoke(self, prompt: str) -> _Message:
+        await asyncio.sleep(self.latency)
+        return _Message(self.ANSWER)
+
+    async def astream(self, prompt: str):
+        pieces = self._pieces()
+        for p in pieces:
+            await asyncio.sleep(self.latency / len(pieces))
+            yield _Message(p)
+
+def configure_env(vector_dir: str | None = None, dim: int = 768, quantization: str = "none") -> str:
+    """
+    Environment for a benchmark process; call before importing `services`
+    (several modules read their settings at import time).
+    """
+    vector_dir = vector_dir or tempfile.mkdtemp(prefix="caffeinate-bench-vectors-")
+    os.environ["VECTOR_BACKEND"] = "local"
+    os.environ["LOCAL_VECTOR_DIR"] = vector_dir
+    os.environ["VECTOR_INDEX_PREFIX"] = "bench"
+    os.environ["EMBEDDING_DIM"] = str(dim)
+    os.environ["LOCAL_VECTOR_QUANT"] = quantization
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")  # only checked for presence
+    os.environ["EMBED_CACHE"] = "off"                     # measure the embedding path every time
+    os.environ["ANSWER_CACHE"] = "off"
+    os.environ.setdefault("JOB_WORKERS", "0")
+    return vector_dir
+
+def install(embed_latency: float = 0.0, llm_latency: float = 0.0, dim: int = 768):
+    # patch every place that resolved the real clients at import time
+    import services.embeddings as embeddings
+    import services.qa as qa
+    embedder = FakeEmbeddings(dim, embed_latency)
+    llm = FakeLLM(llm_latency)
+    fakes = {dim: embedder}
+
+    def get_embedder(output_dimensionality=None):
+        d = output_dimensionality or dim
+        return fakes.setdefault(d, FakeEmbeddings(d, embed_latency))
+
+    embeddings.get_embedder = get_embedder
+    qa.get_embedder = get_embedder
+    qa._llm = lambda: llm
@@ -0,0 +1,236 @@
+﻿"""
+End-to-end benchmarks against a local Postgres, with Gemini and Pinecone
+replaced by the stand-ins in benchmarks.fakes. Results are JSON so runs on
+different commits can be compared with benchmarks.compare.
+
+    cd backend && python -m benchmarks.run --rows 200000 --out /tmp/bench-$(git rev-parse --short HEAD).json
+    python -m benchmarks.compare /tmp/bench-old.json /tmp/bench-new.json
+
+Scenarios (--scenarios, default all):
+    ingest   streamed CSV load (parse, COPY, index, analyze, rollups)
+    queries  kpis / daily_series / top_products straight from the services
+    texts    dataframe_to_texts + dataframe_to_metadata
+    index    index_table per granularity, full and then incremental (nothing changed)
+    search   local vector store exact scan of --search-rows random vectors, float32 and
+             --quantization side by side (latency, bytes scanned, recall against float32)
+    ask      concurrent POST /ask (SQL and RAG routes) through the ASGI app
+The ask scenario needs httpx. Postgres comes from the usual POSTGRES_* variables.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.fakes import configure_env, install
+from benchmarks.synthetic import coffee_sales, to_csv_bytes
+
+SCENARIOS = ("ingest", "queries", "texts", "index", "search", "ask")
+
+ASK_QUESTIONS = [
+    "What was the total revenue in March 2024?",
+    "How many orders were there last year?",
+    "Top 5 products by quantity",
+    "average order value for latte",
+    "Which customers seem to prefer cold drinks?",
+    "Tell me something interesting about weekend sales",
+]
+
+def _stats(samples: List[float]) -> Dict:
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))]
+    return {"n": len(s), "mean_ms": round(1000 * sum(s) / len(s), 3), "p50_ms": round(1000 * pick(0.5), 3),
+            "p95_ms": round(1000 * pick(0.95), 3), "min_ms": round(1000 * s[0], 3)}
+
+def _repeat(fn: Callable, n: int) -> Dict:
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return _stats(times)
+
+def bench_ingest(args, physical: str) -> Dict:
+    from services.loader import copy_csv_to_table
+    df = coffee_sales(args.rows, args.products, args.days, timestamps=args.timestamps, seed=args.seed)
+    raw = to_csv_bytes(df)
+    t0 = time.perf_counter()
+    res = copy_csv_to_table(io.BytesIO(raw), physical)
+    secs = time.perf_counter() - t0
+    return {"rows": res["rows"], "mb": round(len(raw) / 1e6, 2), "seconds": round(secs, 3),
+            "rows_per_s": round(res["rows"] / secs), "mb_per_s": round(len(raw) / 1e6 / secs, 2)}
+
+def bench_queries(args, physical: str) -> Dict:
+    from services.analytics import daily_series, kpis, top_products
+    from services.db import get_engine
+
+    def on_conn(fn):
+        def run():
+            with get_engine().connect() as conn:
+                fn(conn)
+        return run
+
+    cases = {
+        "kpis": lambda c: kpis(c, physical),
+        "daily_day": lambda c: daily_series(c, physical, "day"),
+        "daily_week": lambda c: daily_series(c, physical, "week"),
+        "daily_month": lambda c: daily_series(c, physical, "month"),
+        "daily_day_max_points": lambda c: daily_series(c, physical, "day", max_points=200),
+        "top_products": lambda c: top_products(c, physical, 10),
+    }
+    if args.timestamps:
+        cases["daily_hour"] = lambda c: daily_series(c, physical, "hour")
+    on_conn(cases["kpis"])()  # warm the schema cache
+    return {name: _repeat(on_conn(fn), args.repeat) for name, fn in cases.items()}
+
+def bench_texts(args, physical: str) -> Dict:
+    from services.ingest import dataframe_to_metadata, dataframe_to_texts, load_df
+    df = load_df(physical, limit=args.texts_rows)
+    t0 = time.perf_counter()
+    texts = dataframe_to_texts(df, physical)
+    t1 = time.perf_counter()
+    dataframe_to_metadata(df, physical, texts)
+    t2 = time.perf_counter()
+    return {"rows": len(df), "texts_s": round(t1 - t0, 3), "metadata_s": round(t2 - t1, 3),
+            "rows_per_s": round(len(df) / max(t2 - t0, 1e-9))}
+
+def bench_index(args, physical: str) -> Dict:
+    from services.ingest import index_table
+    out: Dict = {}
+    for granularity in args.index_granularity:
+        # summaries aggregate the whole table; a row limit would not make them comparable
+        limit = None if granularity == "summary" else args.index_rows
+        for mode in ("full", "incremental"):
+            res = index_table(physical, limit=limit, resume=False, mode=mode, granularity=granularity)
+            r = out.setdefault(granularity, {})[mode] = {
+                k: res.get(k) for k in ("rows_scanned", "rows_indexed", "documents", "seconds", "stages")}
+            r["rows_per_s"] = round((res.get("rows_scanned") or 0) / max(res.get("seconds") or 0, 1e-9))
+    return out
+
+def bench_search(args, physical: str) -> Dict:
+    import numpy as np
+    from services import local_vectorstore as lv
+    lv.IVF_MIN_VECTORS = args.search_rows + 1  # time the full scan, not the IVF shortcut
+    rng = np.random.default_rng(args.seed)
+    vecs = rng.standard_normal((args.search_rows, args.dim)).astype(np.float32)
+    queries = rng.standard_normal((args.repeat, args.dim)).astype(np.float32)
+    out: Dict = {}
+    exact = None
+    for quant in dict.fromkeys(("none", args.quantization)):
+        ix = lv.LocalIndex(os.path.join(tempfile.mkdtemp(), "search"), args.dim, "cosine", quant)
+        for s in range(0, len(vecs), 20_000):
+            ix.upsert([{"id": str(i), "values": vecs[i], "metadata": {"table": physical}}
+                       for i in range(s, min(s + 20_000, len(vecs)))])
+        ix.query_batch(queries[:1], top_k=8)  # page the files in
+        found, times = [], []
+        for q in queries:
+            t0 = time.perf_counter()
+            res = ix.query_batch(q, top_k=8)[0]["matches"]
+            times.append(time.perf_counter() - t0)
+            found.append({m["id"] for m in res})
+        exact = exact or found
+        recall = sum(len(a & b) for a, b in zip(found, exact)) / sum(len(b) for b in exact)
+        out[quant] = {**_stats(times), "scanned_mb": round(ix.memory_bytes()["scanned"] / 1e6, 1),
+                      "recall_at_8": round(recall, 4)}
+        ix.close()
+    return out
+
+async def _ask_level(client, table: str, concurrency: int, total: int) -> Dict:
+    sem = asyncio.Semaphore(concurrency)
+    latencies: Dict[str, List[float]] = {}
+
+    async def one(i: int):
+        async with sem:
+            t0 = time.perf_counter()
+            r = await client.post("/ask", json={"question": ASK_QUESTIONS[i % len(ASK_QUESTIONS)], "table": table})
+            r.raise_for_status()
+            latencies.setdefault(r.json().get("route", "rag"), []).append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    wall = time.perf_counter() - t0
+    return {"requests": total, "seconds": round(wall, 3), "req_per_s": round(total / wall, 1),
+            **{route: _stats(s) for route, s in sorted(latencies.items())}}
+
+def bench_ask(args, table: str) -> Dict:
+    import httpx
+    import main
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            return {f"c{c}": await _ask_level(client, table, c, max(args.ask_requests, c))
+                    for c in args.concurrency}
+
+    return asyncio.run(run())
+
+def _meta(args) -> Dict:
+    from sqlalchemy import text
+    from services.db import get_engine
+
+    def git(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    with get_engine().connect() as conn:
+        pg = conn.execute(text("SHOW server_version")).scalar()
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", ".")),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(), "postgres": pg, "args": vars(args)}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--products", type=int, default=12)
+    ap.add_argument("--days", type=int, default=730, help="date span of the synthetic sales")
+    ap.add_argument("--timestamps", action="store_true", help="timestamps instead of dates (adds hourly series)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--table", default="bench_coffee_sales", help="logical table name (tenant prefix applies)")
+    ap.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    ap.add_argument("--repeat", type=int, default=20, help="runs per query in the queries scenario")
+    ap.add_argument("--texts-rows", type=int, default=100_000)
+    ap.add_argument("--index-rows", type=int, default=20_000)
+    ap.add_argument("--search-rows", type=int, default=100_000, help="vectors in the search scenario")
+    ap.add_argument("--index-granularity", nargs="+", choices=("row", "chunk", "summary"),
+                    default=["row", "chunk", "summary"])
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--ask-requests", type=int, default=48, help="requests per concurrency level")
+    ap.add_argument("--embed-latency", type=float, default=0.02, help="seconds per fake embedding call")
+    ap.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake LLM answer")
+    ap.add_argument("--dim", type=int, default=768, help="embedding dimensions")
+    ap.add_argument("--quantization", choices=("none", "float16", "int8"), default="none",
+                    help="local vector store quantization")
+    ap.add_argument("--vector-dir", default=None, help="local vector store directory (default: a temp dir)")
+    ap.add_argument("--out", default=None, help="write the JSON here as well as to stdout")
+    args = ap.parse_args()
+
+    configure_env(args.vector_dir, args.dim, args.quantization)
+    install(args.embed_latency, args.llm_latency, args.dim)
+    from main import tenant_table
+    physical = tenant_table(args.table)
+
+    report = {"meta": _meta(args), "results": {}}
+    runners = {"ingest": bench_ingest, "queries": bench_queries, "texts": bench_texts, "index": bench_index,
+               "search": bench_search}
+    for name in args.scenarios:
+        print(f"running {name} ...", file=sys.stderr)
+        if name == "ask":
+            report["results"][name] = bench_ask(args, args.table)
+        else:
+            report["results"][name] = runners[name](args, physical)
+    out = json.dumps(report, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+    print(out)
+
+if __name__ == "__main__":
+    main()
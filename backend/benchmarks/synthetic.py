@@ -0,0 +1,52 @@
+﻿"""
+Synthetic coffee_sales-style data: one row per sale with a date (or
+timestamp), product, customer, quantity and unit price. Deterministic for a
+given seed, so runs on different commits see identical input.
+"""
+import io
+from typing import List
+import numpy as np
+import pandas as pd
+
+BASE_PRODUCTS = ["latte", "espresso", "mocha", "cappuccino", "flat white", "cold brew", "americano",
+                 "macchiato", "chai latte", "matcha latte", "hot chocolate", "cortado"]
+
+def product_names(n: int) -> List[str]:
+    names = BASE_PRODUCTS[:n]
+    sizes = ["small", "medium", "large"]
+    i = 0
+    while len(names) < n:
+        names.append(f"{sizes[i % 3]} {BASE_PRODUCTS[(i // 3) % len(BASE_PRODUCTS)]} {i // 36 or ''}".strip())
+        i += 1
+    return names
+
+def coffee_sales(rows: int, products: int = 12, days: int = 730, customers: int = 5000,
+                 start: str = "2023-01-01", timestamps: bool = False, seed: int = 0) -> pd.DataFrame:
+    """
+    `rows` sales spread over `days` days from `start`. Product popularity is
+    skewed (Zipf-like) so top-N queries have a stable answer; about 1% of
+    quantities are missing, like real exports.
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(product_names(products))
+    weights = 1.0 / np.arange(1, products + 1)
+    pick = rng.choice(products, rows, p=weights / weights.sum())
+    prices = np.round(2.0 + 0.25 * (np.arange(products) % 12), 2)
+    offset = pd.to_timedelta(rng.integers(0, days * 86400 if timestamps else days, rows),
+                             unit="s" if timestamps else "D")
+    when = pd.Timestamp(start) + offset
+    qty = rng.integers(1, 6, rows).astype(float)
+    qty[rng.random(rows) < 0.01] = np.nan
+    return pd.DataFrame({
+        "date": when.strftime("%Y-%m-%d %H:%M:%S" if timestamps else "%Y-%m-%d"),
+        "product": names[pick],
+        "customer": [f"c{n:05d}" for n in rng.integers(0, customers, rows)],
+        "qty": qty,
+        "price": prices[pick],
+        "store_id": rng.integers(1, 40, rows),
+    })
+
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.StringIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue().encode("utf-8")
@@ -1,11 +1,33 @@
-﻿import os
+﻿import hmac
+import os
+import re
 from fastapi import Header, HTTPException
 
 ADMIN = os.getenv("ADMIN_API_KEY", "")
+DEFAULT_TENANT = os.getenv("TENANT_ID", "demo")
+# "acme:key1,globex:key2": those tenants must present their own key (or the admin key)
+TENANT_KEYS = dict(p.strip().split(":", 1) for p in os.getenv("TENANT_API_KEYS", "").split(",") if ":" in p)
 
-def require_api_key(x_api_key: str | None = Header(default=None, alias="X-API-Key")):
-    if not ADMIN:
+def _key_ok(key: str | None, tenant: str) -> bool:
+    return bool(key) and any(k and hmac.compare_digest(key, k) for k in (ADMIN, TENANT_KEYS.get(tenant)))
+
+def require_api_key(x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+                    x_tenant_id: str | None = Header(default=None, alias="X-Tenant-ID")):
+    tenant = x_tenant_id or DEFAULT_TENANT
+    if not ADMIN and tenant not in TENANT_KEYS:
         # In dev if key not set, allow but warn
         return
-    if not x_api_key or x_api_key != ADMIN:
+    if not _key_ok(x_api_key, tenant):
         raise HTTPException(status_code=401, detail="Invalid or missing API key")
+
+def tenant_id(x_tenant_id: str | None = Header(default=None, alias="X-Tenant-ID"),
+              x_api_key: str | None = Header(default=None, alias="X-API-Key")) -> str:
+    # the tenant prefixes physical table names (tenant__table): identifier characters, no "__",
+    # no "_" at either end, so tenant__table splits back one way only
+    tenant = x_tenant_id or DEFAULT_TENANT
+    if not re.fullmatch(r"[A-Za-z0-9]([A-Za-z0-9_]{0,46}[A-Za-z0-9])?", tenant) or "__" in tenant:
+        raise HTTPException(status_code=400, detail="Invalid tenant id.")
+    # any tenant but the default one is only reachable with its key (or the admin key)
+    if tenant != DEFAULT_TENANT or tenant in TENANT_KEYS:
+        require_api_key(x_api_key, tenant)
+    return tenant
@@ -1,18 +1,45 @@
-﻿from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query, Depends
+﻿from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query, Depends, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+import contextvars
+import json
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from pydantic import BaseModel
-from typing import Optional
+from typing import Callable, Dict, Optional
+from datetime import date
 
-from deps import require_api_key
-from services.rag import answer_question
+from deps import require_api_key, tenant_id, DEFAULT_TENANT
+from services.db import get_engine, pool_stats
+from services.loader import copy_csv_to_table, infer_dates, date_dtypes, prepare_table, publish_table
+from services.changes import changes_since, window_unchanged
+from services.rag import aanswer_question, astream_question, warmup as rag_warmup, warmup_status, WARMUP
 from services.metrics import get_overview
-from services.analytics import kpis, daily_series, top_products
-from services.ingest import index_table
+from services.analytics import kpis, daily_series, top_products, prime_schema, sync_schema, table_schema
+from services.cache import result_cache, cache_key, etag_for, get_generation
+from services.series import FastJSONResponse, columnar, arrow_ipc, ARROW_MEDIA_TYPE
+from services.ingest import index_table, drop_table_vectors, CHUNK_DOC_ROWS
+from services import jobs
+from services.telemetry import REQUESTS, render_prometheus, server_timing, start_request, timed
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # worker threads for queued ingest/index jobs (JOB_WORKERS=0 leaves them to other processes)
+    await run_in_threadpool(jobs.start_workers)
+    if WARMUP:
+        # opt-in (RAG_WARMUP=on): startup waits for the clients so the first /ask is not the slow one
+        await run_in_threadpool(rag_warmup)
+    yield
+    await run_in_threadpool(jobs.stop_workers)
+
+app = FastAPI(lifespan=lifespan)
 
 # ---- CORS ----
 _CORS_ORIGINS = os.getenv("CORS_ALLOW_ORIGINS", "*")
@@ -25,23 +52,133 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-TENANT = os.getenv("TENANT_ID", "demo")
-
-def db_url() -> str:
-    user = os.getenv("POSTGRES_USER", "caffeinate")
-    pwd  = os.getenv("POSTGRES_PASSWORD", "caffeinate123")
-    host = os.getenv("POSTGRES_HOST", "postgres")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    db   = os.getenv("POSTGRES_DB", "caffeinate")
-    return f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    # per-route latency histogram, and a Server-Timing header with the stages this request ran
+    # (for streamed responses the header goes out with the first byte, so it covers setup only)
+    stages = start_request()
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - t0
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    REQUESTS.observe(total, request.method, route, str(response.status_code))
+    response.headers["Server-Timing"] = server_timing(stages, total)
+    return response
 
-def get_engine():
-    return create_engine(db_url())
+# dashboard parts run side by side; keep this below the DB pool size
+_dashboard_pool = ThreadPoolExecutor(max_workers=int(os.getenv("DASHBOARD_WORKERS", "3")))
 
-def tenant_table(raw: str) -> str:
-    # safe prefixing: tenant__tablename
+def tenant_table(raw: str, tenant: str = DEFAULT_TENANT) -> str:
+    # safe prefixing: tenant__tablename (the tenant comes from the X-Tenant-ID header)
     safe = "".join(c if (c.isalnum() or c == "_") else "_" for c in raw)
-    return f"{TENANT}__{safe}"
+    if not safe or safe.startswith("_"):
+        # "a" + "_b" would collide with tenant "a_" + "b"
+        raise HTTPException(status_code=400, detail="Invalid table name.")
+    return f"{tenant}__{safe}"
+
+def _after_ingest(physical: str, replaced: bool = True):
+    # the table changed: refresh everything derived from its old shape
+    with get_engine().connect() as conn:
+        sync_schema(physical, get_generation(conn, physical))
+        prime_schema(conn, physical)
+    if not replaced:
+        return  # merged rows: the next incremental index pass picks up just the changes
+    # a replaced table's vectors describe rows that are gone: drop the namespace in one call
+    try:
+        drop_table_vectors(physical)
+    except Exception:
+        pass  # e.g. RAG not configured; the next full index pass sweeps them instead
+
+def _load_frame(df: pd.DataFrame, physical: str):
+    # one transaction: write, index, build rollups, publish; blocking, so callers run it in a thread
+    with get_engine().begin() as conn:
+        df.to_sql(physical, con=conn, if_exists="replace", index=False, dtype=date_dtypes(df))
+        publish_table(conn, physical, prepare_table(conn, physical), len(df))
+    _after_ingest(physical)
+
+def _ingest_job(ctx: jobs.JobContext) -> Dict:
+    p = ctx.params
+    try:
+        with open(p["spool"], "rb") as f:
+            res = copy_csv_to_table(f, p["physical"],
+                                    on_chunk=lambda rows, frac: ctx.progress(rows, fraction=frac),
+                                    mode=p.get("mode", "replace"), keys=p.get("keys"))
+        _after_ingest(p["physical"], res["mode"] == "replace")
+    finally:
+        os.remove(p["spool"])
+    return {"table": p["table"], "physical_table": p["physical"], **res, "tenant": p.get("tenant", DEFAULT_TENANT)}
+
+def _index_job(ctx: jobs.JobContext) -> Dict:
+    p = ctx.params
+    return index_table(table=p["physical"], limit=p.get("limit"), resume=p.get("resume", True),
+                       mode=p.get("mode", "incremental"), on_progress=lambda done, total: ctx.progress(done, total),
+                       granularity=p.get("granularity", "row"), rows_per_doc=p.get("rows_per_doc", CHUNK_DOC_ROWS))
+
+jobs.register("ingest", _ingest_job)
+jobs.register("index", _index_job)
+
+def _accepted(job_id: str) -> Response:
+    return FastJSONResponse({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"},
+                            status_code=202, headers={"Location": f"/jobs/{job_id}"})
+
+def _not_modified(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match", "")
+    return etag in [t.strip().removeprefix("W/") for t in inm.split(",")]
+
+def _render(endpoint: str, result: Dict, fmt: str, headers: Dict):
+    if fmt == "columns":
+        return FastJSONResponse(columnar(endpoint, result), headers=headers)
+    if fmt == "arrow":
+        raw = arrow_ipc(endpoint, result)
+        if raw is None:
+            raise HTTPException(status_code=406, detail="Arrow output needs pyarrow installed on the server.")
+        return Response(raw, media_type=ARROW_MEDIA_TYPE, headers=headers)
+    return FastJSONResponse(result, headers=headers)
+
+def _format(request: Request, fmt: str) -> str:
+    # ?format= wins; otherwise honour an Arrow Accept header
+    if fmt == "rows" and ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        return "arrow"
+    return fmt
+
+CARRY_BACK = 8  # earlier generations searched for a reusable date-windowed result
+
+def _carried_over(conn, tenant: str, physical: str, endpoint: str, params: Dict, gen: int):
+    # a daily series over [start, end] from an earlier generation still holds when
+    # no ingest since then touched rows dated in that window (services.changes)
+    if endpoint != "daily" or params.get("start") is None or params.get("end") is None:
+        return None
+    for prior in range(gen - 1, max(gen - 1 - CARRY_BACK, 0), -1):
+        hit = result_cache.get(cache_key(tenant, physical, endpoint, params, prior))
+        if hit is not None:
+            return hit if window_unchanged(conn, physical, prior, gen, params["start"], params["end"]) else None
+    return None
+
+def _cached_metric(request: Request, tenant: str, physical: str, endpoint: str, params: Dict, compute: Callable,
+                   fmt: str = "rows"):
+    # results are keyed by the table generation, which only ingest bumps
+    with get_engine().connect() as conn:
+        gen = get_generation(conn, physical)
+        sync_schema(physical, gen)
+        key = cache_key(tenant, physical, endpoint, params, gen)
+        etag = etag_for(key if fmt == "rows" else f"{key}|{fmt}")
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        result = result_cache.get(key)
+        if result is None:
+            result = _carried_over(conn, tenant, physical, endpoint, params, gen)
+            if result is not None:
+                result_cache.put(key, result)
+        if result is None:
+            with timed(endpoint):
+                result = jsonable_encoder(compute(conn))
+            result_cache.put(key, result)
+    return _render(endpoint, result, fmt, {"ETag": etag, "Cache-Control": "no-cache"})
+
+def _compute_part(name: str, physical: str, compute: Callable):
+    # each dashboard part gets its own pooled connection so they run concurrently
+    with get_engine().connect() as conn, timed(name):
+        return jsonable_encoder(compute(conn))
 
 @app.get("/health")
 def health():
@@ -52,27 +189,68 @@ def health():
     except Exception as e:
         return {"status": "error", "detail": str(e)}
 
+@app.get("/db/pool")
+def db_pool():
+    return pool_stats()
+
 @app.post("/ingest_dataset")
-async def ingest_dataset(table: str, file: UploadFile = File(...), _=Depends(require_api_key)):
+async def ingest_dataset(table: str, file: UploadFile = File(...), stream: bool = Query(False),
+                         background: bool = Query(False),
+                         mode: str = Query("replace", pattern="^(replace|append|upsert)$"),
+                         keys: Optional[str] = Query(None, description="comma-separated key columns"),
+                         _=Depends(require_api_key), tenant: str = Depends(tenant_id)):
+    """
+    mode: "replace" swaps in the uploaded table; "append" adds its rows and
+    "upsert" also updates rows whose `keys` match (rows with a known key are
+    skipped on append). Both create the table if it does not exist yet.
+    """
     if not table.isidentifier():
         raise HTTPException(status_code=400, detail="Invalid table name.")
-    physical = tenant_table(table)
+    key_list = [k.strip() for k in keys.split(",") if k.strip()] if keys else []
+    if mode == "upsert" and not key_list:
+        raise HTTPException(status_code=400, detail="mode=upsert needs keys.")
+    physical = tenant_table(table, tenant)
+    if background and jobs.local_workers():
+        # spool the upload to local disk and load it (streamed) on a job worker of this host
+        spool = jobs.spool_path(f"{physical}-")
+        with open(spool, "wb") as out:
+            await run_in_threadpool(shutil.copyfileobj, file.file, out, 1 << 20)
+        job_id = await run_in_threadpool(jobs.enqueue, "ingest",
+                                         {"table": table, "physical": physical, "spool": spool, "tenant": tenant,
+                                          "mode": mode, "keys": key_list}, True)
+        return _accepted(job_id)
+    if stream or background or mode != "replace":
+        # chunked parse + COPY into a staging table; memory stays flat for any file size
+        # (background without local job workers, JOB_WORKERS=0, loads here too: no one would run the job)
+        try:
+            res = await run_in_threadpool(copy_csv_to_table, file.file, physical, mode=mode, keys=key_list)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"CSV read failed: {e}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"DB write failed: {e}")
+        await run_in_threadpool(_after_ingest, physical, res["mode"] == "replace")
+        return {
+            "table": table,
+            "physical_table": physical,
+            **res,
+            "tenant": tenant,
+            "message": "ingested"
+        }
     try:
         content = await file.read()
-        df = pd.read_csv(pd.io.common.BytesIO(content))
+        df = await run_in_threadpool(lambda: infer_dates(pd.read_csv(pd.io.common.BytesIO(content))))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"CSV read failed: {e}")
     if df.empty:
         raise HTTPException(status_code=400, detail="CSV is empty.")
     try:
-        with get_engine().begin() as conn:
-            df.to_sql(physical, con=conn, if_exists="replace", index=False)
+        await run_in_threadpool(_load_frame, df, physical)
         return {
             "table": table,
             "physical_table": physical,
             "rows": int(len(df)),
             "columns": list(df.columns),
-            "tenant": TENANT,
+            "tenant": tenant,
             "message": "ingested"
         }
     except Exception as e:
@@ -82,50 +260,205 @@ class AskRequest(BaseModel):
     question: str
     table: Optional[str] = None
 
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+def _ask_table(payload: AskRequest, tenant: str) -> str:
+    # map logical -> physical; SQL answers and vector namespaces are per table, there is no tenant-wide search
+    if not payload.table:
+        raise HTTPException(status_code=400, detail="table is required.")
+    return tenant_table(payload.table, tenant)
+
 @app.post("/ask")
-def ask(payload: AskRequest = Body(...)):
-    # map logical -> physical for RAG
-    table_physical = tenant_table(payload.table) if payload.table else None
-    return answer_question(payload.question, table_physical)
+async def ask(payload: AskRequest = Body(...), tenant: str = Depends(tenant_id)):
+    return await aanswer_question(payload.question, _ask_table(payload, tenant))
+
+@app.post("/ask/stream")
+async def ask_stream(payload: AskRequest = Body(...), tenant: str = Depends(tenant_id)):
+    """
+    Server-Sent Events: "context" after retrieval, "token" per LLM chunk,
+    "done" with the same payload /ask returns, or "error".
+    """
+    table_physical = _ask_table(payload, tenant)
+
+    async def events():
+        try:
+            async for ev in astream_question(payload.question, table_physical):
+                yield _sse(ev["event"], ev["data"])
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/metrics/overview")
-def metrics_overview(table: str = Query(...)):
-    physical = tenant_table(table)
+def metrics_overview(request: Request, table: str = Query(...), tenant: str = Depends(tenant_id)):
+    physical = tenant_table(table, tenant)
     try:
-        with get_engine().connect() as conn:
-            return get_overview(conn, physical)
+        return _cached_metric(request, tenant, physical, "overview", {}, lambda conn: get_overview(conn, physical))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/metrics/kpis")
-def metrics_kpis(table: str = Query(...)):
+def metrics_kpis(request: Request, table: str = Query(...), tenant: str = Depends(tenant_id)):
     if not table.isidentifier():
         raise HTTPException(status_code=400, detail="Invalid table name.")
-    physical = tenant_table(table)
-    with get_engine().connect() as conn:
-        return kpis(conn, physical)
+    physical = tenant_table(table, tenant)
+    return _cached_metric(request, tenant, physical, "kpis", {}, lambda conn: kpis(conn, physical))
 
 @app.get("/metrics/daily")
-def metrics_daily_endpoint(table: str = Query(...)):
+def metrics_daily_endpoint(request: Request, table: str = Query(...),
+                           granularity: str = Query("day", pattern="^(hour|day|week|month)$"),
+                           start: Optional[date] = Query(None), end: Optional[date] = Query(None),
+                           max_points: Optional[int] = Query(None, ge=3, le=100000),
+                           format: str = Query("rows", pattern="^(rows|columns|arrow)$"), tenant: str = Depends(tenant_id)):
     if not table.isidentifier():
         raise HTTPException(status_code=400, detail="Invalid table name.")
-    physical = tenant_table(table)
-    with get_engine().connect() as conn:
-        return daily_series(conn, physical)
+    physical = tenant_table(table, tenant)
+    params = {"granularity": granularity, "start": start, "end": end, "max_points": max_points}
+    return _cached_metric(request, tenant, physical, "daily", params,
+                          lambda conn: daily_series(conn, physical, granularity, start, end, max_points),
+                          _format(request, format))
 
 @app.get("/metrics/top_products")
-def metrics_top_products_endpoint(table: str = Query(...), limit: int = Query(10, ge=1, le=50)):
+def metrics_top_products_endpoint(request: Request, table: str = Query(...), limit: int = Query(10, ge=1, le=50),
+                                  format: str = Query("rows", pattern="^(rows|columns|arrow)$"), tenant: str = Depends(tenant_id)):
+    if not table.isidentifier():
+        raise HTTPException(status_code=400, detail="Invalid table name.")
+    physical = tenant_table(table, tenant)
+    return _cached_metric(request, tenant, physical, "top_products", {"limit": limit},
+                          lambda conn: top_products(conn, physical, limit), _format(request, format))
+
+@app.get("/metrics/dashboard")
+def metrics_dashboard(request: Request, table: str = Query(...),
+                      granularity: str = Query("day", pattern="^(hour|day|week|month)$"),
+                      start: Optional[date] = Query(None), end: Optional[date] = Query(None),
+                      limit: int = Query(10, ge=1, le=50), max_points: Optional[int] = Query(None, ge=3, le=100000),
+                      tenant: str = Depends(tenant_id)):
+    """
+    KPIs, the time series and top products in one response. Parts share
+    cache entries with their own endpoints; the missing ones are computed
+    concurrently on separate pooled connections.
+    """
     if not table.isidentifier():
         raise HTTPException(status_code=400, detail="Invalid table name.")
-    physical = tenant_table(table)
+    physical = tenant_table(table, tenant)
+    parts = {
+        "kpis": ({}, lambda conn: kpis(conn, physical)),
+        "daily": ({"granularity": granularity, "start": start, "end": end, "max_points": max_points},
+                  lambda conn: daily_series(conn, physical, granularity, start, end, max_points)),
+        "top_products": ({"limit": limit}, lambda conn: top_products(conn, physical, limit)),
+    }
     with get_engine().connect() as conn:
-        return top_products(conn, physical, limit)
+        gen = get_generation(conn, physical)
+        sync_schema(physical, gen)
+        table_schema(conn, physical)  # warm the schema cache once instead of in every part
+    etag = etag_for(cache_key(tenant, physical, "dashboard", {n: p for n, (p, _) in parts.items()}, gen))
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    keys = {n: cache_key(tenant, physical, n, p, gen) for n, (p, _) in parts.items()}
+    out = {n: result_cache.get(k) for n, k in keys.items()}
+    missing = [n for n, v in out.items() if v is None]
+    # copy_context: the parts' SQL timings count toward this request's Server-Timing
+    futures = [_dashboard_pool.submit(contextvars.copy_context().run, _compute_part, n, physical, parts[n][1])
+               for n in missing]
+    for n, v in zip(missing, (f.result() for f in futures)):
+        result_cache.put(keys[n], v)
+        out[n] = v
+    body = {"table": physical, "generation": gen, **out, "computed": missing}
+    return FastJSONResponse(body, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@app.get("/metrics/cache")
+def metrics_cache():
+    return result_cache.stats()
+
+@app.get("/metrics/prometheus")
+def metrics_prometheus():
+    """Request and stage latency histograms, plus DB pool gauges, in the Prometheus text format."""
+    pool = pool_stats()
+    gauges = {f"caffeinate_db_pool_{k}": pool[k] for k in ("checked_out", "overflow", "timeouts", "wait_total_ms")
+              if k in pool}
+    return PlainTextResponse(render_prometheus(gauges), media_type="text/plain; version=0.0.4")
 
 @app.post("/rag/index")
-def rag_index(table: str = Query(...), limit: Optional[int] = Query(None), _=Depends(require_api_key)):
-    physical = tenant_table(table)
+def rag_index(table: str = Query(...), limit: Optional[int] = Query(None), resume: bool = Query(True),
+              mode: str = Query("incremental", pattern="^(full|incremental)$"), background: bool = Query(False),
+              granularity: str = Query("row", pattern="^(row|chunk|summary)$"),
+              rows_per_doc: int = Query(CHUNK_DOC_ROWS, ge=2, le=1000), _=Depends(require_api_key),
+              tenant: str = Depends(tenant_id)):
+    """
+    granularity: "row" embeds every row, "chunk" packs `rows_per_doc` rows per
+    document, "summary" embeds per-day/product/customer aggregates.
+    """
+    physical = tenant_table(table, tenant)
+    if background and jobs.local_workers():
+        return _accepted(jobs.enqueue("index", {"table": table, "physical": physical, "tenant": tenant, "limit": limit,
+                                                "resume": resume, "mode": mode, "granularity": granularity,
+                                                "rows_per_doc": rows_per_doc}))
+    # background without local job workers (JOB_WORKERS=0) indexes here too, as ingest does
     try:
-        return index_table(table=physical, limit=limit)
+        return index_table(table=physical, limit=limit, resume=resume, mode=mode,
+                           granularity=granularity, rows_per_doc=rows_per_doc)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/rag/namespaces")
+def rag_namespaces(tenant: str = Depends(tenant_id)):
+    """Vectors per table of this tenant, from the namespace counts of the current index."""
+    from services.vectorstore import index_name, namespace_counts
+    prefix = f"{tenant}__"
+    try:
+        counts = namespace_counts()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Vector store unavailable: {e}")
+    tables = {ns[len(prefix):]: n for ns, n in sorted(counts.items()) if ns.startswith(prefix)}
+    return {"tenant": tenant, "index": index_name(), "tables": tables, "vectors": sum(tables.values())}
+
+@app.get("/rag/embed_cache")
+def rag_embed_cache():
+    # lazy: the cache module pulls in LangChain
+    from services.embedding_cache import cache_stats
+    return cache_stats()
+
+@app.get("/rag/warmup")
+def rag_warmup_status():
+    return warmup_status()
+
+@app.get("/rag/answer_cache")
+def rag_answer_cache():
+    from services.answer_cache import answer_cache
+    return answer_cache.stats()
+
+@app.get("/ingest/changes")
+def ingest_changes(table: str = Query(...), since: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000),
+                   tenant: str = Depends(tenant_id)):
+    """Change log of `table` after generation `since`: mode, rows inserted/updated, dates touched."""
+    physical = tenant_table(table, tenant)
+    with get_engine().connect() as conn:
+        return {"table": table, "generation": get_generation(conn, physical),
+                "changes": changes_since(conn, physical, since, limit)}
+
+@app.get("/jobs")
+def jobs_list(kind: Optional[str] = Query(None, pattern="^(ingest|index)$"),
+              status: Optional[str] = Query(None, pattern=f"^({'|'.join(jobs.STATES)})$"),
+              limit: int = Query(50, ge=1, le=500), tenant: str = Depends(tenant_id)):
+    return {"jobs": jobs.list_jobs(kind, status, limit, tenant=tenant)}
+
+@app.get("/jobs/{job_id}")
+def jobs_get(job_id: str, tenant: str = Depends(tenant_id)):
+    """State, rows processed, throughput and ETA of a background job."""
+    job = jobs.get_job(job_id, tenant=tenant)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+def jobs_cancel(job_id: str, _=Depends(require_api_key), tenant: str = Depends(tenant_id)):
+    job = jobs.cancel_job(job_id, tenant=tenant)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    spool = (job["params"] or {}).get("spool")
+    if job["status"] == "cancelled" and job["started_at"] is None and spool and os.path.exists(spool):
+        os.remove(spool)  # never started, so its upload is ours to clean up
+    return job
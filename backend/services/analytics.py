@@ -1,15 +1,45 @@
-﻿from typing import Dict, List, Optional
+﻿import json
+import threading
+from datetime import date
+from typing import Dict, List, Optional
 from sqlalchemy import text
+from services.db import ensure_ddl
+from services.columns import num_expr, date_expr, ts_expr
+from services.rollups import rollup_tables, rollups_present, rollup_totals
+from services.series import downsample_points
 
 CANDIDATE_PRODUCT = ["product","item","sku","name"]
 CANDIDATE_DATE = ["date","order_date","sale_date","day","timestamp","created_at"]
+CANDIDATE_QTY = ["qty"]
+CANDIDATE_PRICE = ["price"]
+CANDIDATE_CUSTOMER = ["customer","customer_id","customer_name","client","client_id","user_id"]
+
+GRANULARITIES = ("hour", "day", "week", "month")
+
+# physical table -> {"columns", "types", "date", "product", "qty", "price", "customer", "categorical", "rollups"};
+# filled on ingest or first use
+_META_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_table_meta (
+    name        TEXT PRIMARY KEY,
+    roles       JSONB NOT NULL,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+_SCHEMA: Dict[str, Dict] = {}
+_SCHEMA_GEN: Dict[str, int] = {}
+_SCHEMA_LOCK = threading.Lock()
 
 def _cols(conn, table: str) -> List[str]:
+    return list(col_types(conn, table))
+
+def col_types(conn, table: str) -> Dict[str, str]:
+    # column -> information_schema data_type, in table order
     rows = conn.execute(
-        text("SELECT column_name FROM information_schema.columns WHERE table_name=:t ORDER BY ordinal_position"),
+        text("SELECT column_name, data_type FROM information_schema.columns WHERE table_name=:t "
+             "ORDER BY ordinal_position"),
         {"t": table}
     ).fetchall()
-    return [r[0] for r in rows]
+    return {r[0]: r[1] for r in rows}
 
 def _pick(colnames: List[str], candidates: List[str]) -> Optional[str]:
     low = [c.lower() for c in colnames]
@@ -25,61 +55,151 @@ def _has(conn, table: str, col: str) -> bool:
     ).fetchone()
     return bool(r)
 
-def kpis(conn, table: str) -> Dict:
-    cols = _cols(conn, table)
-    if not cols:
-        return {"table": table, "exists": False}
+def detect_roles(colnames: List[str], types: Optional[Dict[str, str]] = None) -> Dict:
+    return {
+        "columns": list(colnames),
+        "types": dict(types or {}),
+        "date": _pick(colnames, CANDIDATE_DATE),
+        "product": _pick(colnames, CANDIDATE_PRODUCT),
+        "qty": _pick(colnames, CANDIDATE_QTY),
+        "price": _pick(colnames, CANDIDATE_PRICE),
+        "customer": _pick(colnames, CANDIDATE_CUSTOMER),
+    }
 
-    rows = conn.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
-    has_qty = "qty" in [c.lower() for c in cols]
-    has_price = "price" in [c.lower() for c in cols]
+def save_table_meta(conn, table: str, roles: Dict):
+    # call in the transaction that (re)creates the table
+    ensure_ddl("table_meta", _META_DDL)
+    conn.execute(text(
+        "INSERT INTO caffeinate_table_meta (name, roles) VALUES (:n, CAST(:r AS jsonb)) "
+        "ON CONFLICT (name) DO UPDATE SET roles = EXCLUDED.roles, updated_at = now()"
+    ), {"n": table, "r": json.dumps({k: v for k, v in roles.items() if k != "rollups"})})
+
+def load_table_meta(conn, table: str) -> Optional[Dict]:
+    ensure_ddl("table_meta", _META_DDL)
+    r = conn.execute(text("SELECT roles FROM caffeinate_table_meta WHERE name=:n"), {"n": table}).scalar()
+    return dict(r) if r else None
+
+def table_schema(conn, table: str) -> Optional[Dict]:
+    """
+    Column names, types and detected roles for `table`, served from a
+    per-process cache so metric queries skip information_schema. Missing
+    tables are not cached (they may be ingested at any moment).
+    """
+    info = _SCHEMA.get(table)
+    if info is not None:
+        return info
+    # roles recorded at ingest; tables loaded before that get them from the catalog
+    info = load_table_meta(conn, table)
+    if info is None:
+        types = col_types(conn, table)
+        if not types:
+            return None
+        info = detect_roles(list(types), types)
+    info["rollups"] = rollups_present(conn, table)
+    with _SCHEMA_LOCK:
+        _SCHEMA[table] = info
+    return info
+
+def invalidate_schema(table: str):
+    with _SCHEMA_LOCK:
+        _SCHEMA.pop(table, None)
+
+def sync_schema(table: str, generation: int):
+    # drop our cached schema if another worker re-ingested the table since we cached it
+    if _SCHEMA_GEN.get(table) != generation:
+        with _SCHEMA_LOCK:
+            _SCHEMA.pop(table, None)
+            _SCHEMA_GEN[table] = generation
+
+def prime_schema(conn, table: str) -> Optional[Dict]:
+    # call after the table was (re)created so the next metrics request hits the cache
+    invalidate_schema(table)
+    return table_schema(conn, table)
 
-    total_qty = None
-    total_revenue = None
-    if has_qty:
-        total_qty = conn.execute(text(f'SELECT SUM(qty::numeric) FROM "{table}"')).scalar()
-    if has_qty and has_price:
-        total_revenue = conn.execute(text(f'SELECT SUM((qty::numeric)*(price::numeric)) FROM "{table}"')).scalar()
+def kpis(conn, table: str) -> Dict:
+    sch = table_schema(conn, table)
+    if not sch:
+        return {"table": table, "exists": False}
 
+    qcol, pcol = sch["qty"], sch["price"]
+    totals = rollup_totals(conn, table, sch.get("rollups") or {})
+    if totals is not None:
+        rows, total_qty, total_revenue = totals
+        return _kpi_result(table, sch, rows, total_qty, total_revenue)
+
+    qty_expr = f"SUM({num_expr(sch, qcol)})" if qcol else "NULL"
+    rev_expr = f"SUM({num_expr(sch, qcol)}*{num_expr(sch, pcol)})" if qcol and pcol else "NULL"
+    # one pass over the table for every KPI
+    rows, total_qty, total_revenue = conn.execute(
+        text(f'SELECT COUNT(*), {qty_expr}, {rev_expr} FROM "{table}"')
+    ).one()
+    return _kpi_result(table, sch, rows, total_qty, total_revenue)
+
+def _kpi_result(table: str, sch: Dict, rows, total_qty, total_revenue) -> Dict:
     return {
         "table": table, "exists": True, "row_count": int(rows),
-        "has_qty": has_qty, "has_price": has_price,
+        "has_qty": bool(sch["qty"]), "has_price": bool(sch["price"]),
         "total_qty": float(total_qty) if total_qty is not None else None,
         "total_revenue": float(total_revenue) if total_revenue is not None else None,
-        "columns": cols
+        "columns": sch["columns"]
     }
 
-def daily_series(conn, table: str) -> Dict:
-    cols = _cols(conn, table)
-    dcol = _pick(cols, CANDIDATE_DATE)
-    has_qty = "qty" in [c.lower() for c in cols]
-    has_price = "price" in [c.lower() for c in cols]
-
+def daily_series(conn, table: str, granularity: str = "day",
+                 start: Optional[date] = None, end: Optional[date] = None,
+                 max_points: Optional[int] = None) -> Dict:
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {GRANULARITIES}")
+    sch = table_schema(conn, table) or detect_roles([])
+    dcol, qcol, pcol = sch["date"], sch["qty"], sch["price"]
     if not dcol:
         return {"table": table, "has_date": False, "points": []}
 
     # revenue if possible, else just daily counts
-    if has_qty and has_price:
-        q = text(f'SELECT CAST("{dcol}" AS date) d, SUM((qty::numeric)*(price::numeric)) revenue '
-                 f'FROM "{table}" GROUP BY d ORDER BY d')
+    key = "revenue" if qcol and pcol else "ct"
+
+    if (sch.get("rollups") or {}).get("day") and granularity != "hour":
+        src, d, val = f'"{rollup_tables(table)[0]}"', "d", f"SUM({key})"
+    elif key == "revenue":
+        src, d, val = f'"{table}"', date_expr(sch, dcol), f"SUM({num_expr(sch, qcol)}*{num_expr(sch, pcol)})"
     else:
-        q = text(f'SELECT CAST("{dcol}" AS date) d, COUNT(*) ct FROM "{table}" GROUP BY d ORDER BY d')
+        src, d, val = f'"{table}"', date_expr(sch, dcol), "COUNT(*)"
 
-    rows = conn.execute(q).fetchall()
-    key = "revenue" if has_qty and has_price else "ct"
-    return {"table": table, "has_date": True, "metric": key,
-            "points": [{"date": str(r[0]), key: float(r[1]) if r[1] is not None else 0.0} for r in rows]}
+    if granularity == "hour":
+        bucket = f"date_trunc('hour', {ts_expr(sch, dcol)})::timestamp"
+    elif granularity == "day":
+        bucket = d
+    else:
+        bucket = f"date_trunc('{granularity}', {d}::timestamp)::date"
+    where, params = [], {}
+    if start is not None:
+        where.append(f"{d} >= :start")
+        params["start"] = start
+    if end is not None:
+        where.append(f"{d} <= :end")
+        params["end"] = end
+    q = text(f'SELECT {bucket} b, {val} v FROM {src} '
+             f'{"WHERE " + " AND ".join(where) if where else ""} GROUP BY b ORDER BY b')
+
+    rows = conn.execute(q, params).fetchall()
+    points = [{"date": str(r[0]), key: float(r[1]) if r[1] is not None else 0.0} for r in rows if r[0] is not None]
+    out = {"table": table, "has_date": True, "metric": key, "granularity": granularity, "points": points}
+    if max_points and len(points) > max_points:
+        out["points"] = downsample_points(points, key, max_points)
+        out["downsampled"] = {"method": "lttb", "from": len(points), "to": len(out["points"])}
+    return out
 
 def top_products(conn, table: str, limit: int = 10) -> Dict:
-    cols = _cols(conn, table)
-    pcol = _pick(cols, CANDIDATE_PRODUCT)
-    has_qty = "qty" in [c.lower() for c in cols]
+    sch = table_schema(conn, table) or detect_roles([])
+    pcol, qcol = sch["product"], sch["qty"]
 
     if not pcol:
         return {"table": table, "has_product": False, "items": []}
 
-    if has_qty:
-        q = text(f'SELECT "{pcol}" as product, SUM(qty::numeric) qty '
+    if (sch.get("rollups") or {}).get("product"):
+        q = text(f'SELECT product, {"qty" if qcol else "ct"} qty '
+                 f'FROM "{rollup_tables(table)[1]}" ORDER BY qty DESC LIMIT :lim')
+    elif qcol:
+        q = text(f'SELECT "{pcol}" as product, SUM({num_expr(sch, qcol)}) qty '
                  f'FROM "{table}" GROUP BY "{pcol}" ORDER BY qty DESC LIMIT :lim')
     else:
         q = text(f'SELECT "{pcol}" as product, COUNT(*) qty '
@@ -0,0 +1,98 @@
+﻿import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from services.db import get_engine
+from services.cache import get_generation, index_generation_name
+
+# Semantic cache of /ask answers: questions whose embedding is within
+# THRESHOLD cosine similarity of an earlier question on the same table reuse
+# its answer. Entries are tagged with the table's data and index generations,
+# so re-ingesting or re-indexing the table makes them unreachable.
+
+ENABLED = os.getenv("ANSWER_CACHE", "on").lower() != "off"
+THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+MAX_PER_TABLE = int(os.getenv("ANSWER_CACHE_MAX_PER_TABLE", "256"))
+MAX_TABLES = int(os.getenv("ANSWER_CACHE_MAX_TABLES", "64"))
+TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # seconds
+
+def table_generations(table: str) -> Tuple[int, int]:
+    # (data generation, index generation); one short read per question
+    with get_engine().connect() as conn:
+        return get_generation(conn, table), get_generation(conn, index_generation_name(table))
+
+class _TableEntries:
+    def __init__(self, gens: Tuple[int, int], dim: int):
+        self.gens = gens
+        self.vecs = np.zeros((0, dim), dtype=np.float32)
+        self.questions: List[str] = []
+        self.results: List[Dict] = []
+        self.expires: List[float] = []
+
+class AnswerCache:
+    def __init__(self, threshold: float = THRESHOLD, max_per_table: int = MAX_PER_TABLE,
+                 max_tables: int = MAX_TABLES, ttl: float = TTL):
+        self.threshold, self.max_per_table, self.max_tables, self.ttl = threshold, max_per_table, max_tables, ttl
+        self._tables: "OrderedDict[str, _TableEntries]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _unit(vec) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        n = np.linalg.norm(v)
+        return v / n if n else v
+
+    def lookup(self, table: str, gens: Tuple[int, int], vec) -> Optional[Tuple[Dict, float, str]]:
+        """Best cached (result, similarity, question) above the threshold, or None."""
+        q = self._unit(vec)
+        with self._lock:
+            e = self._tables.get(table)
+            best = None
+            if e is not None and e.gens == gens and e.vecs.shape[1] == len(q) and len(e.questions):
+                sims = e.vecs @ q
+                sims[np.asarray(e.expires) <= time.monotonic()] = -1.0
+                i = int(np.argmax(sims))
+                if sims[i] >= self.threshold:
+                    best = (e.results[i], float(sims[i]), e.questions[i])
+                    self._tables.move_to_end(table)
+            if best:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return best
+
+    def put(self, table: str, gens: Tuple[int, int], vec, question: str, result: Dict):
+        q = self._unit(vec)
+        with self._lock:
+            e = self._tables.get(table)
+            if e is None or e.gens != gens or e.vecs.shape[1] != len(q):
+                e = self._tables[table] = _TableEntries(gens, len(q))
+            now = time.monotonic()
+            keep = [i for i, exp in enumerate(e.expires) if exp > now][-(self.max_per_table - 1):] \
+                if self.max_per_table > 1 else []
+            e.vecs = np.vstack([e.vecs[keep], q[None, :]])
+            e.questions = [e.questions[i] for i in keep] + [question]
+            e.results = [e.results[i] for i in keep] + [result]
+            e.expires = [e.expires[i] for i in keep] + [now + self.ttl]
+            self._tables.move_to_end(table)
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ENABLED, "threshold": self.threshold,
+                "tables": len(self._tables), "entries": sum(len(e.questions) for e in self._tables.values()),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+answer_cache = AnswerCache()
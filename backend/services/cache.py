@@ -0,0 +1,158 @@
+﻿import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from sqlalchemy import text
+from services.db import ensure_ddl
+
+MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "512"))
+MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))  # seconds
+# optional sqlite file shared by all uvicorn workers on the host, e.g. /tmp/caffeinate-cache.sqlite
+SHARED_PATH = os.getenv("RESULT_CACHE_PATH", "")
+
+_GEN_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_table_generations (
+    name        TEXT PRIMARY KEY,
+    generation  BIGINT NOT NULL DEFAULT 0,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# ---- generation counters (Postgres, so every worker agrees) ----
+
+def get_generation(conn, name: str) -> int:
+    ensure_ddl("generations", _GEN_DDL)
+    g = conn.execute(
+        text("SELECT generation FROM caffeinate_table_generations WHERE name=:n"), {"n": name}
+    ).scalar()
+    return int(g or 0)
+
+def bump_generation(conn, name: str) -> int:
+    # call inside the transaction that changes the data, so the bump commits with it
+    ensure_ddl("generations", _GEN_DDL)
+    return int(conn.execute(text(
+        "INSERT INTO caffeinate_table_generations AS g (name, generation) VALUES (:n, 1) "
+        "ON CONFLICT (name) DO UPDATE SET generation = g.generation + 1, updated_at = now() "
+        "RETURNING generation"
+    ), {"n": name}).scalar())
+
+def index_generation_name(table: str) -> str:
+    # bumped whenever the vectors of `table` change
+    return f"rag:{table}"
+
+# ---- result cache ----
+
+def cache_key(tenant: str, table: str, endpoint: str, params: Dict, generation: int) -> str:
+    p = json.dumps(params, sort_keys=True, default=str)
+    return f"{tenant}|{table}|{endpoint}|{generation}|{p}"
+
+def etag_for(key: str) -> str:
+    return '"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+class _SharedStore:
+    # sqlite file so several worker processes on one host share results
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            r = self._db.execute("SELECT value FROM results WHERE key=? AND expires>?", (key, time.time())).fetchone()
+        return r[0] if r else None
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, value, time.time() + TTL))
+            self._puts += 1
+            if self._puts % 64 == 0:
+                self._db.execute("DELETE FROM results WHERE expires<=?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM results WHERE key NOT IN "
+                    "(SELECT key FROM results ORDER BY expires DESC LIMIT ?)", (MAX_ENTRIES * 4,)
+                )
+
+class ResultCache:
+    """
+    In-process LRU of JSON-able endpoint results with entry/byte limits and a
+    TTL. Keys embed the table generation, so ingest makes old entries
+    unreachable and they simply age out.
+    """
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES,
+                 ttl: float = TTL, shared_path: str = SHARED_PATH):
+        self.max_entries, self.max_bytes, self.ttl = max_entries, max_bytes, ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._shared = _SharedStore(shared_path) if shared_path else None
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            e = self._data.get(key)
+            if e is not None and e[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return e[2]
+            if e is not None:
+                self._drop(key)
+        if self._shared is not None:
+            raw = self._shared.get(key)
+            if raw is not None:
+                value = json.loads(raw)
+                self._remember(key, value, len(raw))
+                with self._lock:
+                    self.shared_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        raw = json.dumps(value)
+        self._remember(key, value, len(raw))
+        if self._shared is not None:
+            self._shared.put(key, raw)
+
+    def _remember(self, key: str, value: Any, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _drop(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._data), "bytes": self._bytes,
+                "max_entries": self.max_entries, "max_bytes": self.max_bytes, "ttl_s": self.ttl,
+                "hits": self.hits, "shared_hits": self.shared_hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.shared_hits) / lookups, 4) if lookups else None,
+                "shared_store": SHARED_PATH or None,
+            }
+
+result_cache = ResultCache()
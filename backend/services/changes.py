@@ -0,0 +1,57 @@
+﻿from typing import Dict, List, Optional
+from datetime import date
+from sqlalchemy import text
+from services.db import ensure_ddl
+
+# One row per ingest that changed a table: the generation it produced, what
+# happened and the date range the changed rows cover (old and new values),
+# so derived results outside that range can be carried over to the new
+# generation. `full` marks replacements and schema changes: everything changed.
+
+_CHANGES_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_table_changes (
+    id          BIGSERIAL PRIMARY KEY,
+    physical    TEXT NOT NULL,
+    generation  BIGINT NOT NULL,
+    mode        TEXT NOT NULL,
+    full_change BOOLEAN NOT NULL,
+    inserted    BIGINT NOT NULL DEFAULT 0,
+    updated     BIGINT NOT NULL DEFAULT 0,
+    date_from   DATE,
+    date_to     DATE,
+    changed_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS caffeinate_table_changes_gen ON caffeinate_table_changes (physical, generation)
+"""
+
+def record_change(conn, physical: str, generation: int, mode: str, full: bool, inserted: int = 0,
+                  updated: int = 0, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    # call in the transaction that changes the table, next to bump_generation
+    ensure_ddl("table_changes", _CHANGES_DDL)
+    conn.execute(text(
+        "INSERT INTO caffeinate_table_changes "
+        "(physical, generation, mode, full_change, inserted, updated, date_from, date_to) "
+        "VALUES (:t, :g, :m, :f, :i, :u, :df, :dt)"
+    ), {"t": physical, "g": generation, "m": mode, "f": full, "i": inserted, "u": updated,
+        "df": date_from, "dt": date_to})
+
+def changes_since(conn, physical: str, generation: int, limit: int = 100) -> List[Dict]:
+    """Changes that produced generations after `generation`, oldest first."""
+    ensure_ddl("table_changes", _CHANGES_DDL)
+    rows = conn.execute(text(
+        "SELECT generation, mode, full_change, inserted, updated, date_from, date_to, changed_at "
+        "FROM caffeinate_table_changes WHERE physical=:t AND generation > :g ORDER BY generation LIMIT :n"
+    ), {"t": physical, "g": generation, "n": limit}).mappings().all()
+    return [dict(r) for r in rows]
+
+def window_unchanged(conn, physical: str, since: int, until: int, start: date, end: date) -> bool:
+    """
+    True when no change between generations `since` (exclusive) and `until`
+    touched rows dated within [start, end], so results over that window
+    computed at `since` still hold at `until`.
+    """
+    changes = changes_since(conn, physical, since, limit=until - since)
+    if len(changes) != until - since or changes[-1]["generation"] != until:
+        return False  # some generation was produced without a log entry
+    return not any(c["full_change"] or c["date_from"] is None
+                   or (c["date_from"] <= end and c["date_to"] >= start) for c in changes)
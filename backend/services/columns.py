@@ -0,0 +1,23 @@
+﻿from typing import Dict
+
+# SQL expressions for role columns. Tables ingested with typed columns are
+# used as-is (no per-row casts, so indexes and statistics apply); columns of
+# unknown or text type fall back to explicit casts.
+
+NUMERIC_TYPES = {"smallint", "integer", "bigint", "numeric", "real", "double precision"}
+TIMESTAMP_TYPES = {"timestamp without time zone", "timestamp with time zone"}
+
+def _qc(col: str) -> str:
+    return '"' + col.replace('"', '""') + '"'
+
+def col_type(roles: Dict, col: str) -> str:
+    return (roles.get("types") or {}).get(col, "")
+
+def num_expr(roles: Dict, col: str) -> str:
+    return _qc(col) if col_type(roles, col) in NUMERIC_TYPES else f"({_qc(col)}::numeric)"
+
+def date_expr(roles: Dict, col: str) -> str:
+    return _qc(col) if col_type(roles, col) == "date" else f"CAST({_qc(col)} AS date)"
+
+def ts_expr(roles: Dict, col: str) -> str:
+    return _qc(col) if col_type(roles, col) in TIMESTAMP_TYPES else f"CAST({_qc(col)} AS timestamp)"
@@ -0,0 +1,116 @@
+﻿import os
+import threading
+import time
+from typing import Dict
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from services.telemetry import instrument_engine
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds; -1 disables
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
+_ddl_done: set = set()
+
+def db_url() -> str:
+    user = os.getenv("POSTGRES_USER", "caffeinate")
+    pwd  = os.getenv("POSTGRES_PASSWORD", "caffeinate123")
+    host = os.getenv("POSTGRES_HOST", "postgres")
+    port = os.getenv("POSTGRES_PORT", "5432")
+    db   = os.getenv("POSTGRES_DB", "caffeinate")
+    return f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
+
+class _TimedQueuePool(QueuePool):
+    # QueuePool that records how long callers wait to check a connection out
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - t0
+            with self._stats_lock:
+                self._waits += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+
+    def wait_stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "checkouts": self._waits,
+                "wait_total_ms": round(self._wait_total * 1000, 3),
+                "wait_avg_ms": round(self._wait_total * 1000 / self._waits, 3) if self._waits else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "timeouts": self._timeouts,
+            }
+
+def get_engine() -> Engine:
+    """
+    Process-wide SQLAlchemy engine. Every caller shares one connection pool,
+    so requests reuse warm Postgres connections instead of reconnecting.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    db_url(),
+                    poolclass=_TimedQueuePool,
+                    pool_size=POOL_SIZE,
+                    max_overflow=MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=POOL_PRE_PING,
+                )
+                instrument_engine(_engine)
+    return _engine
+
+def dispose_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+def ensure_ddl(name: str, ddl: str):
+    """
+    Run idempotent DDL (CREATE ... IF NOT EXISTS) for one of our bookkeeping
+    tables, once per process, in its own transaction.
+    """
+    if name in _ddl_done:
+        return
+    with get_engine().begin() as conn:
+        conn.execute(text(ddl))
+    _ddl_done.add(name)
+
+def pool_stats() -> Dict:
+    pool = get_engine().pool
+    stats = {
+        "pool_size": pool.size(),
+        "max_overflow": MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "timeout_s": POOL_TIMEOUT,
+        "recycle_s": POOL_RECYCLE,
+        "pre_ping": POOL_PRE_PING,
+    }
+    if isinstance(pool, _TimedQueuePool):
+        stats.update(pool.wait_stats())
+    return stats
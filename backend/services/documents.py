@@ -0,0 +1,180 @@
+﻿from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import pandas as pd
+from sqlalchemy import text
+from services.db import get_engine
+from services.analytics import detect_roles, table_schema
+from services.columns import TIMESTAMP_TYPES, col_type, date_expr, num_expr
+
+# Index documents coarser than one per row: "chunk" packs rows of the same
+# day (or product) into one compact document, "summary" embeds SQL
+# aggregates per day, per product and per customer. Both cut the number of
+# embeddings by orders of magnitude and give retrieval denser context per
+# match.
+
+GRANULARITIES = ("row", "chunk", "summary")
+DOC_TEXT_CHARS = 4000  # text kept in metadata for chunk/summary docs (the whole prompt context budget)
+MAX_META_LIST = 20
+
+def _qi(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _cell_strings(df: pd.DataFrame) -> List[List[str]]:
+    cols = [["" if v is None or v != v else str(v) for v in df[c].tolist()] for c in df.columns]
+    return [list(r) for r in zip(*cols)] if cols else [[] for _ in range(len(df))]
+
+def chunk_key(roles: Dict) -> Tuple[Optional[str], str]:
+    """(label, SQL expression) that chunk documents group rows by: the day, else the product."""
+    date, product = roles.get("date"), roles.get("product")
+    if date:
+        # text dates are not cast (one bad value would fail the pass); ISO ones start with the day
+        if col_type(roles, date) in {"date", *TIMESTAMP_TYPES}:
+            return "date", date_expr(roles, date)
+        return "date", f"left(CAST({_qi(date)} AS text), 10)"
+    if product:
+        return "product", _qi(product)
+    return None, "''"
+
+def chunk_documents(df: pd.DataFrame, table: str, keys: List[str], parts: List[int], roles: Dict,
+                    key_label: Optional[str]) -> Tuple[List[str], Callable[[List[int]], List[Dict]]]:
+    """
+    Pack the rows of `df` that share a (key, part), as numbered by
+    ingest.iter_table_chunks, into one document each: a header naming the
+    key and the columns, then one comma-separated line per row. Nothing in
+    it depends on where the rows sit in the table, so a document keeps its
+    text (and vector id) until its own rows change. Returns the texts and a
+    metadata builder for the positions that get embedded.
+    """
+    lines = [", ".join(r) for r in _cell_strings(df)]
+    header = ", ".join(map(str, df.columns))
+    texts, spans = [], []
+    s = 0
+    while s < len(df):
+        e = s + 1
+        while e < len(df) and keys[e] == keys[s] and parts[e] == parts[s]:
+            e += 1
+        label = f"{key_label} {keys[s] or 'unknown'}, part {int(parts[s]) + 1}; " if key_label else ""
+        texts.append(f"table={table}; {label}columns: {header}\n" + "\n".join(lines[s:e]))
+        spans.append((s, e))
+        s = e
+
+    def metadata(positions: List[int]) -> List[Dict]:
+        out = []
+        for i in positions:
+            s, e = spans[i]
+            md: Dict = {"table": table, "text": texts[i][:DOC_TEXT_CHARS], "granularity": "chunk", "rows": e - s}
+            part = df.iloc[s:e]
+            if roles.get("date") in part:
+                dates = part[roles["date"]].dropna().astype(str)
+                if not dates.empty:
+                    md["date_from"], md["date_to"] = dates.min(), dates.max()
+            if roles.get("product") in part:
+                md["products"] = [str(p) for p in part[roles["product"]].dropna().unique()[:MAX_META_LIST]]
+            out.append(md)
+        return out
+
+    return texts, metadata
+
+# ---- summaries ----
+def _money(v) -> str:
+    return f"{float(v):,.2f}"
+
+def _num(v) -> str:
+    f = float(v)
+    return f"{int(f):,}" if f == int(f) else f"{f:,.2f}"
+
+def _measures(roles: Dict) -> List[str]:
+    out = ["COUNT(*) AS orders"]
+    if roles.get("qty"):
+        out.append(f"SUM({num_expr(roles, roles['qty'])}) AS qty")
+    if roles.get("qty") and roles.get("price"):
+        out.append(f"SUM({num_expr(roles, roles['qty'])} * {num_expr(roles, roles['price'])}) AS revenue")
+    return out
+
+def _present(row: Dict, key: str) -> bool:
+    v = row.get(key)
+    return v is not None and not (isinstance(v, float) and v != v)
+
+def _describe(row: Dict) -> str:
+    parts = [f"{_num(row['orders'])} orders"]
+    if _present(row, "qty"):
+        parts.append(f"quantity {_num(row['qty'])}")
+    if _present(row, "revenue"):
+        parts.append(f"revenue {_money(row['revenue'])}")
+    if _present(row, "avg_price"):
+        parts.append(f"average price {_money(row['avg_price'])}")
+    if _present(row, "top_product"):
+        parts.append(f"most common product {row['top_product']}")
+    if _present(row, "first_date"):
+        parts.append(f"from {row['first_date']} to {row['last_date']}")
+    return ", ".join(parts)
+
+def summary_queries(table: str, roles: Dict) -> List[Tuple[str, str]]:
+    """(kind, SQL) for every summary the table's roles allow; each query returns a `key` column."""
+    t, out = _qi(table), []
+    date, product, customer = roles.get("date"), roles.get("product"), roles.get("customer")
+    measures = _measures(roles)
+    if date:
+        d = date_expr(roles, date)
+        top = [f"mode() WITHIN GROUP (ORDER BY {_qi(product)}) AS top_product"] if product else []
+        out.append(("day", f"SELECT {d} AS key, {', '.join(measures + top)} FROM {t} "
+                           f"WHERE {_qi(date)} IS NOT NULL GROUP BY 1 ORDER BY 1"))
+    if product:
+        extra = [f"AVG({num_expr(roles, roles['price'])}) AS avg_price"] if roles.get("price") else []
+        if date:
+            d = date_expr(roles, date)
+            extra += [f"MIN({d}) AS first_date", f"MAX({d}) AS last_date"]
+        out.append(("product", f"SELECT {_qi(product)} AS key, {', '.join(measures + extra)} FROM {t} "
+                               f"WHERE {_qi(product)} IS NOT NULL GROUP BY 1 ORDER BY 1"))
+    if customer:
+        extra = [f"mode() WITHIN GROUP (ORDER BY {_qi(product)}) AS top_product"] if product else []
+        if date:
+            d = date_expr(roles, date)
+            extra += [f"MIN({d}) AS first_date", f"MAX({d}) AS last_date"]
+        out.append(("customer", f"SELECT {_qi(customer)} AS key, {', '.join(measures + extra)} FROM {t} "
+                                f"WHERE {_qi(customer)} IS NOT NULL GROUP BY 1 ORDER BY 1"))
+    return out
+
+def summary_roles(conn, table: str) -> Optional[Dict]:
+    roles = table_schema(conn, table)
+    if roles is None:
+        return None
+    if "customer" not in roles:  # recorded before customers were a role
+        roles = {**roles, "customer": detect_roles(roles["columns"])["customer"]}
+    return roles
+
+def iter_summary_frames(table: str, chunk_rows: int, offset: int = 0,
+                        limit: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """
+    Summary rows of every kind, `chunk_rows` at a time, with a `kind`
+    column. `offset`/`limit` count summary rows across kinds, in order.
+    """
+    with get_engine().connect() as conn:
+        roles = summary_roles(conn, table)
+        if roles is None:
+            return
+        seen, left = 0, limit
+        for kind, sql in summary_queries(table, roles):
+            if left is not None and left <= 0:
+                return
+            streamed = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows)
+            for df in pd.read_sql(text(sql), streamed, chunksize=chunk_rows):
+                skip = min(max(offset - seen, 0), len(df))
+                seen += len(df)
+                df = df.iloc[skip:]
+                if left is not None:
+                    df = df.iloc[:left]
+                    left -= len(df)
+                if len(df):
+                    yield df.assign(kind=kind)
+                if left is not None and left <= 0:
+                    return
+
+def summary_documents(df: pd.DataFrame, table: str) -> Tuple[List[str], Callable[[List[int]], List[Dict]]]:
+    records = df.to_dict("records")
+    texts = [f"table={table}; {r['kind']} {r['key']}: {_describe(r)}" for r in records]
+
+    def metadata(positions: List[int]) -> List[Dict]:
+        return [{"table": table, "text": texts[i][:DOC_TEXT_CHARS], "granularity": "summary",
+                 "summary": records[i]["kind"], "key": str(records[i]["key"])} for i in positions]
+
+    return texts, metadata
@@ -0,0 +1,238 @@
+﻿import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import text
+from services.db import get_engine, ensure_ddl
+
+BACKEND = os.getenv("EMBED_CACHE", "postgres").lower()  # postgres | local | off
+LOCAL_PATH = os.getenv("EMBED_CACHE_PATH", "/tmp/caffeinate-embeddings.sqlite")
+MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "2000000"))
+MAX_AGE_DAYS = float(os.getenv("EMBED_CACHE_MAX_AGE_DAYS", "30"))
+EVICT_EVERY = 200  # puts between eviction passes
+TOUCH_EVERY = 60.0  # seconds between writes of the recency refreshes lookups queue up
+
+log = logging.getLogger("caffeinate.embedding_cache")
+
+_PG_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_embedding_cache (
+    key        TEXT PRIMARY KEY,
+    model      TEXT NOT NULL,
+    dim        INT NOT NULL,
+    vec        BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    used_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS caffeinate_embedding_cache_used ON caffeinate_embedding_cache (used_at)
+"""
+
+def _pack(vec: List[float]) -> bytes:
+    return np.asarray(vec, dtype=np.float32).tobytes()
+
+def _unpack(raw: bytes) -> List[float]:
+    return np.frombuffer(raw, dtype=np.float32).tolist()
+
+_maint_lock = threading.Lock()  # one background maintenance pass per process
+
+def _in_background(fn):
+    # eviction and recency writes stay off the lookup and indexing paths; skipped while one is running
+    if not _maint_lock.acquire(blocking=False):
+        return
+    def run():
+        try:
+            fn()
+        except Exception:
+            log.exception("embedding cache maintenance failed")
+        finally:
+            _maint_lock.release()
+    threading.Thread(target=run, name="embedding-cache-maintenance", daemon=True).start()
+
+class _PostgresStore:
+    def __init__(self):
+        self._stale: set = set()  # hit keys whose used_at is over an hour old
+        self._stale_lock = threading.Lock()
+        self._touched_at = time.monotonic()
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        ensure_ddl("embedding_cache", _PG_DDL)
+        with get_engine().connect() as conn:
+            rows = conn.execute(
+                text("SELECT key, vec, used_at < now() - interval '1 hour' FROM caffeinate_embedding_cache "
+                     "WHERE key = ANY(:k)"), {"k": keys}
+            ).fetchall()
+        # recency is refreshed coarsely and in batches, so lookups stay read-only
+        with self._stale_lock:
+            self._stale.update(r[0] for r in rows if r[2])
+            due = bool(self._stale) and time.monotonic() - self._touched_at >= TOUCH_EVERY
+        if due:
+            _in_background(self.touch)
+        return {r[0]: bytes(r[1]) for r in rows}
+
+    def touch(self):
+        with self._stale_lock:
+            keys, self._stale = list(self._stale), set()
+            self._touched_at = time.monotonic()
+        if keys:
+            with get_engine().begin() as conn:
+                conn.execute(text("UPDATE caffeinate_embedding_cache SET used_at = now() WHERE key = ANY(:k)"),
+                             {"k": keys})
+
+    def put_many(self, model: str, dim: int, entries: Dict[str, bytes]):
+        ensure_ddl("embedding_cache", _PG_DDL)
+        with get_engine().begin() as conn:
+            conn.execute(text(
+                "INSERT INTO caffeinate_embedding_cache (key, model, dim, vec) "
+                "SELECT unnest(CAST(:k AS text[])), :m, :d, unnest(CAST(:v AS bytea[])) "
+                "ON CONFLICT (key) DO NOTHING"
+            ), {"k": list(entries), "m": model, "d": dim, "v": list(entries.values())})
+
+    def evict(self):
+        self.touch()  # so entries hit since the last refresh are not evicted as old
+        with get_engine().begin() as conn:
+            # one process evicts at a time; concurrent indexers skip their pass
+            if not conn.execute(text("SELECT pg_try_advisory_xact_lock(hashtext('caffeinate_embedding_cache'))")).scalar():
+                return
+            conn.execute(text("DELETE FROM caffeinate_embedding_cache WHERE used_at < now() - make_interval(secs => :s)"),
+                         {"s": MAX_AGE_DAYS * 86400})
+            # the planner's row estimate says whether the size cap can be near without counting
+            est = conn.execute(text("SELECT reltuples FROM pg_class "
+                                    "WHERE oid = 'caffeinate_embedding_cache'::regclass")).scalar()
+            if est is not None and 0 <= est < MAX_ROWS * 0.9:
+                return
+            # walks the used_at index from the newest entry; no sort of the table
+            cutoff = conn.execute(text(
+                "SELECT used_at FROM caffeinate_embedding_cache ORDER BY used_at DESC OFFSET :n LIMIT 1"
+            ), {"n": MAX_ROWS}).scalar()
+            if cutoff is not None:
+                conn.execute(text("DELETE FROM caffeinate_embedding_cache WHERE used_at <= :c"), {"c": cutoff})
+
+class _LocalStore:
+    # sqlite file; good for a single host or when Postgres should not hold vectors
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(key TEXT PRIMARY KEY, model TEXT, dim INT, vec BLOB, used_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used_at)")
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        out: Dict[str, bytes] = {}
+        now = time.time()
+        with self._lock:
+            for s in range(0, len(keys), 500):
+                part = keys[s:s + 500]
+                marks = ",".join("?" * len(part))
+                out.update(self._db.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part).fetchall())
+                self._db.execute(f"UPDATE embeddings SET used_at=? WHERE key IN ({marks})", [now, *part])
+        return out
+
+    def put_many(self, model: str, dim: int, entries: Dict[str, bytes]):
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                                 [(k, model, dim, v, now) for k, v in entries.items()])
+
+    def evict(self):
+        with self._lock:
+            self._db.execute("DELETE FROM embeddings WHERE used_at < ?", (time.time() - MAX_AGE_DAYS * 86400,))
+            self._db.execute("DELETE FROM embeddings WHERE key IN "
+                             "(SELECT key FROM embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (MAX_ROWS,))
+
+_store = None
+_store_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "api_calls": 0, "puts": 0}
+_stats_lock = threading.Lock()
+
+def _get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _LocalStore(LOCAL_PATH) if BACKEND == "local" else _PostgresStore()
+    return _store
+
+def _count(**deltas):
+    with _stats_lock:
+        for k, v in deltas.items():
+            _stats[k] += v
+
+def cache_stats() -> Dict:
+    with _stats_lock:
+        s = dict(_stats)
+    lookups = s["hits"] + s["misses"]
+    s["hit_rate"] = round(s["hits"] / lookups, 4) if lookups else None
+    s["backend"] = BACKEND
+    return s
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that looks texts up by hash of (model, output
+    dimensionality, query/document, text) before calling the wrapped model,
+    and stores what it had to compute. Lookups and writes are batched.
+    """
+    def __init__(self, inner: Embeddings, model: str, dim: Optional[int] = None):
+        self.inner, self.model, self.dim = inner, model, int(dim or 0)
+
+    def _key(self, kind: str, t: str) -> str:
+        return hashlib.sha256(f"{self.model}|{self.dim}|{kind}|{t}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, kind: str, texts: List[str]):
+        keys = [self._key(kind, t) for t in texts]
+        found = _get_store().get_many(list(set(keys)))
+        missing: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                missing.setdefault(k, t)
+        _count(hits=len(keys) - sum(1 for k in keys if k in missing), misses=len(missing))
+        return keys, found, missing
+
+    def _store(self, found: Dict[str, bytes], missing: Dict[str, str], vecs: List[List[float]]):
+        _count(api_calls=1)
+        fresh = {k: _pack(v) for k, v in zip(missing, vecs)}
+        store = _get_store()
+        store.put_many(self.model, self.dim, fresh)
+        found.update(fresh)
+        with _stats_lock:
+            _stats["puts"] += 1
+            evict = _stats["puts"] % EVICT_EVERY == 0
+        if evict:
+            _in_background(store.evict)
+
+    def _cached(self, kind: str, texts: List[str], compute) -> List[List[float]]:
+        keys, found, missing = self._lookup(kind, texts)
+        if missing:
+            self._store(found, missing, compute(list(missing.values())))
+        return [_unpack(found[k]) for k in keys]
+
+    async def _acached(self, kind: str, texts: List[str], acompute) -> List[List[float]]:
+        # store I/O runs in a thread; the embedding API call itself is awaited natively
+        keys, found, missing = await asyncio.to_thread(self._lookup, kind, texts)
+        if missing:
+            vecs = await acompute(list(missing.values()))
+            await asyncio.to_thread(self._store, found, missing, vecs)
+        return [_unpack(found[k]) for k in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._cached("doc", texts, self.inner.embed_documents)
+
+    def embed_query(self, text_: str) -> List[float]:
+        return self._cached("query", [text_], lambda ts: [self.inner.embed_query(ts[0])])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return await self._acached("doc", texts, self.inner.aembed_documents)
+
+    async def aembed_query(self, text_: str) -> List[float]:
+        async def one(ts):
+            return [await self.inner.aembed_query(ts[0])]
+        return (await self._acached("query", [text_], one))[0]
@@ -1,16 +1,47 @@
 ﻿import os
-from typing import Optional
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+import threading
+from typing import Dict, Optional
 
-_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")  # 768-d by default
+MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+# dimensions the model returns when not asked to truncate
+_NATIVE_DIMS = {"models/text-embedding-004": 768, "models/gemini-embedding-001": 3072}
+# vector size used for indexing, querying and index creation; smaller (e.g. 256) means a
+# smaller, faster index at some recall cost
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", str(_NATIVE_DIMS.get(MODEL, 768))))
 
-def get_embedder(output_dimensionality: Optional[int] = None) -> GoogleGenerativeAIEmbeddings:
+_embedders: Dict[int, object] = {}
+_lock = threading.Lock()
+
+def embedding_dim(output_dimensionality: Optional[int] = None) -> int:
+    return int(output_dimensionality or EMBEDDING_DIM)
+
+def get_embedder(output_dimensionality: Optional[int] = None):
     """
-    Returns a LangChain Embeddings instance for Gemini.
-    Set GEMINI_API_KEY in environment.
+    Returns the process-wide LangChain Embeddings instance for Gemini
+    producing `output_dimensionality` (default EMBEDDING_DIM) values per
+    vector, wrapped in the persistent embedding cache unless EMBED_CACHE=off.
+    One client per dimension is shared by all threads, so its HTTP
+    connections stay warm. Set GEMINI_API_KEY in environment.
     """
-    kwargs = {"model": _MODEL}
-    # You can optionally reduce dims via output_dimensionality (e.g., 768->512) later.
-    if output_dimensionality:
-        kwargs["output_dimensionality"] = int(output_dimensionality)
-    return GoogleGenerativeAIEmbeddings(**kwargs)
+    dim = embedding_dim(output_dimensionality)
+    emb = _embedders.get(dim)
+    if emb is None:
+        with _lock:
+            emb = _embedders.get(dim)
+            if emb is None:
+                emb = _embedders[dim] = _build(dim)
+    return emb
+
+def _build(dim: int):
+    # lazy: callers that only need the settings above should not pull in the SDKs
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    from services.embedding_cache import CachedEmbeddings, BACKEND as CACHE_BACKEND
+    kwargs = {"model": MODEL}
+    # only ask for truncation when it changes anything, so full-size cache keys stay valid
+    reduced = dim != _NATIVE_DIMS.get(MODEL)
+    if reduced:
+        kwargs["output_dimensionality"] = dim
+    inner = GoogleGenerativeAIEmbeddings(**kwargs)
+    if CACHE_BACKEND == "off":
+        return inner
+    return CachedEmbeddings(inner, model=MODEL, dim=dim if reduced else None)
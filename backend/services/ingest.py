@@ -1,24 +1,56 @@
 ﻿from __future__ import annotations
+import hashlib
+import json
 import os
-from typing import Dict, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, repeat
+from typing import Callable, Dict, Iterator, List, Tuple
 import pandas as pd
+from pandas.api import types as ptypes
 import numpy as np
 from decimal import Decimal
 from datetime import date, datetime
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from services.db import get_engine, ensure_ddl
+from services.cache import get_generation, bump_generation, index_generation_name
+from services.telemetry import observe
+from services.embeddings import embedding_dim
+from services.documents import GRANULARITIES, chunk_documents, chunk_key, iter_summary_frames, summary_documents, summary_roles
 
-DIM = 768  # text-embedding-004
+INDEX_CHUNK_ROWS = int(os.getenv("RAG_INDEX_CHUNK_ROWS", "2000"))
+EMBED_BATCH = int(os.getenv("RAG_EMBED_BATCH", "100"))
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+CHUNK_DOC_ROWS = int(os.getenv("RAG_CHUNK_DOC_ROWS", "25"))  # rows packed per document with granularity=chunk
+UPSERT_BATCH = 200
+DELETE_BATCH = 1000
+INDEX_MODES = ("full", "incremental")
 
-def _db_url() -> str:
-    user = os.getenv("POSTGRES_USER", "caffeinate")
-    pwd  = os.getenv("POSTGRES_PASSWORD", "caffeinate123")
-    host = os.getenv("POSTGRES_HOST", "postgres")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    db   = os.getenv("POSTGRES_DB", "caffeinate")
-    return f"postgresql+psycopg://{user}:{pwd}@{host}:{port}/{db}"
+_CKPT_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_index_checkpoints (
+    physical    TEXT PRIMARY KEY,
+    generation  BIGINT NOT NULL,
+    row_limit   BIGINT NOT NULL DEFAULT 0,
+    rows_done   BIGINT NOT NULL DEFAULT 0,
+    status      TEXT NOT NULL,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+ALTER TABLE caffeinate_index_checkpoints ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'row';
+ALTER TABLE caffeinate_index_checkpoints ADD COLUMN IF NOT EXISTS resume_after TEXT
+"""
+
+_MANIFEST_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_index_manifest (
+    physical   TEXT NOT NULL,
+    vector_id  TEXT NOT NULL,
+    seen_gen   BIGINT NOT NULL,
+    PRIMARY KEY (physical, vector_id)
+);
+ALTER TABLE caffeinate_index_manifest ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'row'
+"""
 
 def load_df(table: str, limit: int | None = None) -> pd.DataFrame:
-    eng = create_engine(_db_url())
+    eng = get_engine()
     q = f'SELECT * FROM "{table}"'
     if limit and limit > 0:
         q += f" LIMIT {int(limit)}"
@@ -31,8 +63,45 @@ def row_to_text(row: pd.Series, table: str) -> str:
         parts.append(f"{k}={v}")
     return "; ".join(parts)
 
+def _row_view(df: pd.DataFrame) -> Tuple[pd.DataFrame, bool]:
+    # df.iloc[i] upcasts an all-numeric/all-datetime row to one dtype (ints become floats
+    # next to a float column); cast the columns the same way once so the column-wise
+    # builders below produce exactly what the per-row path did.
+    if df.empty or len(df.columns) == 0:
+        return df, False
+    dt = df.iloc[0].dtype
+    if dt == object:
+        return df, False
+    return df.astype(dt), True
+
+def _column_values(s: pd.Series, homogeneous: bool) -> list:
+    # the same scalars row.items() yields: Python scalars for a single-dtype row,
+    # the stored (numpy/pandas) scalars for an object row
+    return s.tolist() if homogeneous else list(s.array)
+
+def _iso_seconds(s: pd.Series):
+    # "YYYY-MM-DDTHH:MM:SS" strings for a naive datetime column without sub-second parts
+    # (what Timestamp.isoformat() gives), formatted in C; None when that shortcut does not apply
+    if not (isinstance(s.dtype, np.dtype) and s.dtype.kind == "M"):
+        return None
+    arr = s.to_numpy()
+    secs = arr.astype("datetime64[s]")
+    if not ((secs == arr) | np.isnat(arr)).all():
+        return None
+    return np.datetime_as_string(secs, unit="s").tolist()
+
+def _text_column(k, s: pd.Series, homogeneous: bool) -> List[str]:
+    iso = _iso_seconds(s)
+    if iso is not None:
+        # str(Timestamp) puts a space where isoformat() has the "T"
+        return [f"{k}={v}" if v == "NaT" else f"{k}={v[:10]} {v[11:]}" for v in iso]
+    return [f"{k}={v}" for v in _column_values(s, homogeneous)]
+
 def dataframe_to_texts(df: pd.DataFrame, table: str) -> List[str]:
-    return [row_to_text(df.iloc[i], table) for i in range(len(df))]
+    # column-wise equivalent of [row_to_text(df.iloc[i], table) for i in range(len(df))]
+    view, homogeneous = _row_view(df)
+    parts = [_text_column(k, view.iloc[:, j], homogeneous) for j, k in enumerate(view.columns)]
+    return ["; ".join(p) for p in zip(repeat(f"table={table}", len(df)), *parts)]
 
 def _to_python_scalar(v):
     # Convert NumPy/Decimal/Timestamp → Python JSON-safe types
@@ -61,52 +130,399 @@ def _safe_meta_value(v):
     # Fallback to string
     return str(v)
 
+def _clip_meta(val):
+    if isinstance(val, str) and len(val) > 256:
+        return val[:256]
+    if isinstance(val, list):
+        # ensure list-of-strings not too big
+        return [str(x)[:128] for x in val[:20]]
+    return val
+
+def _meta_column(s: pd.Series, homogeneous: bool) -> list:
+    # one column of Pinecone-safe values (None = omit), converted per dtype instead of per cell
+    dt = s.dtype
+    if isinstance(dt, np.dtype) and dt.kind in "biuf":
+        vals = s.tolist()
+        if dt.kind == "f":
+            return [None if m else v for v, m in zip(vals, s.isna().to_numpy())]
+        return vals
+    if dt.kind == "M":
+        iso = _iso_seconds(s)
+        if iso is not None:
+            return [None if v == "NaT" else v for v in iso]
+        return [None if v is pd.NaT else v.isoformat() for v in s.array]
+    if ptypes.is_string_dtype(dt) and (dt != object or ptypes.infer_dtype(s, skipna=True) == "string"):
+        mask = s.isna().to_numpy()
+        return [None if m else (v[:256] if len(v) > 256 else v) for v, m in zip(s.tolist(), mask)]
+    return [_clip_meta(_safe_meta_value(v)) for v in _column_values(s, homogeneous)]
+
 def dataframe_to_metadata(df: pd.DataFrame, table: str, texts: List[str], max_cols: int = 8) -> List[Dict]:
-    cols = list(df.columns)[:max_cols]
+    view, homogeneous = _row_view(df)
+    cols = list(view.columns)[:max_cols]
+    values = [_meta_column(view.iloc[:, j], homogeneous) for j in range(len(cols))]
     metas: List[Dict] = []
-    for i in range(len(df)):
+    for i, row in enumerate(zip(*values) if values else repeat((), len(df))):
         md: Dict = {"table": table, "text": str(texts[i])[:800]}
-        for c in cols:
-            val = _safe_meta_value(df.iloc[i][c])
-            if val is None:
-                continue  # skip nulls entirely
-            if isinstance(val, str) and len(val) > 256:
-                val = val[:256]
-            if isinstance(val, list):
-                # ensure list-of-strings not too big
-                val = [str(x)[:128] for x in val[:20]]
-            md[c] = val
+        for c, val in zip(cols, row):
+            if val is not None:  # skip nulls entirely
+                md[c] = val
         metas.append(md)
     return metas
 
-def index_table(table: str, limit: int | None = None) -> Dict:
+def _stage(seconds: float, rows: int) -> Dict:
+    return {"seconds": round(seconds, 3), "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None}
+
+def _load_checkpoint(table: str) -> Dict | None:
+    ensure_ddl("index_checkpoints", _CKPT_DDL)
+    with get_engine().connect() as conn:
+        r = conn.execute(
+            text("SELECT generation, row_limit, rows_done, status, kind, resume_after FROM caffeinate_index_checkpoints "
+                 "WHERE physical=:t"),
+            {"t": table}
+        ).mappings().fetchone()
+    return dict(r) if r else None
+
+def _save_checkpoint(table: str, generation: int, limit: int | None, rows_done: int, status: str,
+                     kind: str = "row", after: List[str] | None = None):
+    ensure_ddl("index_checkpoints", _CKPT_DDL)
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            "INSERT INTO caffeinate_index_checkpoints (physical, generation, row_limit, rows_done, status, kind, "
+            "resume_after) VALUES (:t, :g, :l, :n, :s, :k, :a) ON CONFLICT (physical) DO UPDATE SET "
+            "generation=EXCLUDED.generation, row_limit=EXCLUDED.row_limit, rows_done=EXCLUDED.rows_done, "
+            "status=EXCLUDED.status, kind=EXCLUDED.kind, resume_after=EXCLUDED.resume_after, updated_at=now()"
+        ), {"t": table, "g": generation, "l": limit or 0, "n": rows_done, "s": status, "k": kind,
+            "a": json.dumps(after) if after else None})
+
+_CTID, _KEY, _PART = "caffeinate__ctid", "caffeinate__key", "caffeinate__part"
+
+def iter_table_chunks(table: str, chunk_rows: int = INDEX_CHUNK_ROWS, after: List[str] | None = None,
+                      limit: int | None = None, key_sql: str | None = None,
+                      part_rows: int = 1) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Stream `table` through a server-side cursor, `chunk_rows` rows at a time,
+    in ctid order, which is stable while the table is unchanged (one
+    generation). Yields each chunk with its rows' positions; the last one's
+    (`row_position`) passed back as `after` resumes right behind it.
+
+    With `key_sql` (an SQL expression over the table's columns) rows are
+    ordered by key, then ctid, and the positions also number the rows of
+    each key into parts of `part_rows`; a chunk never ends inside a part.
+    """
+    if key_sql is None:
+        q = f'SELECT *, ctid AS {_CTID} FROM "{table}"'
+        if after:
+            q += " WHERE ctid > CAST(:c AS tid)"  # keyset, a TID range scan: no rows skipped or repeated
+        q += " ORDER BY ctid"
+        params, pos_cols = ({"c": after[0]} if after else None), [_CTID]
+    else:
+        q = (f"SELECT * FROM (SELECT k.*, (row_number() OVER (PARTITION BY {_KEY} ORDER BY {_CTID}) - 1) / "
+             f"{int(part_rows)} AS {_PART} FROM (SELECT *, ctid AS {_CTID}, COALESCE(CAST({key_sql} AS text), '') "
+             f'AS {_KEY} FROM "{table}") k) s')
+        if after:
+            q += f" WHERE ({_KEY}, {_CTID}) > (:k, CAST(:c AS tid))"
+        q += f" ORDER BY {_KEY}, {_CTID}"
+        params, pos_cols = ({"k": after[0], "c": after[1]} if after else None), [_KEY, _PART, _CTID]
+    if limit is not None:
+        q += f" LIMIT {int(limit)}"
+    carry = None  # rows of a part that continues in the next chunk
+    with get_engine().connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows)
+        for df in pd.read_sql(text(q), conn, params=params, chunksize=chunk_rows):
+            if carry is not None:
+                df = pd.concat([carry, df], ignore_index=True)
+                carry = None
+            if key_sql is not None and len(df):
+                tail = (df[_KEY] == df[_KEY].iat[-1]) & (df[_PART] == df[_PART].iat[-1])
+                carry, df = df[tail].reset_index(drop=True), df[~tail].reset_index(drop=True)
+            if len(df):
+                yield df.drop(columns=pos_cols), df[pos_cols]
+    if carry is not None and len(carry):
+        yield carry.drop(columns=pos_cols), carry[pos_cols]
+
+def row_position(pos: pd.DataFrame | None) -> List[str] | None:
+    # checkpointed resume point: (key, ctid) of a chunk's last row, or just its ctid
+    if pos is None or not len(pos):
+        return None
+    return [str(pos[c].iat[-1]) for c in (_KEY, _CTID) if c in pos]
+
+def vector_id(table: str, text_: str) -> str:
+    # stable across reorders/reloads: the id is derived from the row's content
+    return f"{table}:{hashlib.sha1(text_.encode('utf-8')).hexdigest()}"
+
+def _manifest_known(table: str, ids: List[str], kind: str) -> set:
+    ensure_ddl("index_manifest", _MANIFEST_DDL)
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            text("SELECT vector_id FROM caffeinate_index_manifest WHERE physical=:t AND vector_id = ANY(:ids) "
+                 "AND kind = :k"),
+            {"t": table, "ids": ids, "k": kind}
+        ).fetchall()
+    return {r[0] for r in rows}
+
+def _kind_dim(kind: str) -> int | None:
+    # "chunk:25@768" -> 768; kinds recorded before dimensions were tracked have none
+    return int(kind.rsplit("@", 1)[1]) if "@" in kind else None
+
+def _by_dim(rows) -> Dict[int | None, List[str]]:
+    out: Dict[int | None, List[str]] = {}
+    for vid, k in rows:
+        out.setdefault(_kind_dim(k), []).append(vid)
+    return out
+
+def _commit_progress(table: str, generation: int, limit: int | None, rows_done: int, ids: List[str],
+                     kind: str = "row", after: List[str] | None = None) -> Dict[int | None, List[str]]:
+    """
+    Record the chunk's vectors as present in this generation, then move the
+    checkpoint. Returns the ids that were last written at another dimension,
+    by dimension: the same document now lives in this run's index instead.
+    """
+    ensure_ddl("index_manifest", _MANIFEST_DDL)
+    with get_engine().begin() as conn:
+        moved = conn.execute(text(
+            "WITH prev AS (SELECT vector_id, kind FROM caffeinate_index_manifest "
+            "              WHERE physical=:t AND vector_id = ANY(:ids) AND kind <> :k), "
+            "up AS (INSERT INTO caffeinate_index_manifest (physical, vector_id, seen_gen, kind) "
+            "       SELECT :t, unnest(CAST(:ids AS text[])), :g, :k "
+            "       ON CONFLICT (physical, vector_id) DO UPDATE SET seen_gen = EXCLUDED.seen_gen, kind = EXCLUDED.kind) "
+            "SELECT vector_id, kind FROM prev"
+        ), {"t": table, "ids": list(dict.fromkeys(ids)), "g": generation, "k": kind}).fetchall()  # duplicate rows share an id
+    _save_checkpoint(table, generation, limit, rows_done, "running", kind, after)
+    dim = _kind_dim(kind)
+    return {d: v for d, v in _by_dim(moved).items() if d != dim}
+
+def _manifest_sweep(table: str, generation: int, kind: str = "row") -> Dict[int | None, List[str]]:
+    # after a complete pass: whatever was not seen in this generation is gone from the table,
+    # and documents of another granularity were replaced by this pass
+    with get_engine().begin() as conn:
+        rows = conn.execute(text(
+            "DELETE FROM caffeinate_index_manifest WHERE physical=:t AND (seen_gen < :g OR kind <> :k) "
+            "RETURNING vector_id, kind"
+        ), {"t": table, "g": generation, "k": kind}).fetchall()
+    return _by_dim(rows)  # grouped by the dimension (so the index) the vectors were written to
+
+def _estimated_rows(table: str) -> int | None:
+    # planner estimate (tables are analyzed at ingest), exact count if never analyzed
+    with get_engine().connect() as conn:
+        est = conn.execute(text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:q)"),
+                           {"q": f'"{table}"'}).scalar()
+        if est is None or est < 0:
+            est = conn.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
+    return int(est) if est is not None else None
+
+def _documents(df: pd.DataFrame, table: str, granularity: str, pos: pd.DataFrame | None, roles: Dict,
+               key_label: str | None):
+    # (texts, metadata builder for the positions that get embedded) for one chunk of the source
+    if granularity == "chunk":
+        return chunk_documents(df, table, pos[_KEY].tolist(), pos[_PART].tolist(), roles, key_label)
+    if granularity == "summary":
+        return summary_documents(df, table)
+    texts = dataframe_to_texts(df, table)
+    return texts, lambda pos: dataframe_to_metadata(df.iloc[pos], table, [texts[i] for i in pos])
+
+def index_table(table: str, limit: int | None = None, resume: bool = True, mode: str = "full",
+                on_progress: Callable[[int, int | None], None] | None = None,
+                granularity: str = "row", rows_per_doc: int = CHUNK_DOC_ROWS, dim: int | None = None) -> Dict:
+    """
+    Embed and upsert `table` as a pipeline: chunks are read through a
+    server-side cursor, each chunk is embedded in parallel batches, and its
+    upsert runs in the background while the next chunk is read and embedded.
+    Progress is checkpointed after every upserted chunk; with `resume` an
+    interrupted run of the same table generation and limit continues where
+    it stopped.
+
+    Vector ids are content hashes tracked in a per-table manifest.
+    mode="incremental" only embeds rows whose id is not in the manifest yet;
+    any complete pass (no `limit`) deletes vectors of rows that disappeared.
+
+    granularity="row" embeds one document per row, "chunk" one per
+    `rows_per_doc` rows of the same day (or product, without a date
+    column), "summary" one per day, product and
+    customer aggregate (there `limit` counts summary rows). A complete pass
+    also removes the table's documents of any other granularity.
+
+    Vectors have `dim` dimensions (default EMBEDDING_DIM) and go to the
+    index named after the model and that dimension; changing it re-embeds
+    everything into a fresh index. Within it they live in the table's own
+    namespace (vectorstore.namespace_for).
+
+    `on_progress(rows_done, rows_expected)` runs after every committed
+    chunk; an exception from it stops the run (the checkpoint is kept).
+    """
+    if mode not in INDEX_MODES:
+        raise ValueError(f"mode must be one of {INDEX_MODES}")
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {GRANULARITIES}")
+    rows_per_doc = max(int(rows_per_doc), 1)
+    dim = embedding_dim(dim)
+    # what a manifest entry stands for: documents of this shape, in the index for this dimension
+    kind = f"{f'chunk:{rows_per_doc}' if granularity == 'chunk' else granularity}@{dim}"
     # Lazy import to avoid pulling SDKs unless needed
     from services.embeddings import get_embedder
-    from services.vectorstore import ensure_index, upsert_vectors
+    from services.vectorstore import ensure_index, upsert_vectors, delete_vectors, namespace_for
 
-    df = load_df(table, limit)
-    if df.empty:
-        return {"table": table, "rows_indexed": 0, "message": "table is empty"}
+    namespace = namespace_for(table)
+    with get_engine().connect() as conn:
+        generation = get_generation(conn, table)
+    ckpt = _load_checkpoint(table) if resume else None
+    start, after = 0, None
+    if ckpt and ckpt["status"] == "running" and ckpt["generation"] == generation \
+            and ckpt["row_limit"] == (limit or 0) and ckpt["kind"] == kind:
+        start = int(ckpt["rows_done"])
+        # table passes resume behind the last committed row; a summary pass counts summary rows
+        after = json.loads(ckpt["resume_after"]) if ckpt["resume_after"] else None
+        if granularity != "summary" and start and len(after or ()) != (2 if granularity == "chunk" else 1):
+            start = 0  # written before positions (or chunk keys) were checkpointed
+    if (limit and start >= limit) or not start:
+        start, after = 0, None
 
-    texts = dataframe_to_texts(df, table)
-    metas = dataframe_to_metadata(df, table, texts)
+    ensure_index(dim=dim, metric="cosine")
+    embedder = get_embedder(dim)
+    _save_checkpoint(table, generation, limit, start, "running", kind, after)
+
+    timings = {"read": 0.0, "prepare": 0.0, "embed": 0.0, "upsert": 0.0}
+
+    def _upsert(items: List[Dict]) -> float:
+        t0 = time.perf_counter()
+        for s in range(0, len(items), UPSERT_BATCH):
+            upsert_vectors(items[s:s + UPSERT_BATCH], namespace=namespace)
+        return time.perf_counter() - t0
+
+    expected = (limit or _estimated_rows(table)) if on_progress and granularity != "summary" else limit
+    def _drop(ids: List[str], in_dim: int | None, required: bool = False) -> int:
+        try:
+            for s in range(0, len(ids), DELETE_BATCH):
+                delete_vectors(ids[s:s + DELETE_BATCH], in_dim, namespace=namespace)
+        except Exception:
+            if required:
+                raise  # an index of another dimension is no longer queried and may be gone
+        return len(ids)
+
+    def _drop_other_dims(moved: Dict[int | None, List[str]]) -> int:
+        return sum(_drop(ids, d) for d, ids in moved.items())
+
+    t_start = time.perf_counter()
+    done, embedded, docs, deleted = start, 0, 0, 0
+    pending = None  # (future, rows_done once it lands, ids of the chunk, position of its last row)
+    remaining = (limit - start) if limit else None
+    roles: Dict = {}
+    key_label = None
+    if granularity == "summary":
+        chunks = ((df, None) for df in iter_summary_frames(table, INDEX_CHUNK_ROWS, offset=start, limit=remaining))
+    else:
+        key_sql = None
+        if granularity == "chunk":
+            with get_engine().connect() as conn:
+                roles = summary_roles(conn, table) or {}
+            # documents hold the rows of one day (or product), so appends leave the others as they were
+            key_label, key_sql = chunk_key(roles)
+        chunks = iter_table_chunks(table, INDEX_CHUNK_ROWS, after=after, limit=remaining, key_sql=key_sql,
+                                   part_rows=rows_per_doc)
+    embed_pool = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY)
+    upsert_pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            t0 = time.perf_counter()
+            df, pos = next(chunks, (None, None))
+            timings["read"] += time.perf_counter() - t0
+            if df is None:
+                break
+            if df.empty:
+                continue
+
+            t0 = time.perf_counter()
+            texts, metadata = _documents(df, table, granularity, pos, roles, key_label)
+            docs += len(texts)
+            ids = [vector_id(table, t) for t in texts]
+            skip = _manifest_known(table, ids, kind) if mode == "incremental" else set()
+            todo: Dict[str, int] = {}  # id -> row position; identical rows share one vector
+            for i, vid in enumerate(ids):
+                if vid not in skip and vid not in todo:
+                    todo[vid] = i
+            rows_idx = list(todo.values())
+            sub_texts = [texts[i] for i in rows_idx]
+            metas = metadata(rows_idx)
+            timings["prepare"] += time.perf_counter() - t0
 
-    ensure_index(dim=DIM, metric="cosine")
-    embedder = get_embedder()
-    vectors: List[List[float]] = embedder.embed_documents(texts)
+            t0 = time.perf_counter()
+            batches = [sub_texts[s:s + EMBED_BATCH] for s in range(0, len(sub_texts), EMBED_BATCH)]
+            vectors: List[List[float]] = list(chain.from_iterable(embed_pool.map(embedder.embed_documents, batches)))
+            timings["embed"] += time.perf_counter() - t0
+            if vectors and len(vectors[0]) != dim:
+                raise ValueError(f"embedder returned {len(vectors[0])}-d vectors, expected {dim}")
 
-    items = []
-    for i, vec in enumerate(vectors):
-        items.append({
-            "id": f"{table}:{i}",
-            "values": vec,
-            "metadata": metas[i],  # sanitized types
-        })
+            items = [
+                {"id": vid, "values": vec, "metadata": metas[i]}  # sanitized types
+                for i, (vid, vec) in enumerate(zip(todo, vectors))
+            ]
+            if pending:
+                timings["upsert"] += pending[0].result()
+                deleted += _drop_other_dims(_commit_progress(table, generation, limit, pending[1], pending[2], kind, pending[3]))
+                if on_progress:
+                    on_progress(pending[1], expected)
+            done += len(df)
+            embedded += len(items)
+            pending = (upsert_pool.submit(_upsert, items), done, ids, row_position(pos))
+        if pending:
+            timings["upsert"] += pending[0].result()
+            deleted += _drop_other_dims(_commit_progress(table, generation, limit, pending[1], pending[2], kind, pending[3]))
+            if on_progress:
+                on_progress(pending[1], expected)
+    finally:
+        chunks.close()
+        embed_pool.shutdown(wait=True)
+        upsert_pool.shutdown(wait=True)
 
-    # Chunk the upsert
-    B = 200
-    for s in range(0, len(items), B):
-        upsert_vectors(items[s:s+B])
+    if not limit:
+        for stale_dim, stale in _manifest_sweep(table, generation, kind).items():
+            deleted += _drop(stale, stale_dim, required=stale_dim == dim)
+    _save_checkpoint(table, generation, limit, done, "done", kind)
+    if embedded or deleted:
+        with get_engine().begin() as conn:
+            bump_generation(conn, index_generation_name(table))
 
-    return {"table": table, "rows_indexed": len(items), "dim": len(vectors[0]) if vectors else DIM}
+    for stage, secs in timings.items():
+        observe(f"index_{stage}", secs)
+    scanned = done - start
+    if done == 0:
+        message = "no date, product or customer column to summarize" if granularity == "summary" else "table is empty"
+        return {"table": table, "rows_indexed": 0, "vectors_deleted": deleted, "message": message}
+    return {
+        "table": table, "mode": mode, "granularity": granularity, "rows_indexed": embedded, "rows_scanned": scanned,
+        "rows_unchanged": scanned - embedded if granularity == "row" else None, "documents": docs, "documents_unchanged": docs - embedded,
+        "vectors_deleted": deleted,
+        "resumed_from": start, "rows_total": done,
+        "dim": dim, "seconds": round(time.perf_counter() - t_start, 3),
+        "stages": {
+            "read": _stage(timings["read"], scanned), "prepare": _stage(timings["prepare"], scanned),
+            "embed": _stage(timings["embed"], embedded), "upsert": _stage(timings["upsert"], embedded),
+        },
+    }
 
+def drop_table_vectors(table: str) -> Dict:
+    """
+    Forget everything indexed for `table` after it was replaced wholesale:
+    its namespace in every index the manifest points at (one call each, no
+    listing of ids), its manifest entries and its checkpoint.
+    """
+    from services.vectorstore import delete_namespace, namespace_for
+    ensure_ddl("index_manifest", _MANIFEST_DDL)
+    ensure_ddl("index_checkpoints", _CKPT_DDL)
+    with get_engine().connect() as conn:
+        kinds = conn.execute(text("SELECT DISTINCT kind FROM caffeinate_index_manifest WHERE physical=:t"),
+                             {"t": table}).scalars().all()
+    if not kinds:
+        return {"table": table, "dims": []}
+    current = embedding_dim()
+    dims = sorted({_kind_dim(k) or current for k in kinds})
+    for d in dims:
+        try:
+            delete_namespace(namespace_for(table), d)
+        except Exception:
+            if d == current:
+                raise  # an index of another dimension is no longer queried and may be gone
+    with get_engine().begin() as conn:
+        conn.execute(text("DELETE FROM caffeinate_index_manifest WHERE physical=:t"), {"t": table})
+        conn.execute(text("DELETE FROM caffeinate_index_checkpoints WHERE physical=:t"), {"t": table})
+        bump_generation(conn, index_generation_name(table))
+    return {"table": table, "dims": dims}
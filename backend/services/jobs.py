@@ -0,0 +1,285 @@
+﻿import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import text
+from services.db import get_engine, ensure_ddl
+
+# Background jobs without a broker: a Postgres table is the queue and every
+# API process runs a few worker threads that claim jobs with
+# SELECT ... FOR UPDATE SKIP LOCKED. Per-kind limits apply across processes
+# (claims are serialized by an advisory lock), so ingest and indexing stay
+# within a few pooled connections and metrics requests keep theirs.
+
+WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # worker threads per process; 0 = enqueue only
+KIND_LIMITS = {
+    "ingest": int(os.getenv("JOB_LIMIT_INGEST", "1")),
+    "index": int(os.getenv("JOB_LIMIT_INDEX", "1")),
+}
+POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "900"))  # running jobs without a heartbeat this long are failed
+HEARTBEAT_SECONDS = min(60.0, STALE_SECONDS / 3)
+SPOOL_DIR = os.getenv("JOB_SPOOL_DIR", "/tmp/caffeinate-spool")
+HOST = socket.gethostname()
+STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS caffeinate_jobs (
+    id               TEXT PRIMARY KEY,
+    kind             TEXT NOT NULL,
+    status           TEXT NOT NULL DEFAULT 'queued',
+    params           JSONB NOT NULL DEFAULT '{}',
+    host             TEXT,                 -- jobs with local inputs (spooled uploads) only run here
+    worker           TEXT,
+    rows_done        BIGINT NOT NULL DEFAULT 0,
+    rows_total       BIGINT,
+    fraction         DOUBLE PRECISION,
+    result           JSONB,
+    error            TEXT,
+    cancel_requested BOOLEAN NOT NULL DEFAULT false,
+    created_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at       TIMESTAMPTZ,
+    heartbeat_at     TIMESTAMPTZ,
+    finished_at      TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS caffeinate_jobs_queued ON caffeinate_jobs (created_at) WHERE status = 'queued'
+"""
+
+_COLS = ("id, kind, status, params, host, worker, rows_done, rows_total, fraction, result, error, "
+         "cancel_requested, created_at, started_at, heartbeat_at, finished_at")
+
+class JobCancelled(Exception):
+    pass
+
+class JobContext:
+    """Handed to job handlers: report progress, and stop when cancelled."""
+    PROGRESS_EVERY = 1.0  # seconds between progress writes
+
+    def __init__(self, job_id: str, params: Dict):
+        self.id, self.params = job_id, params
+        self._last = 0.0
+
+    def progress(self, rows_done: int, rows_total: Optional[int] = None, fraction: Optional[float] = None,
+                 force: bool = False):
+        # also the cancellation point: raises JobCancelled once a cancel was requested
+        now = time.monotonic()
+        if not force and now - self._last < self.PROGRESS_EVERY:
+            return
+        self._last = now
+        with get_engine().begin() as conn:
+            cancel = conn.execute(text(
+                "UPDATE caffeinate_jobs SET rows_done = :d, rows_total = COALESCE(:t, rows_total), "
+                "fraction = COALESCE(:f, fraction), heartbeat_at = now() WHERE id = :id RETURNING cancel_requested"
+            ), {"id": self.id, "d": int(rows_done), "t": rows_total, "f": fraction}).scalar()
+        if cancel:
+            raise JobCancelled()
+
+_handlers: Dict[str, Callable[[JobContext], Dict]] = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_threads: List[threading.Thread] = []
+
+def register(kind: str, handler: Callable[[JobContext], Dict]):
+    _handlers[kind] = handler
+
+def _ddl():
+    ensure_ddl("jobs", _DDL)
+
+def enqueue(kind: str, params: Dict, local: bool = False) -> str:
+    """Queue a job and return its id; `local` pins it to this host (its inputs are on local disk)."""
+    _ddl()
+    job_id = uuid.uuid4().hex
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            "INSERT INTO caffeinate_jobs (id, kind, params, host) VALUES (:id, :k, CAST(:p AS jsonb), :h)"
+        ), {"id": job_id, "k": kind, "p": json.dumps(params, default=str), "h": HOST if local else None})
+    _wake.set()
+    return job_id
+
+def spool_path(job_hint: str = "") -> str:
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return os.path.join(SPOOL_DIR, f"{job_hint}{uuid.uuid4().hex}.upload")
+
+def _view(row) -> Dict:
+    j = dict(row._mapping)
+    elapsed = None
+    if j["started_at"] is not None:
+        end = j["finished_at"] or j["heartbeat_at"] or j["started_at"]
+        elapsed = max((end - j["started_at"]).total_seconds(), 0.0)
+    done, total, frac = j["rows_done"], j["rows_total"], j["fraction"]
+    if frac is None and total:
+        frac = min(done / total, 1.0)
+    j["elapsed_s"] = round(elapsed, 3) if elapsed is not None else None
+    j["rows_per_sec"] = round(done / elapsed, 1) if elapsed else None
+    j["eta_s"] = round(elapsed * (1 - frac) / frac, 1) if elapsed and frac and j["status"] == "running" else None
+    j["fraction"] = round(frac, 4) if frac is not None else None
+    return j
+
+# jobs belong to the tenant whose table they load or index (params.physical = tenant__table)
+_OWNED = "(CAST(:tenant AS text) IS NULL OR starts_with(params->>'physical', :tenant || '__'))"
+
+def get_job(job_id: str, tenant: Optional[str] = None) -> Optional[Dict]:
+    _ddl()
+    with get_engine().connect() as conn:
+        row = conn.execute(text(f"SELECT {_COLS} FROM caffeinate_jobs WHERE id = :id AND {_OWNED}"),
+                           {"id": job_id, "tenant": tenant}).first()
+    return _view(row) if row else None
+
+def list_jobs(kind: Optional[str] = None, status: Optional[str] = None, limit: int = 50,
+              tenant: Optional[str] = None) -> List[Dict]:
+    _ddl()
+    where, params = [_OWNED], {"n": limit, "tenant": tenant}
+    if kind:
+        where.append("kind = :k")
+        params["k"] = kind
+    if status:
+        where.append("status = :s")
+        params["s"] = status
+    with get_engine().connect() as conn:
+        rows = conn.execute(text(
+            f"SELECT {_COLS} FROM caffeinate_jobs WHERE {' AND '.join(where)} "
+            "ORDER BY created_at DESC LIMIT :n"
+        ), params).fetchall()
+    return [_view(r) for r in rows]
+
+def cancel_job(job_id: str, tenant: Optional[str] = None) -> Optional[Dict]:
+    # queued jobs are cancelled at once; running ones stop at their next progress report
+    _ddl()
+    if get_job(job_id, tenant) is None:
+        return None
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            "UPDATE caffeinate_jobs SET cancel_requested = true, "
+            "status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+            "finished_at = CASE WHEN status = 'queued' THEN now() ELSE finished_at END "
+            "WHERE id = :id"
+        ), {"id": job_id})
+    return get_job(job_id, tenant)
+
+def _claim(worker: str) -> Optional[Dict]:
+    with get_engine().begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('caffeinate_jobs'))"))
+        running = dict(conn.execute(text(
+            "SELECT kind, count(*) FROM caffeinate_jobs WHERE status = 'running' GROUP BY kind"
+        )).fetchall())
+        kinds = [k for k in _handlers if running.get(k, 0) < KIND_LIMITS.get(k, 1)]
+        if not kinds:
+            return None
+        row = conn.execute(text(
+            "SELECT id, kind, params FROM caffeinate_jobs WHERE status = 'queued' AND kind = ANY(:kinds) "
+            "AND (host IS NULL OR host = :h) ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED"
+        ), {"kinds": kinds, "h": HOST}).first()
+        if row is None:
+            return None
+        conn.execute(text(
+            "UPDATE caffeinate_jobs SET status = 'running', worker = :w, started_at = now(), heartbeat_at = now() "
+            "WHERE id = :id"
+        ), {"id": row[0], "w": worker})
+    return {"id": row[0], "kind": row[1], "params": row[2] or {}}
+
+def _finish(job_id: str, status: str, result: Optional[Dict] = None, error: Optional[str] = None):
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            "UPDATE caffeinate_jobs SET status = :s, result = CAST(:r AS jsonb), error = :e, "
+            "fraction = CASE WHEN :s = 'succeeded' THEN 1 ELSE fraction END, "
+            "finished_at = now(), heartbeat_at = now() WHERE id = :id"
+        ), {"id": job_id, "s": status, "r": json.dumps(result, default=str) if result is not None else None,
+            "e": error})
+
+def _reap_stale():
+    # jobs whose worker died (no heartbeat) would otherwise hold their kind's slot forever
+    _ddl()
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            "UPDATE caffeinate_jobs SET status = 'failed', error = 'worker lost (no heartbeat)', finished_at = now() "
+            "WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => :s)"
+        ), {"s": STALE_SECONDS})
+
+def _sweep_spool():
+    # uploads whose job will never run here: cancelled from another host, reaped, or never enqueued
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    with get_engine().connect() as conn:
+        live = set(conn.execute(text(
+            "SELECT params->>'spool' FROM caffeinate_jobs "
+            "WHERE host = :h AND status IN ('queued', 'running') AND params ? 'spool'"
+        ), {"h": HOST}).scalars())
+    cutoff = time.time() - STALE_SECONDS  # spooled but not enqueued yet is recent
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if path not in live and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass  # removed by its handler meanwhile
+
+def _heartbeat(job_id: str, done: threading.Event):
+    # phases that report no progress (merge, publish, index builds) must not look like a lost worker
+    while not done.wait(HEARTBEAT_SECONDS):
+        try:
+            with get_engine().begin() as conn:
+                conn.execute(text("UPDATE caffeinate_jobs SET heartbeat_at = now() WHERE id = :id AND status = 'running'"),
+                             {"id": job_id})
+        except Exception:
+            pass  # the next beat retries
+
+def run_one(worker: str = "inline") -> bool:
+    """Claim and run one job; False when nothing was runnable."""
+    job = _claim(worker)
+    if job is None:
+        return False
+    ctx = JobContext(job["id"], job["params"])
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job["id"], done), name=f"job-heartbeat-{job['id'][:8]}",
+                     daemon=True).start()
+    try:
+        result = _handlers[job["kind"]](ctx)
+        _finish(job["id"], "succeeded", result=result)
+    except JobCancelled:
+        _finish(job["id"], "cancelled")
+    except Exception as e:
+        _finish(job["id"], "failed", error=f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}")
+    finally:
+        done.set()
+    return True
+
+def _loop(worker: str):
+    # the first pass creates the table and reaps; until the database is up it is retried here
+    reaped = float("-inf")
+    while not _stop.is_set():
+        try:
+            if time.monotonic() - reaped > 60:
+                _reap_stale()
+                _sweep_spool()
+                reaped = time.monotonic()
+            if run_one(worker):
+                continue
+        except Exception:
+            pass  # database hiccup: back off and retry
+        _wake.wait(POLL_SECONDS)
+        _wake.clear()
+
+def start_workers(n: int = WORKERS):
+    # needs no database: the workers set up the queue table once it is reachable
+    if n <= 0 or _threads:
+        return
+    _stop.clear()
+    for i in range(n):
+        t = threading.Thread(target=_loop, args=(f"{HOST}:{os.getpid()}:{i}",), name=f"job-worker-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+def local_workers() -> int:
+    """Worker threads of this process; jobs pinned to this host need at least one."""
+    return sum(t.is_alive() for t in _threads)
+
+def stop_workers(timeout: float = 5.0):
+    _stop.set()
+    _wake.set()
+    for t in _threads:
+        t.join(timeout)
+    _threads.clear()
@@ -0,0 +1,423 @@
+﻿import hashlib
+import io
+import os
+import re
+import time
+import uuid
+from typing import Callable, Dict, IO, List, Optional, Tuple
+import pandas as pd
+from pandas.api import types as ptypes
+from psycopg import errors as pg_errors
+from sqlalchemy import text
+from services.db import get_engine
+from services.analytics import detect_roles, col_types, save_table_meta, load_table_meta
+from services.rollups import build_rollups, derived_name, merge_into_rollups, rollups_present
+from services.cache import bump_generation, get_generation
+from services.changes import record_change
+from services.columns import date_expr
+from services.telemetry import observe, timed
+
+CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "50000"))
+CATEGORY_MAX = int(os.getenv("INGEST_CATEGORY_MAX", "1000"))  # distinct values for text to count as categorical
+INDEXED_ROLES = ("date", "product")
+INGEST_MODES = ("replace", "append", "upsert")
+# roles whose change makes the rollups (and anything derived from roles) stale
+_ROLLUP_ROLES = ("date", "product", "qty", "price")
+
+# widening order when a later chunk no longer fits the type locked from the first one
+_WIDER = {"BOOLEAN": "TEXT", "BIGINT": "DOUBLE PRECISION", "DOUBLE PRECISION": "TEXT",
+          "DATE": "TIMESTAMP", "TIMESTAMP": "TEXT", "TIMESTAMPTZ": "TEXT"}
+_DATETIME_TYPES = ("DATE", "TIMESTAMP", "TIMESTAMPTZ")
+
+# text that parses as dates: ISO 8601 (optionally with time and offset) or US m/d/Y
+_ISO_RE = re.compile(r"^\d{4}-\d{1,2}-\d{1,2}([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}(:?\d{2})?)?$")
+_US_RE = re.compile(r"^\d{1,2}/\d{1,2}/\d{4}( \d{1,2}:\d{2}(:\d{2})?)?$")
+_TZ_RE = re.compile(r"(?:Z|[+-]\d{2}:?\d{2})$")
+
+def _qi(name: str) -> str:
+    # quote an identifier for Postgres
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _is_text(s: pd.Series) -> bool:
+    return ptypes.is_object_dtype(s.dtype) or ptypes.is_string_dtype(s.dtype)
+
+def _as_datetime(s: pd.Series) -> Optional[pd.Series]:
+    # the whole column parsed as datetimes, or None if any value is not a date
+    vals = s.dropna().astype(str).str.strip()
+    if vals.empty:
+        return None
+    sample = vals.iloc[:200]
+    if sample.str.match(_ISO_RE).all():
+        fmt = "ISO8601"
+    elif sample.str.match(_US_RE).all():
+        fmt = "mixed"
+    else:
+        return None
+    try:
+        return pd.to_datetime(s, format=fmt, utc=bool(sample.str.contains(_TZ_RE).any()))
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def infer_dates(df: pd.DataFrame, schema: Optional[List[Tuple[str, str]]] = None) -> pd.DataFrame:
+    """
+    Parse date-like text columns. With a locked `schema` only the columns
+    already typed as dates are parsed (failures then widen them to TEXT).
+    """
+    locked = dict(schema or [])
+    out = df
+    for col in df.columns:
+        if not _is_text(df[col]) or (locked and locked.get(col) not in _DATETIME_TYPES):
+            continue
+        parsed = _as_datetime(df[col])
+        if parsed is not None:
+            if out is df:
+                out = df.copy()
+            out[col] = parsed
+    return out
+
+def _date_only(s: pd.Series) -> bool:
+    vals = s.dropna()
+    return not isinstance(s.dtype, pd.DatetimeTZDtype) and bool((vals == vals.dt.normalize()).all())
+
+def date_dtypes(df: pd.DataFrame) -> Dict:
+    # to_sql dtype overrides so date-only columns are stored as DATE, not TIMESTAMP
+    from sqlalchemy import Date
+    return {c: Date() for c in df.columns
+            if ptypes.is_datetime64_any_dtype(df[c].dtype) and not df[c].dropna().empty and _date_only(df[c])}
+
+def _pg_type(s: pd.Series) -> str:
+    if ptypes.is_bool_dtype(s.dtype):
+        return "BOOLEAN"
+    if ptypes.is_integer_dtype(s.dtype):
+        return "BIGINT"
+    if ptypes.is_float_dtype(s.dtype):
+        return "DOUBLE PRECISION"
+    if isinstance(s.dtype, pd.DatetimeTZDtype):
+        return "TIMESTAMPTZ"
+    if ptypes.is_datetime64_any_dtype(s.dtype):
+        return "DATE" if not s.dropna().empty and _date_only(s) else "TIMESTAMP"
+    return "TEXT"
+
+def _fits(s: pd.Series, pg: str) -> bool:
+    if pg == "TEXT":
+        return True
+    vals = s.dropna()
+    if pg == "BOOLEAN":
+        return ptypes.is_bool_dtype(s.dtype) or vals.isin([True, False]).all()
+    if pg == "BIGINT":
+        if ptypes.is_integer_dtype(s.dtype):
+            return True
+        return ptypes.is_float_dtype(s.dtype) and bool((vals == vals.round()).all())
+    if pg == "DOUBLE PRECISION":
+        return ptypes.is_numeric_dtype(s.dtype) and not ptypes.is_bool_dtype(s.dtype)
+    if pg == "DATE":
+        return vals.empty or (ptypes.is_datetime64_any_dtype(s.dtype) and _date_only(s))
+    return ptypes.is_datetime64_any_dtype(s.dtype) or vals.empty
+
+def _conform(df: pd.DataFrame, schema: List[Tuple[str, str]]) -> pd.DataFrame:
+    # integral floats (ints + NaN in this chunk) must be written as "3", not "3.0"
+    out = df
+    for col, pg in schema:
+        if pg == "BIGINT" and ptypes.is_float_dtype(df[col].dtype) and _fits(df[col], pg):
+            if out is df:
+                out = df.copy()
+            out[col] = df[col].astype("Int64")
+    return out
+
+def _copy_frame(raw_conn, table: str, df: pd.DataFrame):
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    cols = ", ".join(_qi(c) for c in df.columns)
+    with raw_conn.cursor() as cur:
+        with cur.copy(f"COPY {_qi(table)} ({cols}) FROM STDIN WITH (FORMAT csv)") as cp:
+            cp.write(buf.getvalue())
+
+def _categorical(conn, table: str, types: Dict[str, str]) -> List[str]:
+    # text columns with few distinct values, from the statistics ANALYZE just gathered
+    rows = conn.execute(text(
+        "SELECT s.attname, CASE WHEN s.n_distinct >= 0 THEN s.n_distinct ELSE -s.n_distinct * c.reltuples END "
+        "FROM pg_stats s JOIN pg_class c ON c.oid = to_regclass(:q) "
+        "WHERE s.schemaname = current_schema() AND s.tablename = :t"
+    ), {"q": _qi(table), "t": table}).fetchall()
+    distinct = {r[0]: r[1] for r in rows}
+    return [c for c, t in types.items() if t == "text" and 0 < (distinct.get(c) or 0) <= CATEGORY_MAX]
+
+def prepare_table(conn, table: str) -> Dict:
+    """
+    Index the date and product columns of a freshly loaded table, gather its
+    statistics and work out its column roles. Run it in the loading
+    transaction, before the table becomes visible.
+    """
+    types = col_types(conn, table)
+    roles = detect_roles(list(types), types)
+    for role in INDEXED_ROLES:
+        if roles[role]:
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {_qi(derived_name(table, f'__{role}_idx'))} "
+                f"ON {_qi(table)} ({_qi(roles[role])})"
+            ))
+    conn.execute(text(f"ANALYZE {_qi(table)}"))
+    roles["categorical"] = _categorical(conn, table, types)
+    return roles
+
+def publish_table(conn, physical: str, roles: Dict, rows: int = 0) -> int:
+    # rollups, recorded roles and the generation bump commit with the new table
+    build_rollups(conn, physical, roles)
+    save_table_meta(conn, physical, roles)
+    generation = bump_generation(conn, physical)
+    record_change(conn, physical, generation, "replace", True, inserted=rows)
+    return generation
+
+# ---- append / upsert ----
+_PG_NAMES = {"bigint": "BIGINT", "double precision": "DOUBLE PRECISION", "text": "TEXT", "boolean": "BOOLEAN",
+             "date": "DATE", "timestamp without time zone": "TIMESTAMP", "timestamp with time zone": "TIMESTAMPTZ"}
+
+def _table_types(conn, table: str) -> List[Tuple[str, str]]:
+    rows = conn.execute(text(
+        "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = to_regclass(:q) AND attnum > 0 AND NOT attisdropped ORDER BY attnum"
+    ), {"q": _qi(table)}).fetchall()
+    return [(r[0], _PG_NAMES.get(r[1], r[1].upper())) for r in rows]
+
+def _copy_rejected(e: pg_errors.DataError) -> ValueError:
+    # COPY's context names the staging table; keep the column and the value
+    where = re.search(r"column .*$", e.diag.context or "")
+    return ValueError(f"values do not fit the table's column types: {e.diag.message_primary}"
+                      + (f" ({where.group(0)})" if where else ""))
+
+def _key_index(conn, physical: str, keys: List[str]):
+    # merges probe the table by key; named after the key set so another set gets its own index
+    tag = hashlib.md5("|".join(keys).encode()).hexdigest()[:6]
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {_qi(derived_name(physical, f'__key_{tag}_idx'))} "
+                      f"ON {_qi(physical)} ({', '.join(_qi(k) for k in keys)})"))
+
+def _date_range(conn, roles: Dict, source: str) -> Tuple:
+    col = roles.get("date")
+    if not col:
+        return None, None
+    d = date_expr(roles, col)
+    return tuple(conn.execute(text(f"SELECT MIN({d}), MAX({d}) FROM {source}")).one())
+
+def _span(*ranges) -> Tuple:
+    lows = [r[0] for r in ranges if r[0] is not None]
+    highs = [r[1] for r in ranges if r[1] is not None]
+    return (min(lows) if lows else None, max(highs) if highs else None)
+
+def _merge(conn, physical: str, staging: str, schema: List[Tuple[str, str]], mode: str,
+           keys: List[str]) -> Dict:
+    """
+    Fold the rows of `staging` into the existing `physical`, set-based:
+    "append" inserts them (rows whose key is already present are skipped),
+    "upsert" updates rows with a matching key whose values differ and
+    inserts the rest. Rows of the upload sharing a key count once (the last
+    one wins); rows with a NULL key never match. Columns missing from the
+    upload are NULL in inserted rows and left alone in updated ones. The
+    table's column types never change: `staging` was typed from them.
+    """
+    # one merge per table at a time; readers are not blocked
+    conn.execute(text(f"LOCK TABLE {_qi(physical)} IN SHARE ROW EXCLUSIVE MODE"))
+    target = dict(_table_types(conn, physical))
+    extra = [c for c, _ in schema if c not in target]
+    if extra:
+        raise ValueError(f"columns not in the existing table: {', '.join(extra)}")
+    missing = [k for k in keys if k not in target or k not in dict(schema)]
+    if missing:
+        raise ValueError(f"key columns not in the upload and the table: {', '.join(missing)}")
+    changed = [c for c, pg in schema if target[c] != pg]
+    if changed:
+        raise ValueError(f"the table was replaced during the upload (columns {', '.join(changed)}); try again")
+    # every column of the table, so the inserted rows (and the rollups folded from them) see them all
+    cols = [c for c, _ in schema]
+    sel = ", ".join(f"{_qi(c) if c in cols else 'NULL'}::{pg.lower()} AS {_qi(c)}" for c, pg in target.items())
+    collist = ", ".join(_qi(c) for c in target)
+    ins_name = f"{staging}_ins"
+    src, ins = _qi(f"{staging}_src"), _qi(ins_name)
+    if keys:
+        klist = ", ".join(_qi(k) for k in keys)
+        any_null = " OR ".join(f"{_qi(k)} IS NULL" for k in keys)
+        conn.execute(text(
+            f"CREATE TEMP TABLE {src} ON COMMIT DROP AS "
+            f"(SELECT DISTINCT ON ({klist}) {sel} FROM {_qi(staging)} WHERE NOT ({any_null}) "
+            f" ORDER BY {klist}, ctid DESC) "
+            f"UNION ALL (SELECT {sel} FROM {_qi(staging)} WHERE {any_null})"
+        ))
+        _key_index(conn, physical, keys)
+        match = " AND ".join(f"t.{_qi(k)} = s.{_qi(k)}" for k in keys)
+    else:
+        conn.execute(text(f"CREATE TEMP TABLE {src} ON COMMIT DROP AS SELECT {sel} FROM {_qi(staging)}"))
+        match = "FALSE"
+    conn.execute(text(f"DROP TABLE {_qi(staging)}"))
+
+    table_roles = _recorded_roles(conn, physical)
+    updated, old_range = 0, (None, None)
+    if mode == "upsert":
+        differs = f"({', '.join(f't.{_qi(c)}' for c in cols)}) IS DISTINCT FROM ({', '.join(f's.{_qi(c)}' for c in cols)})"
+        # dates the changed rows had before the update: they change too
+        old_range = _date_range(conn, table_roles, f"(SELECT t.* FROM {_qi(physical)} t JOIN {src} s "
+                                                   f"ON {match} WHERE {differs}) o")
+        updated = conn.execute(text(
+            f"UPDATE {_qi(physical)} t SET {', '.join(f'{_qi(c)} = s.{_qi(c)}' for c in cols)} "
+            f"FROM {src} s WHERE {match} AND {differs}"
+        )).rowcount
+    conn.execute(text(
+        f"CREATE TEMP TABLE {ins} ON COMMIT DROP AS SELECT * FROM {src} s "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {_qi(physical)} t WHERE {match})"
+    ))
+    inserted = conn.execute(text(f"INSERT INTO {_qi(physical)} ({collist}) SELECT {collist} FROM {ins}")).rowcount
+    staged = conn.execute(text(f"SELECT COUNT(*) FROM {src}")).scalar()
+    out = {"inserted": inserted, "updated": updated}
+    if not (inserted or updated):
+        return {**out, "generation": None, "roles": table_roles, "staged": staged}
+
+    roles = prepare_table(conn, physical)
+    same_roles = all(roles.get(k) == table_roles.get(k) for k in _ROLLUP_ROLES)
+    present = rollups_present(conn, physical)
+    if mode == "append" and same_roles and present["day"] == bool(roles["date"]) \
+            and present["product"] == bool(roles["product"]):
+        merge_into_rollups(conn, physical, roles, ins_name)  # only added rows: fold their aggregates in
+    else:
+        build_rollups(conn, physical, roles)
+    save_table_meta(conn, physical, roles)
+    generation = bump_generation(conn, physical)
+    new_range = _date_range(conn, roles, src if mode == "upsert" else ins)
+    date_from, date_to = _span(old_range, new_range)
+    record_change(conn, physical, generation, mode, not same_roles, inserted, updated, date_from, date_to)
+    return {**out, "generation": generation, "roles": roles, "staged": staged}
+
+def _recorded_roles(conn, physical: str) -> Dict:
+    roles = load_table_meta(conn, physical)
+    if roles is None:
+        types = col_types(conn, physical)
+        roles = detect_roles(list(types), types)
+    return roles
+
+def _exists(conn, table: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:q) IS NOT NULL"), {"q": _qi(table)}).scalar()
+
+def _create_staging(conn, staging: str, schema: List[Tuple[str, str]]):
+    ddl = ", ".join(f"{_qi(c)} {pg}" for c, pg in schema)
+    conn.execute(text(f"CREATE TABLE {_qi(staging)} ({ddl})"))
+
+def staging_name(physical: str) -> str:
+    # stay under Postgres' 63-byte identifier limit
+    return f"{physical[:40]}__stg_{uuid.uuid4().hex[:8]}"
+
+def _fraction_read(fileobj: IO, size: Optional[int]) -> Optional[float]:
+    try:
+        return min(fileobj.tell() / size, 1.0) if size else None
+    except (OSError, ValueError):
+        return None
+
+def copy_csv_to_table(fileobj: IO, physical: str, chunk_rows: int = CHUNK_ROWS,
+                      on_chunk: Optional[Callable[[int, Optional[float]], None]] = None,
+                      mode: str = "replace", keys: Optional[List[str]] = None) -> Dict:
+    """
+    Stream a CSV into `physical` with bounded memory: the upload is parsed
+    `chunk_rows` at a time, the column types are locked from the first chunk
+    (date-like text becomes DATE/TIMESTAMP; types are only ever widened),
+    rows go in through COPY ... FROM STDIN into a staging table, which is
+    indexed and analyzed and then replaces `physical` (and its rollups are
+    rebuilt) in the same transaction so readers never see a half-loaded
+    table.
+
+    mode="append" / "upsert" merge the staged rows into an existing
+    `physical` instead (see _merge), deduplicating on the `keys` columns;
+    upsert needs keys. The staging table then takes the existing column
+    types and values that do not fit them fail the load (ValueError).
+    Appends fold into the rollups, upserts rebuild them. The result counts
+    rows inserted, updated and skipped.
+
+    `on_chunk(rows_so_far, fraction_of_file_read)` runs after every chunk;
+    an exception from it aborts the load and rolls everything back.
+    """
+    if mode not in INGEST_MODES:
+        raise ValueError(f"mode must be one of {INGEST_MODES}")
+    keys = list(keys or [])
+    if mode == "upsert" and not keys:
+        raise ValueError("upsert needs key columns")
+    t0 = time.perf_counter()
+    staging = staging_name(physical)
+    try:
+        size = os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        size = None
+    schema: List[Tuple[str, str]] = []
+    rows = chunks = 0
+
+    with get_engine().begin() as conn:
+        raw = conn.connection.driver_connection
+        # merging into an existing table: its column types are fixed, not inferred
+        target = dict(_table_types(conn, physical)) if mode != "replace" else {}
+        mark = time.perf_counter()
+        for chunk in pd.read_csv(fileobj, chunksize=chunk_rows):
+            if not schema and target:
+                extra = [c for c in chunk.columns if c not in target]
+                if extra:
+                    raise ValueError(f"columns not in the existing table: {', '.join(map(str, extra))}")
+                schema = [(c, target[c]) for c in chunk.columns]
+                _create_staging(conn, staging, schema)
+            chunk = infer_dates(chunk, schema)
+            observe("ingest_parse", time.perf_counter() - mark)
+            if not schema:
+                if chunk.columns.empty:
+                    break
+                schema = [(c, _pg_type(chunk[c])) for c in chunk.columns]
+                _create_staging(conn, staging, schema)
+            # an existing table's types are never widened: COPY rejects what does not fit them
+            for i, (col, pg) in enumerate([] if target else schema):
+                while not _fits(chunk[col], pg):
+                    # dates that stopped parsing go straight to text
+                    pg = "TEXT" if pg in _DATETIME_TYPES and _is_text(chunk[col]) else _WIDER[pg]
+                    conn.execute(text(
+                        f"ALTER TABLE {_qi(staging)} ALTER COLUMN {_qi(col)} TYPE {pg} USING {_qi(col)}::{pg.lower()}"
+                    ))
+                schema[i] = (col, pg)
+            if chunk.empty:
+                continue
+            with timed("ingest_load"):
+                try:
+                    _copy_frame(raw, staging, _conform(chunk, schema))
+                except pg_errors.DataError as e:
+                    raise _copy_rejected(e) from e
+            rows += len(chunk)
+            chunks += 1
+            if on_chunk:
+                on_chunk(rows, _fraction_read(fileobj, size))
+            mark = time.perf_counter()
+
+        if rows == 0:
+            raise ValueError("CSV is empty.")
+        merged = None
+        if mode != "replace" and _exists(conn, physical):
+            with timed("ingest_merge"):
+                merged = _merge(conn, physical, staging, schema, mode, keys)
+            roles = merged["roles"]
+            generation = merged["generation"] or get_generation(conn, physical)  # None: nothing changed
+        else:
+            # index and analyze while readers still see the old table
+            with timed("ingest_publish"):
+                roles = prepare_table(conn, staging)
+                conn.execute(text(f"DROP TABLE IF EXISTS {_qi(physical)}"))
+                conn.execute(text(f"ALTER TABLE {_qi(staging)} RENAME TO {_qi(physical)}"))
+                for role in INDEXED_ROLES:
+                    if roles[role]:
+                        conn.execute(text(f"ALTER INDEX {_qi(derived_name(staging, f'__{role}_idx'))} "
+                                          f"RENAME TO {_qi(derived_name(physical, f'__{role}_idx'))}"))
+                generation = publish_table(conn, physical, roles, rows)
+
+    secs = time.perf_counter() - t0
+    return {
+        "rows": rows,
+        "columns": [c for c, _ in schema],
+        "column_types": dict(schema),
+        "roles": {k: roles.get(k) for k in ("date", "product", "qty", "price", "categorical")},
+        "chunks": chunks,
+        "mode": mode,
+        "created": merged is None and mode != "replace",  # append/upsert into a table that did not exist
+        "inserted": merged["inserted"] if merged else rows,
+        "updated": merged["updated"] if merged else 0,
+        "skipped": rows - merged["inserted"] - merged["updated"] if merged else 0,
+        "generation": generation,
+        "seconds": round(secs, 3),
+        "rows_per_sec": round(rows / secs, 1) if secs > 0 else None,
+    }
@@ -0,0 +1,494 @@
+﻿import json
+import os
+import re
+import shutil
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process guard
+    fcntl = None
+
+# In-process vector store with the same surface as services.vectorstore.
+# On disk, per index directory:
+#   index.json    {"dim", "metric", "capacity", "quantization"}
+#   vectors.f32   float32 [capacity, dim] matrix, memory-mapped (rows are unit-normalized for cosine)
+#   vectors.f16 / vectors.i8 + scales.f32
+#                 quantized copy that searches scan instead (LOCAL_VECTOR_QUANT); the float32
+#                 rows are then only read to rescore each query's best candidates. The copy
+#                 costs extra disk; what shrinks is the working set searches keep in the page
+#                 cache (1/2 or ~1/4 of float32). int8 also scans faster than float32; float16
+#                 scans slower (numpy widens half floats slowly), so it only pays off when the
+#                 float32 rows would not stay cached. python -m benchmarks.run --scenarios search
+#   items.jsonl   append-only log of puts/deletes (id, row, metadata), replayed on open; a torn
+#                 last line is cut off, and the log is rewritten as one put per live row whenever
+#                 the index is rebuilt from it (on open, and when it is partitioned)
+#   lock          held (flock) while the index is open. Rows are handed out from one process's
+#                 view of the log, so an index is single-process: a second process opening it
+#                 gets a RuntimeError. Run one API worker with it, or use Pinecone.
+# Namespaces other than the default are indexes of their own under namespaces/<name>/,
+# so dropping one is removing a directory.
+
+LOCAL_DIR = os.getenv("LOCAL_VECTOR_DIR", "/tmp/caffeinate-vectors")
+BLOCK_ROWS = int(os.getenv("LOCAL_VECTOR_BLOCK_ROWS", "65536"))     # rows scored per matmul
+IVF_MIN_VECTORS = int(os.getenv("LOCAL_VECTOR_IVF_MIN", "100000"))  # partition indexes at least this big
+IVF_NPROBE = int(os.getenv("LOCAL_VECTOR_NPROBE", "8"))
+QUANTIZATION = os.getenv("LOCAL_VECTOR_QUANT", "none").lower()  # none | float16 | int8
+RESCORE_FACTOR = int(os.getenv("LOCAL_VECTOR_RESCORE", "4"))      # candidates rescored per result wanted
+WIDEN_ROWS = int(os.getenv("LOCAL_VECTOR_WIDEN_ROWS", "256"))      # quantized rows converted to float32 at a time
+QUANTIZATIONS = ("none", "float16", "int8")
+
+def _matches(md: Dict, flt: Dict) -> bool:
+    # the subset of Pinecone's filter language we use: {"f": v}, {"f": {"$eq"|"$ne"|"$in"|"$nin": ...}}
+    for field, cond in flt.items():
+        v = md.get(field)
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, arg in cond.items():
+            if op == "$eq" and v != arg:
+                return False
+            if op == "$ne" and v == arg:
+                return False
+            if op == "$in" and v not in arg:
+                return False
+            if op == "$nin" and v in arg:
+                return False
+    return True
+
+def _table_values(flt: Optional[Dict]) -> Optional[List[str]]:
+    # {"table": x} / {"table": {"$eq": x}} / {"table": {"$in": [...]}} can use the per-row table codes
+    if not flt or set(flt) != {"table"}:
+        return None
+    cond = flt["table"]
+    if not isinstance(cond, dict):
+        return [cond]
+    if set(cond) == {"$eq"}:
+        return [cond["$eq"]]
+    if set(cond) == {"$in"}:
+        return list(cond["$in"])
+    return None
+
+class LocalIndex:
+    def __init__(self, path: str, dim: int, metric: str = "cosine", quantization: str = QUANTIZATION):
+        if metric not in ("cosine", "dotproduct"):
+            raise ValueError(f"unsupported metric {metric!r} for the local vector store")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}")
+        self.path, self.dim, self.metric = path, int(dim), metric
+        self._lock = threading.RLock()
+        self._rows: Dict[str, int] = {}   # id -> row
+        self._ids: List[Optional[str]] = []
+        self._meta: List[Optional[Dict]] = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._tables: Dict[str, int] = {}  # metadata["table"] -> code
+        self._table_code = np.zeros(0, dtype=np.int32)
+        self._ivf: Optional[Dict[str, Any]] = None
+        self._logged = 0  # entries in items.jsonl
+        self._log = None
+        os.makedirs(path, exist_ok=True)
+        self._lockf = self._acquire()
+        cfg = os.path.join(path, "index.json")
+        if os.path.exists(cfg):
+            with open(cfg) as f:
+                c = json.load(f)
+            self.dim, self.metric, self._capacity = c["dim"], c["metric"], c["capacity"]
+            stored = c.get("quantization", "none")
+        else:
+            self._capacity = 0
+            stored = quantization
+        self.quantization = quantization
+        self._vecs = self._map(self._capacity)
+        self._qvecs, self._scales = self._map_quantized(self._capacity)
+        self._replay()
+        if stored != quantization:
+            self._requantize()  # setting changed since the index was written
+        self._write_cfg()
+        if self._logged > len(self._rows):
+            self._compact()
+        else:
+            self._log = open(os.path.join(path, "items.jsonl"), "a", encoding="utf-8")
+
+    # ---- storage ----
+    def _acquire(self):
+        f = open(os.path.join(self.path, "lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                raise RuntimeError(f"local index {self.path} is open in another process; "
+                                   "the local vector store is single-process") from None
+        return f
+
+    def _write_cfg(self):
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump({"dim": self.dim, "metric": self.metric, "capacity": self._capacity,
+                       "quantization": self.quantization}, f)
+
+    def _map(self, capacity: int, fname: str = "vectors.f32", dtype=np.float32, width: int | None = None) -> np.ndarray:
+        fn = os.path.join(self.path, fname)
+        shape = (capacity, self.dim if width is None else width)
+        size = capacity * shape[1] * np.dtype(dtype).itemsize
+        with open(fn, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        if capacity == 0:
+            return np.zeros((0, shape[1]), dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode="r+", shape=shape)
+
+    def _map_quantized(self, capacity: int):
+        if self.quantization == "float16":
+            return self._map(capacity, "vectors.f16", np.float16), None
+        if self.quantization == "int8":
+            return self._map(capacity, "vectors.i8", np.int8), self._map(capacity, "scales.f32", np.float32, 1)[:, 0]
+        return None, None
+
+    def _quantize(self, rows, mat: np.ndarray):
+        if self.quantization == "float16":
+            self._qvecs[rows] = mat.astype(np.float16)
+        elif self.quantization == "int8":
+            # symmetric per-row scale: the largest component maps to +-127
+            scale = np.abs(mat).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            self._qvecs[rows] = np.rint(mat / scale[:, None]).astype(np.int8)
+            self._scales[rows] = scale
+
+    def _requantize(self):
+        keep = {"float16": {"vectors.f16"}, "int8": {"vectors.i8", "scales.f32"}}.get(self.quantization, set())
+        for fn in {"vectors.f16", "vectors.i8", "scales.f32"} - keep:
+            if os.path.exists(os.path.join(self.path, fn)):
+                os.remove(os.path.join(self.path, fn))
+        for s in range(0, self._capacity, BLOCK_ROWS):
+            rows = np.arange(s, min(s + BLOCK_ROWS, self._capacity))
+            self._quantize(rows, np.asarray(self._vecs[rows]))
+        self._flush()
+
+    def _flush(self):
+        for m in (self._vecs, self._qvecs, self._scales):
+            if isinstance(m, np.memmap):
+                m.flush()
+        if self._scales is not None and isinstance(self._scales.base, np.memmap):
+            self._scales.base.flush()
+
+    def _grow(self, need: int):
+        if need <= self._capacity:
+            return
+        cap = max(need, self._capacity * 2, 1024)
+        self._flush()
+        self._vecs = self._map(cap)
+        self._qvecs, self._scales = self._map_quantized(cap)
+        self._capacity = cap
+        self._write_cfg()
+        extra = cap - len(self._alive)
+        self._alive = np.concatenate([self._alive, np.zeros(extra, dtype=bool)])
+        self._table_code = np.concatenate([self._table_code, np.full(extra, -1, dtype=np.int32)])
+
+    def _replay(self):
+        self._alive = np.zeros(self._capacity, dtype=bool)
+        self._table_code = np.full(self._capacity, -1, dtype=np.int32)
+        fn = os.path.join(self.path, "items.jsonl")
+        if not os.path.exists(fn):
+            return
+        good = 0  # bytes up to the end of the last whole entry
+        with open(fn, "rb") as f:
+            for line in f:
+                try:
+                    e = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    e = None
+                if e is None:
+                    break  # torn last write
+                if e["op"] == "put":
+                    self._set_row(e["row"], e["id"], e["metadata"])
+                else:
+                    self._clear_row(e["id"])
+                good += len(line)
+                self._logged += 1
+        if good < os.path.getsize(fn):
+            # cut the torn tail off, or the next entry would be appended to the same line and lost with it
+            with open(fn, "r+b") as f:
+                f.truncate(good)
+
+    def _compact(self):
+        # one put per live row; deletes and overwritten puts are dropped
+        fn = os.path.join(self.path, "items.jsonl")
+        with open(fn + ".tmp", "w", encoding="utf-8") as f:
+            for row, vid in enumerate(self._ids):
+                if vid is not None:
+                    f.write(json.dumps({"op": "put", "id": vid, "row": row, "metadata": self._meta[row]}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._log is not None:
+            self._log.close()
+        os.replace(fn + ".tmp", fn)
+        self._logged = len(self._rows)
+        self._log = open(fn, "a", encoding="utf-8")
+
+    def _set_row(self, row: int, vid: str, md: Dict):
+        while len(self._ids) <= row:
+            self._ids.append(None)
+            self._meta.append(None)
+        self._rows[vid] = row
+        self._ids[row], self._meta[row] = vid, md
+        self._alive[row] = True
+        t = md.get("table")
+        self._table_code[row] = self._tables.setdefault(t, len(self._tables)) if t is not None else -1
+
+    def _clear_row(self, vid: str) -> bool:
+        row = self._rows.pop(vid, None)
+        if row is None:
+            return False
+        self._ids[row], self._meta[row] = None, None
+        self._alive[row] = False
+        return True
+
+    # ---- API ----
+    def upsert(self, items: Iterable[Dict]):
+        items = list(items)
+        if not items:
+            return
+        mat = np.asarray([it["values"] for it in items], dtype=np.float32)
+        if mat.shape[1] != self.dim:
+            raise ValueError(f"vector dimension {mat.shape[1]} does not match index dimension {self.dim}")
+        if self.metric == "cosine":
+            norms = np.linalg.norm(mat, axis=1, keepdims=True)
+            mat /= np.where(norms == 0, 1, norms)
+        with self._lock:
+            rows, fresh = [], {}
+            nxt = len(self._ids)
+            for it in items:
+                row = self._rows.get(it["id"], fresh.get(it["id"]))
+                if row is None:
+                    row = fresh[it["id"]] = nxt
+                    nxt += 1
+                rows.append(row)
+            self._grow(nxt)
+            self._vecs[rows] = mat
+            if self.quantization != "none":
+                self._quantize(rows, mat)
+            self._flush()
+            for it, row in zip(items, rows):
+                md = it.get("metadata") or {}
+                self._set_row(row, it["id"], md)
+                self._log.write(json.dumps({"op": "put", "id": it["id"], "row": row, "metadata": md}) + "\n")
+            self._logged += len(items)
+            self._log.flush()
+            if self._ivf is not None:
+                self._ivf_assign(np.asarray(rows))
+
+    def delete(self, ids: Iterable[str]):
+        with self._lock:
+            for vid in ids:
+                if self._clear_row(vid):
+                    self._log.write(json.dumps({"op": "del", "id": vid}) + "\n")
+                    self._logged += 1
+            self._log.flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._log.close()
+            self._lockf.close()  # releases the flock
+
+    def count(self) -> int:
+        return len(self._rows)
+
+    def _candidate_mask(self, flt: Optional[Dict], n: int) -> np.ndarray:
+        mask = self._alive[:n].copy()
+        tables = _table_values(flt)
+        if tables is not None:
+            codes = [self._tables[t] for t in tables if t in self._tables]
+            mask &= np.isin(self._table_code[:n], codes)
+        elif flt:
+            for row in np.flatnonzero(mask):
+                if not _matches(self._meta[row], flt):
+                    mask[row] = False
+        return mask
+
+    def query_batch(self, queries: np.ndarray, top_k: int = 8, filter: Optional[Dict] = None) -> List[Dict]:
+        """
+        Top-k for a batch of query vectors: one matrix multiplication per
+        block of stored rows, keeping a running top-k per query. Large
+        indexes only score the rows in the IVF lists nearest to each query;
+        a filter that leaves few rows (one table of many) scans those
+        exactly, as does a probe that finds fewer than top_k of them.
+        """
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.metric == "cosine":
+            norms = np.linalg.norm(q, axis=1, keepdims=True)
+            q = q / np.where(norms == 0, 1, norms)
+        with self._lock:
+            n = len(self._ids)  # row slots, deleted ones included
+            live = int(self._alive[:n].sum())
+            if live == 0:
+                return [{"matches": []} for _ in range(len(q))]
+            if live >= IVF_MIN_VECTORS and self._ivf is None:
+                self._ivf_build(n)
+            mask = self._candidate_mask(filter, n)
+            if self._ivf is None or mask.sum() < IVF_MIN_VECTORS:
+                results = self._topk(q, np.flatnonzero(mask), top_k)
+            else:
+                results = []
+                for i in range(len(q)):
+                    rows = np.flatnonzero(mask & self._ivf_probe(q[i], n))
+                    if len(rows) < top_k:
+                        rows = np.flatnonzero(mask)
+                    results.append(self._topk(q[i:i + 1], rows, top_k)[0])
+            return [
+                {"matches": [{"id": self._ids[r], "score": float(s), "metadata": self._meta[r]} for r, s in res]}
+                for res in results
+            ]
+
+    def _block_scores(self, q: np.ndarray, blk: np.ndarray) -> np.ndarray:
+        # contiguous rows (no filter, or a table loaded in one go) are sliced as a view, not gathered
+        lo, hi = int(blk[0]), int(blk[-1]) + 1
+        rows = slice(lo, hi) if hi - lo == len(blk) else blk
+        if self.quantization == "none":
+            return q @ self._vecs[rows].T
+        # BLAS has no int8/float16 kernels: widen a few rows at a time into a buffer that stays in cache
+        mat = self._qvecs[rows]
+        scores = np.empty((len(q), len(blk)), dtype=np.float32)
+        buf = np.empty((min(WIDEN_ROWS, len(blk)), self.dim), dtype=np.float32)
+        for s in range(0, len(blk), WIDEN_ROWS):
+            part = mat[s:s + WIDEN_ROWS]
+            wide = buf[:len(part)]
+            np.copyto(wide, part, casting="unsafe")
+            scores[:, s:s + len(part)] = q @ wide.T
+        if self.quantization == "int8":
+            scores *= self._scales[rows]
+        return scores
+
+    def _topk(self, q: np.ndarray, rows: np.ndarray, k: int) -> List[List]:
+        depth = k if self.quantization == "none" else k * RESCORE_FACTOR
+        best_s = np.full((len(q), 0), -np.inf, dtype=np.float32)
+        best_r = np.zeros((len(q), 0), dtype=np.int64)
+        for s in range(0, len(rows), BLOCK_ROWS):
+            blk = rows[s:s + BLOCK_ROWS]
+            scores = self._block_scores(q, blk)
+            best_s = np.concatenate([best_s, scores], axis=1)
+            best_r = np.concatenate([best_r, np.broadcast_to(blk, scores.shape)], axis=1)
+            if best_s.shape[1] > depth:
+                keep = np.argpartition(-best_s, depth - 1, axis=1)[:, :depth]
+                best_s = np.take_along_axis(best_s, keep, axis=1)
+                best_r = np.take_along_axis(best_r, keep, axis=1)
+        if self.quantization != "none" and best_r.shape[1]:
+            # exact float32 scores for the shortlisted rows decide the final order
+            best_s = np.stack([self._vecs[best_r[i]] @ q[i] for i in range(len(q))])
+        order = np.argsort(-best_s, axis=1)[:, :k]
+        return [list(zip(np.take_along_axis(best_r, order, 1)[i], np.take_along_axis(best_s, order, 1)[i]))
+                for i in range(len(q))]
+
+    def memory_bytes(self) -> Dict[str, int]:
+        # bytes a search scans vs the full-precision rows kept for rescoring
+        n = len(self._ids)
+        full = n * self.dim * 4
+        if self.quantization == "none":
+            return {"scanned": full, "full_precision": full}
+        scanned = n * self.dim * (2 if self.quantization == "float16" else 1)
+        return {"scanned": scanned + (n * 4 if self.quantization == "int8" else 0), "full_precision": full}
+
+    # ---- IVF partitioning ----
+    def _ivf_build(self, n: int, iters: int = 10):
+        rows = np.flatnonzero(self._alive[:n])
+        nlist = max(1, int(np.sqrt(len(rows))))
+        rng = np.random.default_rng(0)
+        sample = rows if len(rows) <= nlist * 64 else rng.choice(rows, nlist * 64, replace=False)
+        data = np.asarray(self._vecs[np.sort(sample)])
+        cent = data[rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(iters):  # spherical k-means
+            assign = np.argmax(data @ cent.T, axis=1)
+            for c in range(nlist):
+                members = data[assign == c]
+                if len(members):
+                    v = members.sum(axis=0)
+                    cent[c] = v / (np.linalg.norm(v) or 1)
+        self._ivf = {"centroids": cent, "list": np.full(self._capacity, -1, dtype=np.int32)}
+        self._ivf_assign(rows)
+        if self._logged > len(self._rows):
+            self._compact()
+
+    def _ivf_assign(self, rows: np.ndarray):
+        lst = self._ivf["list"]
+        if len(lst) < self._capacity:
+            lst = self._ivf["list"] = np.concatenate([lst, np.full(self._capacity - len(lst), -1, dtype=np.int32)])
+        for s in range(0, len(rows), BLOCK_ROWS):
+            blk = rows[s:s + BLOCK_ROWS]
+            lst[blk] = np.argmax(self._vecs[blk] @ self._ivf["centroids"].T, axis=1)
+
+    def _ivf_probe(self, q: np.ndarray, n: int) -> np.ndarray:
+        cent = self._ivf["centroids"]
+        probe = np.argsort(-(cent @ q))[:IVF_NPROBE]
+        return np.isin(self._ivf["list"][:n], probe)
+
+_indexes: Dict[tuple, LocalIndex] = {}  # (index name, namespace) -> index
+_lock = threading.Lock()
+
+def _path(name: str, namespace: str = "") -> str:
+    root = os.path.join(LOCAL_DIR, name)
+    if not namespace:
+        return root
+    if not re.fullmatch(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*", namespace):
+        raise ValueError(f"invalid namespace {namespace!r} for the local vector store")
+    return os.path.join(root, "namespaces", namespace)
+
+def _exists(name: str, namespace: str = "") -> bool:
+    return (name, namespace) in _indexes or os.path.exists(os.path.join(_path(name, namespace), "index.json"))
+
+def _open(name: str, dim: Optional[int], metric: str, quantization: str, namespace: str) -> LocalIndex:
+    idx = _indexes.get((name, namespace))
+    if idx is None:
+        path = _path(name, namespace)
+        if not os.path.exists(os.path.join(path, "index.json")):
+            if namespace:
+                # a namespace is created on first write, with the settings of its index
+                root = _open(name, dim, metric, quantization, "")
+                dim, metric = root.dim, root.metric
+            elif dim is None:
+                raise KeyError(f"local index {name!r} does not exist; call ensure_index first")
+        idx = _indexes[(name, namespace)] = LocalIndex(path, dim or 0, metric, quantization)
+    return idx
+
+def get_index(name: str, dim: Optional[int] = None, metric: str = "cosine",
+              quantization: str = QUANTIZATION, namespace: str = "") -> LocalIndex:
+    with _lock:
+        return _open(name, dim, metric, quantization, namespace)
+
+def ensure_index(name: str, dim: int = 768, metric: str = "cosine", quantization: str = QUANTIZATION):
+    get_index(name, dim, metric, quantization)
+
+def upsert_vectors(name: str, items: Iterable[Dict], namespace: str = ""):
+    get_index(name, namespace=namespace).upsert(items)
+
+def query_vectors(name: str, vector: List[float], top_k: int = 8, filter: Dict | None = None,
+                  namespace: str = "") -> Dict:
+    if namespace and not _exists(name, namespace):
+        return {"matches": []}  # nothing indexed for it yet
+    return get_index(name, namespace=namespace).query_batch(np.asarray([vector]), top_k=top_k, filter=filter)[0]
+
+def delete_vectors(name: str, ids: List[str], namespace: str = ""):
+    if namespace and not _exists(name, namespace):
+        return
+    get_index(name, namespace=namespace).delete(ids)
+
+def delete_namespace(name: str, namespace: str = ""):
+    if not namespace:
+        idx = get_index(name)
+        idx.delete([i for i in list(idx._ids) if i is not None])
+        return
+    with _lock:
+        idx = _indexes.pop((name, namespace), None)
+        if idx is not None:
+            idx.close()
+        shutil.rmtree(_path(name, namespace), ignore_errors=True)
+
+def namespace_counts(name: str) -> Dict[str, int]:
+    root = _path(name)
+    if not _exists(name):
+        return {}
+    out = {"": get_index(name).count()}
+    ns_dir = os.path.join(root, "namespaces")
+    for ns in sorted(os.listdir(ns_dir)) if os.path.isdir(ns_dir) else []:
+        if _exists(name, ns):
+            out[ns] = get_index(name, namespace=ns).count()
+    return {ns: n for ns, n in out.items() if n or ns}
@@ -1,7 +1,10 @@
-﻿import os, re
-from typing import Dict, List, Any
+﻿import asyncio
+import os, re, threading
+from typing import AsyncIterator, Dict, List, Any
 from services.embeddings import get_embedder
-from services.vectorstore import query_vectors
+from services.vectorstore import query_vectors, namespace_for
+from services.answer_cache import answer_cache, table_generations, ENABLED as CACHE_ENABLED
+from services.telemetry import timed
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-1.5-flash")
@@ -21,39 +24,50 @@ def _build_context(matches: List[Dict[str, Any]]) -> str:
         total += len(line)
     return "\n".join(buf) if buf else "(no context found)"
 
-def answer_with_rag(question: str, table: str | None = None) -> Dict:
-    # 1) embed the query
-    embedder = get_embedder()
-    qvec = embedder.embed_query(question)
+_chat: ChatGoogleGenerativeAI | None = None
+_chat_lock = threading.Lock()
 
-    # 2) retrieve from Pinecone
-    flt = {"table": {"$eq": table}} if table else None
-    res = query_vectors(qvec, top_k=TOP_K, filter=flt)
-    matches = getattr(res, "matches", None) or res.get("matches", [])
-
-    # 3) build context
-    context = _build_context(matches)
+def _llm() -> ChatGoogleGenerativeAI:
+    # one chat client per process: it is thread-safe and keeps its connections open
+    global _chat
+    if _chat is None:
+        with _chat_lock:
+            if _chat is None:
+                _chat = ChatGoogleGenerativeAI(
+                    model=GEMINI_MODEL,
+                    temperature=0.2,
+                    google_api_key=os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+                )
+    return _chat
 
-    # 4) ask Gemini for a natural sentence
-    llm = ChatGoogleGenerativeAI(
-        model=GEMINI_MODEL,
-        temperature=0.2,
-        google_api_key=os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-    )
-    prompt = (
+def _prompt(context: str, question: str) -> str:
+    return (
         "You are a precise data analyst. Use only the provided context (facts extracted from a business dataset). "
         "Respond with ONE short, natural sentence. Include units/currency if relevant. "
         "If the context is insufficient, say so clearly.\n\n"
         f"Context:\n{context}\n\nQuestion: {question}\nAnswer (one short sentence):"
     )
-    resp = llm.invoke(prompt)
-    answer_text = getattr(resp, "content", None) or str(resp)
-    ans = str(answer_text).strip()
 
+def _matches_of(res) -> List:
+    return getattr(res, "matches", None) or res.get("matches", [])
+
+def _finish(answer_text) -> str:
+    ans = str(answer_text).strip()
     # If the model returned just a bare number, wrap it in a sentence
     if re.fullmatch(r"[-+]?\d+(\.\d+)?", ans):
         ans = f"The total is {ans}."
+    return ans
+
+def _public_matches(matches: List) -> List[Dict]:
+    return [
+        {
+            "id": getattr(m, "id", None) or (m.get("id") if isinstance(m, dict) else None),
+            "score": getattr(m, "score", None) or (m.get("score") if isinstance(m, dict) else None),
+            "metadata": getattr(m, "metadata", None) or (m.get("metadata") if isinstance(m, dict) else {})
+        } for m in matches[:3]
+    ]
 
+def _result(table: str | None, context: str, matches: List, ans: str) -> Dict:
     return {
         "status": "ok",
         "model": GEMINI_MODEL,
@@ -61,11 +75,106 @@ def answer_with_rag(question: str, table: str | None = None) -> Dict:
         "table": table,
         "answer": ans,
         "used_context_chars": min(len(context), MAX_CONTEXT_CHARS),
-        "matches": [
-            {
-                "id": getattr(m, "id", None) or (m.get("id") if isinstance(m, dict) else None),
-                "score": getattr(m, "score", None) or (m.get("score") if isinstance(m, dict) else None),
-                "metadata": getattr(m, "metadata", None) or (m.get("metadata") if isinstance(m, dict) else {})
-            } for m in matches[:3]
-        ]
+        "matches": _public_matches(matches),
     }
+
+def _generations(table: str | None):
+    if not (CACHE_ENABLED and table):
+        return None
+    try:
+        return table_generations(table)
+    except Exception:
+        return None  # the answer cache is best-effort
+
+def _cache_info(hit: bool, similarity: float | None = None, question: str | None = None) -> Dict:
+    s = answer_cache.stats()
+    return {"hit": hit, "similarity": round(similarity, 4) if similarity is not None else None,
+            "matched_question": question, "hits": s["hits"], "misses": s["misses"], "hit_rate": s["hit_rate"]}
+
+def _from_cache(table: str | None, gens, qvec) -> Dict | None:
+    if gens is None:
+        return None
+    hit = answer_cache.lookup(table, gens, qvec)
+    if hit is None:
+        return None
+    result, sim, prior = hit
+    return {**result, "answer_cache": _cache_info(True, sim, prior)}
+
+def _remember(table: str | None, gens, qvec, question: str, result: Dict) -> Dict:
+    if gens is not None:
+        answer_cache.put(table, gens, qvec, question, result)
+    return {**result, "answer_cache": _cache_info(False)}
+
+def answer_with_rag(question: str, table: str | None = None) -> Dict:
+    # 1) embed the query, and reuse the answer to a near-identical earlier question
+    embedder = get_embedder()
+    with timed("embed"):
+        qvec = embedder.embed_query(question)
+    gens = _generations(table)
+    cached = _from_cache(table, gens, qvec)
+    if cached:
+        return cached
+
+    # 2) retrieve from the table's namespace
+    with timed("vector_query"):
+        matches = _matches_of(query_vectors(qvec, top_k=TOP_K, namespace=namespace_for(table)))
+
+    # 3) build context
+    context = _build_context(matches)
+
+    # 4) ask Gemini for a natural sentence
+    with timed("llm"):
+        resp = _llm().invoke(_prompt(context, question))
+    answer_text = getattr(resp, "content", None) or str(resp)
+    return _remember(table, gens, qvec, question, _result(table, context, matches, _finish(answer_text)))
+
+async def _aembed(question: str, table: str | None):
+    with timed("embed"):
+        qvec = await get_embedder().aembed_query(question)
+    gens = await asyncio.to_thread(_generations, table)
+    return qvec, gens
+
+async def _aretrieve(qvec, table: str | None):
+    # the vector store clients are synchronous; keep them off the event loop
+    with timed("vector_query"):
+        res = await asyncio.to_thread(query_vectors, qvec, top_k=TOP_K, namespace=namespace_for(table))
+    matches = _matches_of(res)
+    return matches, _build_context(matches)
+
+async def aanswer_with_rag(question: str, table: str | None = None) -> Dict:
+    qvec, gens = await _aembed(question, table)
+    cached = _from_cache(table, gens, qvec)
+    if cached:
+        return cached
+    matches, context = await _aretrieve(qvec, table)
+    with timed("llm"):
+        resp = await _llm().ainvoke(_prompt(context, question))
+    answer_text = getattr(resp, "content", None) or str(resp)
+    return _remember(table, gens, qvec, question, _result(table, context, matches, _finish(answer_text)))
+
+async def astream_answer(question: str, table: str | None = None) -> AsyncIterator[Dict]:
+    """
+    Yields {"event", "data"} dicts: "context" once retrieval is done, one
+    "token" per streamed LLM chunk, then "done" with the full /ask payload.
+    A cached answer arrives as a single token.
+    """
+    qvec, gens = await _aembed(question, table)
+    cached = _from_cache(table, gens, qvec)
+    if cached:
+        yield {"event": "context", "data": {"table": table, "matches": cached["matches"],
+                                            "used_context_chars": cached["used_context_chars"]}}
+        yield {"event": "token", "data": cached["answer"]}
+        yield {"event": "done", "data": cached}
+        return
+    matches, context = await _aretrieve(qvec, table)
+    yield {"event": "context", "data": {"table": table, "matches": _public_matches(matches),
+                                        "used_context_chars": min(len(context), MAX_CONTEXT_CHARS)}}
+    parts: List[str] = []
+    with timed("llm"):
+        async for chunk in _llm().astream(_prompt(context, question)):
+            tok = getattr(chunk, "content", None) or ""
+            if tok:
+                parts.append(tok)
+                yield {"event": "token", "data": tok}
+    result = _result(table, context, matches, _finish("".join(parts)))
+    yield {"event": "done", "data": _remember(table, gens, qvec, question, result)}
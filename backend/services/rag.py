@@ -1,23 +1,116 @@
-﻿import os
-from typing import Dict
+﻿import asyncio
+import importlib
+import os
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+# aggregate questions go to SQL first (services.sql_answer); everything else to RAG
+STRUCTURED = os.getenv("STRUCTURED_QA", "on").lower() != "off"
+# build the RAG clients at startup instead of on the first question
+WARMUP = os.getenv("RAG_WARMUP", "off").lower() in ("1", "on", "true", "yes")
+
+_warmup: Dict = {"status": "not run"}
+
+def _required_keys() -> List[str]:
+    # the local vector store needs no Pinecone credentials
+    if os.getenv("VECTOR_BACKEND", "pinecone").lower() == "local":
+        return ["GEMINI_API_KEY"]
+    return ["GEMINI_API_KEY", "PINECONE_API_KEY"]  # the index name is derived (vectorstore.index_name)
 
 def rag_config_ok() -> bool:
-    need = ["GEMINI_API_KEY", "PINECONE_API_KEY", "PINECONE_INDEX"]
-    return all(os.getenv(k) for k in need)
+    return all(os.getenv(k) for k in _required_keys())
+
+def _not_configured(question: str, table: str | None) -> Dict:
+    return {
+        "status": "todo",
+        "message": "RAG not configured yet",
+        "missing": {k: bool(os.getenv(k)) for k in _required_keys()},
+        "echo": {"question": question, "table": table}
+    }
+
+def warmup() -> Dict:
+    """
+    Imports services.qa (LangChain, the Gemini SDK), builds the shared
+    embedder and chat clients and pings the vector index, so the first
+    question after a deploy pays none of it. Failed steps are reported,
+    not raised: the app still starts and retries lazily.
+    """
+    global _warmup
+    if not rag_config_ok():
+        _warmup = {"status": "skipped", "missing": [k for k in _required_keys() if not os.getenv(k)]}
+        return _warmup
+    steps: Dict[str, Dict] = {}
+
+    def step(name: str, fn: Callable):
+        t0 = time.perf_counter()
+        try:
+            out = fn()
+            steps[name] = {"ms": round((time.perf_counter() - t0) * 1000, 1)}
+            if isinstance(out, int):
+                steps[name]["vectors"] = out
+        except Exception as e:
+            steps[name] = {"error": str(e)}
+
+    step("import", lambda: importlib.import_module("services.qa"))
+    from services import embeddings, qa, vectorstore
+    step("embedder", embeddings.get_embedder)
+    step("llm", qa._llm)
+    step("index", vectorstore.ping)
+    ok = all("error" not in s for s in steps.values())
+    _warmup = {"status": "ok" if ok else "degraded", "steps": steps}
+    return _warmup
+
+def warmup_status() -> Dict:
+    return _warmup
+
+def _structured(question: str, table: str | None) -> Optional[Dict]:
+    # needs a table to aggregate over; works without any RAG keys
+    if not (STRUCTURED and table):
+        return None
+    from sqlalchemy.exc import DataError, OperationalError, ProgrammingError
+    from services.sql_answer import answer_with_sql
+    try:
+        return answer_with_sql(question, table)
+    except (ProgrammingError, DataError):
+        return None  # the table is gone or a column does not cast: let RAG try
+    except OperationalError as e:
+        if getattr(e.orig, "pgcode", None) == "57014":
+            return None  # statement_timeout
+        raise
+
+def _rag(result: Dict) -> Dict:
+    return {**result, "route": "rag"} if result.get("status") == "ok" else result
 
 def answer_question(question: str, table: str | None = None) -> Dict:
+    structured = _structured(question, table)
+    if structured:
+        return structured
     # If keys missing, return a friendly TODO
     if not rag_config_ok():
-        return {
-            "status": "todo",
-            "message": "RAG not configured yet",
-            "missing": {
-                "GEMINI_API_KEY": bool(os.getenv("GEMINI_API_KEY")),
-                "PINECONE_API_KEY": bool(os.getenv("PINECONE_API_KEY")),
-                "PINECONE_INDEX":  bool(os.getenv("PINECONE_INDEX")),
-            },
-            "echo": {"question": question, "table": table}
-        }
+        return _not_configured(question, table)
     # Lazy import the heavy bits to avoid startup errors
     from services.qa import answer_with_rag
-    return answer_with_rag(question, table)
+    return _rag(answer_with_rag(question, table))
+
+async def aanswer_question(question: str, table: str | None = None) -> Dict:
+    structured = await asyncio.to_thread(_structured, question, table)
+    if structured:
+        return structured
+    if not rag_config_ok():
+        return _not_configured(question, table)
+    from services.qa import aanswer_with_rag
+    return _rag(await aanswer_with_rag(question, table))
+
+async def astream_question(question: str, table: str | None = None) -> AsyncIterator[Dict]:
+    # same events as qa.astream_answer; SQL answers and the unconfigured TODO arrive as one "done"
+    structured = await asyncio.to_thread(_structured, question, table)
+    if structured:
+        yield {"event": "token", "data": structured["answer"]}
+        yield {"event": "done", "data": structured}
+        return
+    if not rag_config_ok():
+        yield {"event": "done", "data": _not_configured(question, table)}
+        return
+    from services.qa import astream_answer
+    async for ev in astream_answer(question, table):
+        yield {**ev, "data": _rag(ev["data"])} if ev["event"] == "done" else ev
@@ -0,0 +1,99 @@
+﻿import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.exc import DataError
+from services.columns import num_expr, date_expr
+
+# Pre-aggregated companions of an ingested table:
+#   <table>__by_day      d, ct, qty, revenue      (week/month are rolled up from it at query time)
+#   <table>__by_product  product, ct, qty, revenue
+# qty/revenue are NULL when the table has no qty/price column. A rollup whose
+# casts fail (text in qty/price, a date column that is not all dates) is
+# skipped: readers see it missing and query the table itself.
+
+log = logging.getLogger("caffeinate.rollups")
+
+def derived_name(table: str, suffix: str) -> str:
+    name = f"{table}{suffix}"
+    if len(name.encode()) <= 63:
+        return name
+    # Postgres truncates identifiers at 63 bytes; keep long names distinct
+    h = hashlib.md5(table.encode()).hexdigest()[:8]
+    return f"{table[:40]}_{h}{suffix}"
+
+def rollup_tables(table: str) -> Tuple[str, str]:
+    return derived_name(table, "__by_day"), derived_name(table, "__by_product")
+
+def _measures(roles: Dict) -> str:
+    q, p = roles.get("qty"), roles.get("price")
+    qty = f"SUM({num_expr(roles, q)})::numeric" if q else "NULL::numeric"
+    rev = f"SUM({num_expr(roles, q)}*{num_expr(roles, p)})::numeric" if q and p else "NULL::numeric"
+    return f"COUNT(*)::bigint AS ct, {qty} AS qty, {rev} AS revenue"
+
+def _specs(table: str, roles: Dict):
+    day, prod = rollup_tables(table)
+    out = []
+    if roles.get("date"):
+        out.append((day, "d", date_expr(roles, roles["date"])))
+    if roles.get("product"):
+        out.append((prod, "product", f'"{roles["product"]}"'))
+    return out
+
+def build_rollups(conn, table: str, roles: Dict):
+    """
+    (Re)build the rollups of `table` from scratch. Run it in the transaction
+    that (re)creates the table so readers never see mismatched rollups.
+    """
+    day, prod = rollup_tables(table)
+    conn.execute(text(f'DROP TABLE IF EXISTS "{day}", "{prod}"'))
+    for name, key, expr in _specs(table, roles):
+        try:
+            with conn.begin_nested():
+                conn.execute(text(
+                    f'CREATE TABLE "{name}" AS SELECT {expr} AS {key}, {_measures(roles)} '
+                    f'FROM "{table}" GROUP BY 1'
+                ))
+                # NULL keys (rows without a date/product) are a group of their own
+                conn.execute(text(f'CREATE UNIQUE INDEX ON "{name}" ({key}) NULLS NOT DISTINCT'))
+        except DataError as e:
+            log.warning("skipping rollup %s: %s", name, e.orig)
+
+def merge_into_rollups(conn, table: str, roles: Dict, source: str):
+    """
+    Incremental refresh for appends: fold the aggregates of the rows in
+    `source` (same columns as `table`) into the existing rollups. A rollup
+    the new rows do not cast into is dropped.
+    """
+    add = "CASE WHEN r.{c} IS NULL AND EXCLUDED.{c} IS NULL THEN NULL " \
+          "ELSE COALESCE(r.{c}, 0) + COALESCE(EXCLUDED.{c}, 0) END"
+    for name, key, expr in _specs(table, roles):
+        try:
+            with conn.begin_nested():
+                conn.execute(text(
+                    f'INSERT INTO "{name}" AS r SELECT {expr} AS {key}, {_measures(roles)} '
+                    f'FROM "{source}" GROUP BY 1 '
+                    f'ON CONFLICT ({key}) DO UPDATE SET ct = r.ct + EXCLUDED.ct, '
+                    f'qty = {add.format(c="qty")}, revenue = {add.format(c="revenue")}'
+                ))
+        except DataError as e:
+            log.warning("dropping rollup %s: %s", name, e.orig)
+            conn.execute(text(f'DROP TABLE "{name}"'))
+
+def rollups_present(conn, table: str) -> Dict[str, bool]:
+    day, prod = rollup_tables(table)
+    r = conn.execute(
+        text("SELECT to_regclass(:d) IS NOT NULL, to_regclass(:p) IS NOT NULL"),
+        {"d": f'"{day}"', "p": f'"{prod}"'}
+    ).one()
+    return {"day": bool(r[0]), "product": bool(r[1])}
+
+def rollup_totals(conn, table: str, present: Dict[str, bool]) -> Optional[Tuple]:
+    # (row_count, total_qty, total_revenue) summed from whichever rollup exists
+    day, prod = rollup_tables(table)
+    src = day if present.get("day") else prod if present.get("product") else None
+    if not src:
+        return None
+    return tuple(conn.execute(
+        text(f'SELECT COALESCE(SUM(ct), 0), SUM(qty), SUM(revenue) FROM "{src}"')
+    ).one())
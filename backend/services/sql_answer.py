@@ -0,0 +1,417 @@
+﻿import os
+import re
+import time
+import calendar
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import text
+from services.db import get_engine
+from services.cache import get_generation
+from services.analytics import table_schema, sync_schema
+from services.columns import num_expr, date_expr
+from services.rollups import rollup_tables
+
+# Answers aggregate questions ("total revenue in March", "how many lattes
+# last week", "top 3 products") with one read-only SQL query built from
+# rules over the detected column roles. Anything the rules do not cover
+# returns None so the caller can fall back to RAG, or to LLM-written SQL
+# when SQL_LLM=on.
+
+STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "5000"))
+DATE_ANCHOR = os.getenv("SQL_DATE_ANCHOR", "today").lower()  # today | data (latest date in the table)
+LLM_SQL = os.getenv("SQL_LLM", "off").lower() == "on"
+MAX_PRODUCTS = 5000
+MAX_ROWS = 50
+
+_AGG = re.compile(r"\b(total|sum|how many|how much|number of|count|average|avg|mean|revenue|sales|sold|"
+                  r"top|best[- ]selling|most popular|best|highest)\b")
+_TOP = re.compile(r"\b(top|best[- ]selling|most popular|best|highest|most sold|sold the most|sells the most)\b")
+_REVENUE = re.compile(r"\b(revenue|income|earnings|turnover|money|made|make|earn(ed)?|order value|aov|spend|spent)\b|\$")
+_QTY = re.compile(r"\b(quantity|units?|cups?|items?|sold|volume)\b")
+_COUNT = re.compile(r"\b(orders?|transactions?|records?|rows|purchases|receipts?|count)\b")
+_AVG = re.compile(r"\b(average|avg|mean)\b")
+_AVG_PRICE = re.compile(r"\b(average|avg|mean) (unit |selling )?price\b")
+# breakdowns, comparisons and explanations need more than one number: leave them to RAG
+_GROUPED = re.compile(r"\b(per|each|every|compare[ds]?|comparing|comparison|versus|vs|why|trends?|trending|"
+                      r"breakdown|over time)\b")
+_BY = re.compile(r"\bby\s+(?!(?:revenue|sales|quantity|units?|volume|count|number|orders?|cups?|items?)\b)\w+")
+_PER_SALE = re.compile(r"\b(per|each|every)\s+(sale|order|transaction|receipt|purchase)s?\b")
+_WHICH = re.compile(r"\b(?:which|what)\s+(\w+)")
+_WHICH_FILLER = {"is", "was", "are", "were", "did", "does", "do", "had", "has", "have", "of", "the", "our", "my",
+                 "a", "an", "in", "been", "will", "would", "could", "can", "about"}
+_PRODUCT_WORDS = {"product", "products", "item", "items", "drink", "drinks", "sku", "skus", "seller", "sellers"}
+# dimensions the rules cannot group or filter by
+_OTHER_DIMS = re.compile(r"\b(customers?|clients?|stores?|shops?|locations?|branch(es)?|outlets?|regions?|cit(y|ies)|"
+                         r"countr(y|ies)|employees?|staff|cashiers?|baristas?|payments?|categor(y|ies)|channels?|"
+                         r"hours?|weekdays?|weekends?)\b")
+
+_MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_name) if m}
+_MONTHS.update({m.lower(): i for i, m in enumerate(calendar.month_abbr) if m})
+_MONTH_RE = re.compile(r"\b(?:(in|during|for|of|since)\s+)?(" + "|".join(sorted(_MONTHS, key=len, reverse=True))
+                       + r")\.?(?:\s+(\d{4}))?\b")
+_ISO = r"(\d{4}-\d{2}-\d{2})"
+
+_LABELS = {
+    "revenue": "total revenue", "qty": "total quantity sold", "count": "number of sales",
+    "avg_order": "average revenue per sale", "avg_qty": "average quantity per sale", "avg_price": "average unit price",
+}
+
+_PRODUCTS: Dict[str, Tuple[int, List[str]]] = {}  # table -> (generation, distinct product values)
+_LATEST: Dict[str, Tuple[int, Optional[date]]] = {}  # table -> (generation, newest date)
+
+# ---- question parsing ----
+
+def _add_months(d: date, n: int) -> date:
+    m = d.year * 12 + d.month - 1 + n
+    return date(m // 12, m % 12 + 1, 1)
+
+def parse_range(q: str, anchor: date, latest: Optional[date] = None) -> Optional[Tuple[Optional[date], Optional[date], str]]:
+    """
+    (start, end exclusive, label) for the time phrase in `q`, or None. A
+    month without a year is the most recent one up to `latest` (the newest
+    date in the data), or up to `anchor` when that is unknown.
+    """
+    m = re.search(rf"\b(?:between|from)\s+{_ISO}\s+(?:and|to|until)\s+{_ISO}", q)
+    if m:
+        a, b = date.fromisoformat(m.group(1)), date.fromisoformat(m.group(2))
+        return a, b + timedelta(days=1), f"between {a} and {b}"
+    m = re.search(rf"\b(?:since|after)\s+{_ISO}", q)
+    if m:
+        a = date.fromisoformat(m.group(1))
+        return a, None, f"since {a}"
+    m = re.search(_ISO, q)
+    if m:
+        a = date.fromisoformat(m.group(1))
+        return a, a + timedelta(days=1), f"on {a}"
+    if re.search(r"\btoday\b", q):
+        return anchor, anchor + timedelta(days=1), "today"
+    if re.search(r"\byesterday\b", q):
+        return anchor - timedelta(days=1), anchor, "yesterday"
+    m = re.search(r"\b(?:last|past|previous)\s+(\d+)\s+(day|week|month)s?\b", q)
+    if m:
+        n, unit = int(m.group(1)), m.group(2)
+        end = anchor + timedelta(days=1)
+        start = _add_months(anchor, -n + 1) if unit == "month" else end - timedelta(days=n * (7 if unit == "week" else 1))
+        return start, end, f"in the last {n} {unit}{'s' if n != 1 else ''}"
+    m = re.search(r"\b(this|last|past|previous)\s+(week|month|year)\b", q)
+    if m:
+        cur = m.group(1) == "this"
+        if m.group(2) == "week":
+            start = anchor - timedelta(days=anchor.weekday())
+            start = start if cur else start - timedelta(days=7)
+            end = start + timedelta(days=7)
+        elif m.group(2) == "month":
+            start = _add_months(anchor, 0 if cur else -1)
+            end = _add_months(start, 1)
+        else:
+            start = date(anchor.year if cur else anchor.year - 1, 1, 1)
+            end = date(start.year + 1, 1, 1)
+        return start, end, f"{'this' if cur else 'last'} {m.group(2)}"
+    for m in _MONTH_RE.finditer(q):
+        prep, name, year = m.group(1), m.group(2), m.group(3)
+        if name == "may" and not (prep or year):
+            continue  # "may" is usually the verb
+        month = _MONTHS[name]
+        ref = latest or anchor
+        y = int(year) if year else (ref.year if month <= ref.month else ref.year - 1)
+        start = date(y, month, 1)
+        if prep == "since":
+            return start, None, f"since {calendar.month_name[month]} {y}"
+        return start, _add_months(start, 1), f"in {calendar.month_name[month]} {y}"
+    m = re.search(r"\b(?:in|during|for|of|since)?\s*((?:19|20)\d{2})\b", q)
+    if m:
+        y = int(m.group(1))
+        if m.group(0).strip().startswith("since"):
+            return date(y, 1, 1), None, f"since {y}"
+        return date(y, 1, 1), date(y + 1, 1, 1), f"in {y}"
+    return None
+
+def _measure(q: str, roles: Dict) -> Optional[str]:
+    has_qty, has_rev = bool(roles["qty"]), bool(roles["qty"] and roles["price"])
+    if _AVG_PRICE.search(q):
+        return "avg_price" if has_rev else None
+    avg = bool(_AVG.search(q))
+    if _REVENUE.search(q) or re.search(r"\bhow much\b", q):
+        m = "revenue" if has_rev else None
+    elif re.search(r"\bhow many\b", q) and _COUNT.search(q) and not _QTY.search(q):
+        m = "count"
+    elif _QTY.search(q) or re.search(r"\bhow many\b", q):
+        m = "qty" if has_qty else "count"
+    elif _COUNT.search(q):
+        m = "count"
+    elif re.search(r"\bsales\b", q):
+        m = "revenue" if has_rev else "qty" if has_qty else "count"
+    else:
+        return None
+    if avg:
+        return {"revenue": "avg_order", "qty": "avg_qty"}.get(m)
+    return m
+
+def _match_products(q: str, products: List[str]) -> List[str]:
+    spans = []
+    for p in products:
+        v = str(p).strip().lower()
+        if len(v) < 3:
+            continue
+        m = re.search(r"\b" + re.escape(v) + r"(?:e?s)?\b", q)
+        if m:
+            spans.append((m.start(), m.end(), p))
+    # "iced latte" wins over "latte" inside it
+    keep = [s for s in spans if not any(o[0] <= s[0] and s[1] <= o[1] and (o[1] - o[0]) > (s[1] - s[0]) for o in spans)]
+    return [s[2] for s in keep]
+
+def _words(name: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(name).lower()).split())
+
+def _out_of_scope(q: str, roles: Dict) -> bool:
+    # true when answering with one total or a top-product list would ignore part of the question
+    if _GROUPED.search(_PER_SALE.sub("", q)) or _BY.search(q) or _OTHER_DIMS.search(q):
+        return True
+    product_words = _PRODUCT_WORDS | set(_words(roles["product"] or "").split())
+    for m in _WHICH.finditer(q):
+        if m.group(1) not in _WHICH_FILLER and m.group(1) not in product_words:
+            return True  # "which store", "what day"
+    used = {roles[k] for k in ("date", "product", "qty", "price")}
+    for col in roles.get("columns") or []:
+        name = _words(col)
+        if col in used or len(name) < 3 or any(r.fullmatch(name) for r in (_AGG, _REVENUE, _QTY, _COUNT)):
+            continue
+        if re.search(r"\b" + re.escape(name) + r"s?\b", q):
+            return True  # a column the rules know nothing about
+    return False
+
+def plan_question(question: str, roles: Dict, products: List[str], anchor: date,
+                  latest: Optional[date] = None) -> Optional[Dict]:
+    """Rule-based plan {kind, measure, products, range, top_n}, or None if the rules do not apply."""
+    q = " ".join(question.lower().split())
+    if not _AGG.search(q) or _out_of_scope(q, roles):
+        return None
+    top = bool(_TOP.search(q)) and bool(roles["product"]) and (
+        re.search(r"\b(products?|items?|drinks?|skus?|sellers?|what|which)\b", q) is not None)
+    measure = _measure(q, roles)
+    if top:
+        measure = measure if measure in ("revenue", "qty", "count") else ("qty" if roles["qty"] else "count")
+    if measure is None:
+        return None
+    rng = parse_range(q, anchor, latest)
+    if rng and not roles["date"]:
+        return None
+    picked = _match_products(q, products) if roles["product"] else []
+    n = re.search(r"\btop\s+(\d+)\b", q)
+    return {
+        "kind": "top" if top else "scalar", "measure": measure, "products": picked,
+        "range": rng, "top_n": min(int(n.group(1)), MAX_ROWS) if n else 1,
+    }
+
+# ---- SQL ----
+
+_FORBIDDEN = re.compile(
+    r"\b(insert|update|delete|merge|upsert|drop|alter|create|truncate|grant|revoke|copy|call|do|execute|prepare|"
+    r"vacuum|analyze|cluster|reindex|lock|listen|notify|set|reset|refresh|comment|security|into|"
+    r"pg_sleep|pg_read_file|pg_read_binary_file|pg_ls_dir|lo_import|lo_export|dblink)\b"
+    r"|pg_catalog|information_schema|pg_\w+\s*\("
+)
+
+def validate_sql(sql: str, allowed_tables: List[str]) -> str:
+    """
+    Single read-only SELECT over `allowed_tables` only. Returns the statement
+    without a trailing semicolon; raises ValueError otherwise.
+    """
+    s = sql.strip().rstrip(";").strip()
+    bare = re.sub(r"'(?:[^']|'')*'", "''", s)  # ignore string literal contents
+    names = re.findall(r'"((?:[^"]|"")*)"', bare)
+    bare_ids = re.sub(r'"(?:[^"]|"")*"', '""', bare).lower()
+    if ";" in bare_ids or "--" in bare_ids or "/*" in bare_ids:
+        raise ValueError("only a single statement without comments is allowed")
+    if not re.match(r"^(select|with)\b", bare_ids):
+        raise ValueError("only SELECT statements are allowed")
+    if _FORBIDDEN.search(bare_ids):
+        raise ValueError("statement uses a forbidden keyword or function")
+    if re.search(r'\bfrom\s+(""|[a-z_][a-z0-9_.]*)(\s+(as\s+)?(?!where|group|order|limit)[a-z_]\w*)?\s*,', bare_ids):
+        raise ValueError("use explicit JOINs")
+    ctes = set(re.findall(r"\b([a-z_][a-z0-9_]*)\s+as\s*\(", bare_ids))
+    for m in re.finditer(r'\b(?:from|join)\s+(""|[a-z_][a-z0-9_.]*)', bare_ids):
+        if re.search(r"\b(extract|substring|trim|overlay|position)\s*\([^()]*$", bare_ids[:m.start()]):
+            continue  # EXTRACT(year FROM ...) and friends
+        ref = m.group(1)
+        if ref == '""':
+            # quoted identifiers were blanked in order; count them to find this one
+            ref = names[bare_ids[:m.start(1)].count('""')].replace('""', '"')
+        if ref not in allowed_tables and ref not in ctes:
+            raise ValueError(f"table {ref!r} is not allowed")
+    return s
+
+def _source(table: str, roles: Dict, plan: Dict) -> Tuple[str, str, str, str]:
+    # (FROM clause, date expr, product expr, label): rollups when the filters allow it
+    day, prod = rollup_tables(table)
+    present = roles.get("rollups") or {}
+    if present.get("day") and not plan["products"] and plan["kind"] == "scalar":
+        return f'"{day}"', "d", "", "rollup:day"
+    if present.get("product") and not plan["range"]:
+        return f'"{prod}"', "", "product", "rollup:product"
+    d = date_expr(roles, roles["date"]) if roles["date"] else ""
+    p = f'"{roles["product"]}"' if roles["product"] else ""
+    return f'"{table}"', d, p, "table"
+
+def build_sql(table: str, roles: Dict, plan: Dict) -> Tuple[str, Dict, str]:
+    src, d, p, label = _source(table, roles, plan)
+    if label == "table":
+        q, pr = roles["qty"], roles["price"]
+        ct, qty = "COUNT(*)", f"SUM({num_expr(roles, q)})" if q else "NULL::numeric"
+        rev = f"SUM({num_expr(roles, q)}*{num_expr(roles, pr)})" if q and pr else "NULL::numeric"
+    else:
+        ct, qty, rev = "SUM(ct)", "SUM(qty)", "SUM(revenue)"
+    where, params = [], {}
+    if plan["range"]:
+        start, end, _ = plan["range"]
+        if start is not None:
+            where.append(f"{d} >= :start")
+            params["start"] = start
+        if end is not None:
+            where.append(f"{d} < :end")
+            params["end"] = end
+    if plan["products"]:
+        where.append(f"{p} = ANY(:products)")
+        params["products"] = list(plan["products"])
+    w = f' WHERE {" AND ".join(where)}' if where else ""
+    if plan["kind"] == "top":
+        order = {"revenue": "revenue", "qty": "qty", "count": "ct"}[plan["measure"]]
+        sql = (f"SELECT {p} AS product, {ct} AS ct, {qty} AS qty, {rev} AS revenue FROM {src}{w} "
+               f"GROUP BY 1 ORDER BY {order} DESC NULLS LAST LIMIT :n")
+        params["n"] = plan["top_n"]
+    else:
+        sql = f"SELECT {ct} AS ct, {qty} AS qty, {rev} AS revenue FROM {src}{w}"
+    return sql, params, label
+
+def _value(measure: str, ct, qty, rev) -> Optional[float]:
+    ct, qty, rev = (float(x) if x is not None else None for x in (ct, qty, rev))
+    if measure == "count":
+        return ct
+    if measure == "qty":
+        return qty
+    if measure == "revenue":
+        return rev
+    if measure == "avg_order":
+        return rev / ct if rev is not None and ct else None
+    if measure == "avg_qty":
+        return qty / ct if qty is not None and ct else None
+    return rev / qty if rev is not None and qty else None  # avg_price
+
+def _fmt(measure: str, v: float) -> str:
+    if measure in ("revenue", "avg_order", "avg_price"):
+        return f"{v:,.2f}"
+    return f"{v:,.0f}" if float(v).is_integer() else f"{v:,.2f}"
+
+def _phrase(plan: Dict, rows: List) -> Tuple[str, Optional[float]]:
+    what = f" for {', '.join(map(str, plan['products']))}" if plan["products"] else ""
+    when = f" {plan['range'][2]}" if plan["range"] else ""
+    m = plan["measure"]
+    if plan["kind"] == "top":
+        if not rows:
+            return f"There are no matching sales{when}.", None
+        by = {"revenue": "revenue", "qty": "quantity sold", "count": "number of sales"}[m]
+        items = [(r[0], _value(m, r[1], r[2], r[3])) for r in rows]
+        listed = ", ".join(f"{name} ({_fmt(m, v) if v is not None else 'n/a'})" for name, v in items)
+        if len(items) == 1:
+            return f"The top product by {by}{when} was {listed}.", items[0][1]
+        return f"The top {len(items)} products by {by}{when} were {listed}.", None
+    ct, qty, rev = rows[0]
+    if not ct:
+        return f"There were no matching sales{what}{when}.", 0.0
+    v = _value(m, ct, qty, rev)
+    if v is None:
+        return f"The {_LABELS[m]}{what}{when} is not available.", None
+    label = _LABELS[m]
+    return f"{label[0].upper()}{label[1:]}{what}{when} was {_fmt(m, v)}.", v
+
+def _products(conn, table: str, roles: Dict, generation: int) -> List[str]:
+    hit = _PRODUCTS.get(table)
+    if hit and hit[0] == generation:
+        return hit[1]
+    if (roles.get("rollups") or {}).get("product"):
+        q = f'SELECT product FROM "{rollup_tables(table)[1]}" WHERE product IS NOT NULL LIMIT {MAX_PRODUCTS}'
+    else:
+        q = f'SELECT DISTINCT "{roles["product"]}" FROM "{table}" WHERE "{roles["product"]}" IS NOT NULL LIMIT {MAX_PRODUCTS}'
+    vals = [r[0] for r in conn.execute(text(q)).fetchall()]
+    _PRODUCTS[table] = (generation, vals)
+    return vals
+
+def _latest(conn, table: str, roles: Dict, generation: int) -> Optional[date]:
+    # newest date in the data; resolves "in March" and, with SQL_DATE_ANCHOR=data, "last week"
+    if not roles["date"]:
+        return None
+    hit = _LATEST.get(table)
+    if hit and hit[0] == generation:
+        return hit[1]
+    if (roles.get("rollups") or {}).get("day"):
+        d = conn.execute(text(f'SELECT MAX(d) FROM "{rollup_tables(table)[0]}"')).scalar()
+    else:
+        d = conn.execute(text(f'SELECT MAX({date_expr(roles, roles["date"])}) FROM "{table}"')).scalar()
+    _LATEST[table] = (generation, d)
+    return d
+
+def _anchor(latest: Optional[date]) -> date:
+    return latest if DATE_ANCHOR == "data" and latest else date.today()
+
+def _read_only(conn):
+    # first statement of the transaction; the database rejects any write after it
+    conn.execute(text("SET TRANSACTION READ ONLY"))
+    conn.execute(text("SELECT set_config('statement_timeout', :ms, true)"), {"ms": str(STATEMENT_TIMEOUT_MS)})
+
+def answer_with_sql(question: str, table: str) -> Optional[Dict]:
+    """
+    Answer `question` about `table` from SQL, or None when it is not an
+    aggregate question the rules (or, with SQL_LLM=on, the LLM) can express.
+    """
+    t0 = time.perf_counter()
+    with get_engine().connect() as conn, conn.begin():
+        _read_only(conn)
+        generation = get_generation(conn, table)
+        sync_schema(table, generation)
+        roles = table_schema(conn, table)
+        if not roles:
+            return None
+        products = _products(conn, table, roles, generation) if roles["product"] else []
+        latest = _latest(conn, table, roles, generation)
+        plan = plan_question(question, roles, products, _anchor(latest), latest)
+        if plan is None:
+            return _llm_sql(conn, question, table, roles, t0) if LLM_SQL and _AGG.search(question.lower()) else None
+        sql, params, source = build_sql(table, roles, plan)
+        allowed = [table, *rollup_tables(table)]
+        rows = conn.execute(text(validate_sql(sql, allowed)), params).fetchall()
+    answer, value = _phrase(plan, rows)
+    return {
+        "status": "ok", "route": "sql", "generator": "rules", "table": table, "answer": answer,
+        "value": value, "measure": plan["measure"],
+        "products": plan["products"], "range": {
+            "start": plan["range"][0], "end_exclusive": plan["range"][1], "label": plan["range"][2],
+        } if plan["range"] else None,
+        "sql": sql, "params": params, "source": source,
+        "rows": [list(r) for r in rows[:MAX_ROWS]],
+        "seconds": round(time.perf_counter() - t0, 4),
+    }
+
+def _llm_sql(conn, question: str, table: str, roles: Dict, t0: float) -> Optional[Dict]:
+    from services.qa import _llm  # lazy: pulls in the Gemini SDK
+    prompt = (
+        "Write one PostgreSQL SELECT statement that answers the question. Use only the table "
+        f'"{table}" with columns {", ".join(repr(c) for c in roles["columns"])}; quote identifiers with double '
+        "quotes and cast text columns explicitly (e.g. ::numeric, ::date). Return only the SQL, no explanation.\n\n"
+        f"Question: {question}"
+    )
+    raw = getattr(_llm().invoke(prompt), "content", "") or ""
+    sql = re.sub(r"^```(?:sql)?|```$", "", str(raw).strip(), flags=re.I).strip()
+    try:
+        sql = validate_sql(sql, [table])
+    except ValueError:
+        return None
+    rows = conn.execute(text(f"SELECT * FROM ({sql}) q LIMIT {MAX_ROWS}")).fetchall()
+    if len(rows) == 1 and len(rows[0]) == 1:
+        answer = f"The answer is {rows[0][0]}."
+    else:
+        answer = "Result: " + "; ".join(", ".join(str(v) for v in r) for r in rows) if rows else "No matching rows."
+    return {
+        "status": "ok", "route": "sql", "generator": "llm", "table": table, "answer": answer,
+        "sql": sql, "params": {}, "rows": [list(r) for r in rows],
+        "seconds": round(time.perf_counter() - t0, 4),
+    }
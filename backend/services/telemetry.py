@@ -0,0 +1,138 @@
+﻿import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event
+
+# Latency histograms kept in-process and exposed in the Prometheus text
+# format, plus per-request stage timings for the Server-Timing header.
+# Every observation goes to both: the histogram for trends, the request's
+# list for "where did this call spend its time".
+
+SLOW_SQL_MS = float(os.getenv("SLOW_SQL_MS", "500"))  # statements at least this slow are logged; 0 logs all
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+log = logging.getLogger("caffeinate.sql")
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labelnames: Tuple[str, ...]):
+        self.name, self.help, self.labelnames = name, help_, labelnames
+        self._series: Dict[Tuple, List] = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *labels: str):
+        i = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * len(BUCKETS), 0.0, 0]
+            if i < len(BUCKETS):
+                s[0][i] += 1
+            s[1] += seconds
+            s[2] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for labels, (counts, total, n) in sorted(series.items()):
+            base = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, labels))
+            sep = "," if base else ""
+            acc = 0
+            for le, c in zip(BUCKETS, counts):
+                acc += c
+                out.append(f'{self.name}_bucket{{{base}{sep}le="{le}"}} {acc}')
+            out.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {n}')
+            out.append(f"{self.name}_sum{{{base}}} {total:.6f}")
+            out.append(f"{self.name}_count{{{base}}} {n}")
+        return out
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REQUESTS = Histogram("caffeinate_request_seconds", "HTTP request latency by route.",
+                     ("method", "endpoint", "status"))
+# labelled by stage only: tenant, rollup and staging tables would each add a series
+STAGES = Histogram("caffeinate_stage_seconds", "Latency of one stage (sql, embed, vector_query, llm, ...).",
+                   ("stage",))
+
+_request_stages: ContextVar[Optional[List]] = ContextVar("caffeinate_request_stages", default=None)
+
+def observe(stage: str, seconds: float):
+    STAGES.observe(seconds, stage)
+    current = _request_stages.get()
+    if current is not None:
+        current.append((stage, seconds))
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+def start_request() -> List:
+    # the list is shared with thread-pool copies of the context, so their stages land here too
+    stages: List = []
+    _request_stages.set(stages)
+    return stages
+
+def server_timing(stages: List, total: float) -> str:
+    summed: Dict[str, List] = {}
+    for stage, secs in list(stages):
+        s = summed.setdefault(stage, [0.0, 0])
+        s[0] += secs
+        s[1] += 1
+    parts = [f'{name};dur={s[0] * 1000:.1f};desc="x{s[1]}"' if s[1] > 1 else f"{name};dur={s[0] * 1000:.1f}"
+             for name, s in summed.items()]
+    return ", ".join(parts + [f"total;dur={total * 1000:.1f}"])
+
+# ---- SQL ----
+_TABLE_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE|TABLE|ANALYZE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?([A-Za-z_][\w$]*)"?',
+                       re.IGNORECASE)
+_STAGING_RE = re.compile(r"__stg_[0-9a-f]{8}")
+
+def statement_table(statement: str) -> str:
+    """First user table a statement touches, for the slow-SQL log (staging suffixes folded)."""
+    for m in _TABLE_RE.finditer(statement):
+        name = m.group(1)
+        if name.lower() in ("information_schema", "pg_catalog", "pg_class", "pg_stats", "pg_indexes", "stdin"):
+            continue
+        return _STAGING_RE.sub("__stg", name)
+    return ""
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("caffeinate_t0", []).append(time.perf_counter())
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("caffeinate_t0")
+    if not starts:
+        return
+    secs = time.perf_counter() - starts.pop()
+    observe("sql", secs)
+    if secs * 1000 >= SLOW_SQL_MS:
+        log.warning("slow sql: %.1f ms on %s: %s", secs * 1000, statement_table(statement) or "?",
+                    " ".join(statement.split())[:500])
+
+def _failed(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("caffeinate_t0"):
+        conn.info["caffeinate_t0"].pop()
+
+def instrument_engine(engine):
+    """Time every statement run through `engine` and log the slow ones."""
+    event.listen(engine, "before_cursor_execute", _before)
+    event.listen(engine, "after_cursor_execute", _after)
+    event.listen(engine, "handle_error", _failed)
+
+def render_prometheus(extra: Optional[Dict[str, float]] = None) -> str:
+    lines = REQUESTS.render() + STAGES.render()
+    for name, value in (extra or {}).items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
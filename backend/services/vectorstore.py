@@ -1,34 +1,141 @@
-﻿import os
-from typing import List, Dict, Iterable
-from pinecone import Pinecone, ServerlessSpec
+﻿import hashlib
+import os
+import re
+import threading
+from typing import List, Dict, Iterable, Optional
+from services.embeddings import MODEL, EMBEDDING_DIM
 
-_INDEX = os.getenv("PINECONE_INDEX", "caffeinate-rag-768")
+BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()  # pinecone | local
+INDEX_PREFIX = os.getenv("VECTOR_INDEX_PREFIX", "caffeinate-rag")
 _CLOUD = os.getenv("PINECONE_CLOUD", "aws")
 _REGION = os.getenv("PINECONE_REGION", "us-east-1")
+_POOL_THREADS = int(os.getenv("PINECONE_POOL_THREADS", "4"))
 
-def get_pc() -> Pinecone:
-    return Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+# process-wide client, Index handles (each owns an HTTP connection pool) and the
+# indexes known to exist; an index deleted behind our back needs a restart
+_pc = None
+_handles: Dict[str, object] = {}
+_ensured: set = set()
+_lock = threading.Lock()
 
-def ensure_index(dim: int = 768, metric: str = "cosine"):
-    pc = get_pc()
-    if _INDEX not in [i.name for i in pc.list_indexes()]:
-        pc.create_index(
-            name=_INDEX,
-            dimension=dim,
-            metric=metric,
-            spec=ServerlessSpec(cloud=_CLOUD, region=_REGION),
-        )
+def index_name(dim: Optional[int] = None) -> str:
+    """
+    Index for vectors of the embedding model at `dim` dimensions: both are
+    part of the name, so vectors of different spaces never share an index.
+    """
+    dim = int(dim or EMBEDDING_DIM)
+    model = re.sub(r"[^a-z0-9]+", "-", MODEL.split("/")[-1].lower()).strip("-")
+    name = f"{INDEX_PREFIX}-{model}-{dim}"
+    if len(name) > 45:  # Pinecone's limit
+        name = f"{INDEX_PREFIX[:24]}-{hashlib.md5(model.encode()).hexdigest()[:8]}-{dim}"
+    return name
+
+def _dim_of(vector) -> int:
+    return len(vector) if vector is not None else EMBEDDING_DIM
+
+def _local():
+    # NumPy store in LOCAL_VECTOR_DIR; no SDK or network needed
+    from services import local_vectorstore
+    return local_vectorstore
+
+def get_pc():
+    global _pc
+    if _pc is None:
+        with _lock:
+            if _pc is None:
+                from pinecone import Pinecone
+                _pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+    return _pc
+
+def _index(name: str):
+    handle = _handles.get(name)
+    if handle is None:
+        pc = get_pc()
+        with _lock:
+            handle = _handles.get(name)
+            if handle is None:
+                handle = _handles[name] = pc.Index(name, pool_threads=_POOL_THREADS)
+    return handle
+
+def ensure_index(dim: int = EMBEDDING_DIM, metric: str = "cosine"):
+    name = index_name(dim)
+    if (name, metric) in _ensured:
+        return
+    if BACKEND == "local":
+        _local().ensure_index(name, dim=dim, metric=metric)
+    else:
+        from pinecone import ServerlessSpec
+        pc = get_pc()
+        if name not in [i.name for i in pc.list_indexes()]:
+            pc.create_index(
+                name=name,
+                dimension=dim,
+                metric=metric,
+                spec=ServerlessSpec(cloud=_CLOUD, region=_REGION),
+            )
+        elif pc.describe_index(name).dimension != dim:
+            raise ValueError(f"Pinecone index {name!r} exists with another dimension than {dim}")
+    _ensured.add((name, metric))
 
-def upsert_vectors(items: Iterable[Dict]):
+def namespace_for(table: Optional[str]) -> str:
     """
-    items: iterable of {"id": str, "values": List[float], "metadata": {...}}
+    Vectors of a table live in their own namespace, named after the physical
+    table (already tenant-prefixed), so queries only search that table and
+    dropping it is one call. No table means the default namespace.
     """
-    pc = get_pc()
-    index = pc.Index(_INDEX)
-    index.upsert(vectors=list(items))
+    return table or ""
+
+def ping(dim: int = EMBEDDING_DIM) -> int:
+    """Opens (or connects to) the index for `dim` and returns its vector count; raises when it is missing."""
+    name = index_name(dim)
+    if BACKEND == "local":
+        return _local().get_index(name).count()
+    return int(_index(name).describe_index_stats().total_vector_count)
+
+def upsert_vectors(items: Iterable[Dict], namespace: str = ""):
+    """
+    items: iterable of {"id": str, "values": List[float], "metadata": {...}},
+    all of one dimension; they go to `namespace` of the index for that dimension.
+    """
+    items = list(items)
+    if not items:
+        return
+    name = index_name(_dim_of(items[0]["values"]))
+    if BACKEND == "local":
+        return _local().upsert_vectors(name, items, namespace=namespace)
+    _index(name).upsert(vectors=items, namespace=namespace)
+
+def query_vectors(vector: List[float], top_k: int = 8, filter: Dict | None = None, namespace: str = ""):
+    # the query's own length picks the index, so it is always compared with vectors of its space
+    name = index_name(_dim_of(vector))
+    if BACKEND == "local":
+        return _local().query_vectors(name, vector, top_k=top_k, filter=filter, namespace=namespace)
+    return _index(name).query(vector=vector, top_k=top_k, include_metadata=True, filter=filter,
+                              namespace=namespace)
+
+def delete_vectors(ids: List[str], dim: Optional[int] = None, namespace: str = ""):
+    name = index_name(dim)
+    if BACKEND == "local":
+        return _local().delete_vectors(name, ids, namespace=namespace)
+    _index(name).delete(ids=list(ids), namespace=namespace)
 
-def query_vectors(vector: List[float], top_k: int = 8, filter: Dict | None = None):
-    pc = get_pc()
-    index = pc.Index(_INDEX)
-    return index.query(vector=vector, top_k=top_k, include_metadata=True, filter=filter)
+def delete_namespace(namespace: str, dim: Optional[int] = None):
+    """Drops every vector of `namespace` in the index for `dim`, without listing them."""
+    name = index_name(dim)
+    if BACKEND == "local":
+        return _local().delete_namespace(name, namespace)
+    try:
+        _index(name).delete(delete_all=True, namespace=namespace)
+    except Exception as e:
+        if getattr(e, "status", None) != 404:  # nothing was ever written there
+            raise
 
+def namespace_counts(dim: Optional[int] = None) -> Dict[str, int]:
+    """Vector count per namespace of the index for `dim` ({} when it does not exist yet)."""
+    name = index_name(dim)
+    if BACKEND == "local":
+        return _local().namespace_counts(name)
+    if name not in [i.name for i in get_pc().list_indexes()]:
+        return {}
+    stats = _index(name).describe_index_stats()
+    return {ns: int(v.vector_count) for ns, v in (stats.namespaces or {}).items()}
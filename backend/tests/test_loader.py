@@ -0,0 +1,116 @@
+﻿import io
+import uuid
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from services.db import get_engine
+import pandas as pd
+from services.loader import _conform, _fits, _pg_type, copy_csv_to_table, date_dtypes, infer_dates
+from services.rollups import rollup_tables
+
+# The load tests need the Postgres from the usual POSTGRES_* variables and are
+# skipped without one; the type-inference tests below them run anywhere.
+
+BASE = """order_id,date,product,qty,price
+1,2024-03-01,latte,2,3.5
+2,2024-03-01,mocha,1,4.0
+3,2024-03-02,latte,3,3.5
+"""
+
+_BOOKKEEPING = (("caffeinate_table_meta", "name"), ("caffeinate_table_generations", "name"),
+                ("caffeinate_table_changes", "physical"))
+
+@pytest.fixture
+def table():
+    try:
+        with get_engine().connect():
+            pass
+    except OperationalError:
+        pytest.skip("Postgres is not reachable")
+    name = f"test_{uuid.uuid4().hex[:8]}"
+    yield name
+    tables = [name, *rollup_tables(name)]
+    with get_engine().begin() as conn:
+        for t in tables:
+            conn.execute(text(f'DROP TABLE IF EXISTS "{t}"'))
+        # the loads also leave bookkeeping rows behind; later tests must not see them
+        for book, col in _BOOKKEEPING:
+            if conn.execute(text("SELECT to_regclass(:b)"), {"b": book}).scalar():
+                conn.execute(text(f"DELETE FROM {book} WHERE {col} = ANY(:ts)"), {"ts": tables})
+
+def _load(table, csv, **kw):
+    return copy_csv_to_table(io.BytesIO(csv.encode()), table, **kw)
+
+def _rollups_match(conn, table):
+    day, prod = rollup_tables(table)
+    raw = conn.execute(text(f'SELECT COUNT(*), SUM(qty), SUM(qty*price) FROM "{table}"')).one()
+    by_day = conn.execute(text(f'SELECT SUM(ct), SUM(qty), SUM(revenue) FROM "{day}"')).one()
+    by_product = conn.execute(text(f'SELECT SUM(ct), SUM(qty), SUM(revenue) FROM "{prod}"')).one()
+    return [float(v) for v in raw] == [float(v) for v in by_day] == [float(v) for v in by_product]
+
+def test_append_without_some_columns(table):
+    _load(table, BASE)
+    res = _load(table, "order_id,date,product,qty\n4,2024-03-03,latte,5\n5,2024-03-03,tea,1\n",
+                mode="append", keys=["order_id"])
+    assert (res["inserted"], res["skipped"]) == (2, 0)
+    res = _load(table, "order_id,date,product\n6,2024-03-04,latte\n", mode="append")
+    assert res["inserted"] == 1
+    with get_engine().connect() as conn:
+        assert conn.execute(text(f'SELECT COUNT(*) FROM "{table}" WHERE price IS NULL')).scalar() == 3
+        assert _rollups_match(conn, table)
+
+def test_upsert_without_some_columns_keeps_them(table):
+    _load(table, BASE)
+    res = _load(table, "order_id,qty\n1,9\n7,1\n", mode="upsert", keys=["order_id"])
+    assert (res["inserted"], res["updated"]) == (1, 1)
+    with get_engine().connect() as conn:
+        row = conn.execute(text(f'SELECT product, qty, price FROM "{table}" WHERE order_id = 1')).one()
+        assert (row[0], row[1], row[2]) == ("latte", 9, 3.5)
+        assert _rollups_match(conn, table)
+
+def test_append_keeps_column_types(table):
+    _load(table, BASE)
+    with pytest.raises(ValueError, match="column qty"):
+        _load(table, "order_id,date,product,qty,price\n8,2024-03-05,latte,two,3.5\n", mode="append")
+    with pytest.raises(ValueError, match="not in the existing table"):
+        _load(table, "order_id,store\n9,north\n", mode="append")
+    res = _load(table, "order_id,date,product,qty,price\n10,2024-03-05,latte,2,3.75\n", mode="append")
+    assert res["column_types"]["qty"] == "BIGINT" and res["inserted"] == 1
+    with get_engine().connect() as conn:
+        types = conn.execute(text(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = :t"
+        ), {"t": table}).fetchall()
+    assert dict(types)["qty"] == "bigint"
+
+def test_rollup_that_does_not_cast_is_skipped(table):
+    from services.rollups import rollups_present
+    res = _load(table, "date,product,qty,price\n2024-03-01,latte,2,3.5\nsoon,mocha,1,4.0\n")
+    assert res["rows"] == 2
+    with get_engine().connect() as conn:
+        assert rollups_present(conn, table) == {"day": False, "product": True}
+
+def test_infer_dates_parses_only_date_text():
+    df = pd.DataFrame({"d": ["2024-03-01", "2024-03-02"], "ts": ["3/1/2024 08:15", "3/2/2024 09:00"],
+                       "p": ["latte", "2024-03-01"]})
+    out = infer_dates(df)
+    assert _pg_type(out["d"]) == "DATE" and _pg_type(out["ts"]) == "TIMESTAMP"
+    assert _pg_type(out["p"]) == "TEXT"
+    assert list(date_dtypes(out)) == ["d"]
+    # a locked schema only parses the columns it already types as dates
+    out = infer_dates(df, [("d", "TEXT"), ("ts", "TIMESTAMP"), ("p", "TEXT")])
+    assert _pg_type(out["d"]) == "TEXT" and _pg_type(out["ts"]) == "TIMESTAMP"
+
+def test_offset_dates_are_timestamptz():
+    out = infer_dates(pd.DataFrame({"t": ["2024-03-01T08:00:00+02:00", "2024-03-01T09:30:00Z"]}))
+    assert _pg_type(out["t"]) == "TIMESTAMPTZ" and date_dtypes(out) == {}
+
+def test_fits_and_conform_integral_floats():
+    qty = pd.Series([1.0, None, 3.0])
+    assert _pg_type(qty) == "DOUBLE PRECISION" and _fits(qty, "BIGINT")
+    assert not _fits(pd.Series([1.5, 2.0]), "BIGINT")
+    assert not _fits(pd.Series(["a"]), "DOUBLE PRECISION") and _fits(pd.Series(["a"]), "TEXT")
+    df = pd.DataFrame({"qty": qty, "price": [3.5, 4.0, None]})
+    out = _conform(df, [("qty", "BIGINT"), ("price", "DOUBLE PRECISION")])
+    assert str(out["qty"].dtype) == "Int64" and out["price"].dtype == df["price"].dtype
+    assert df["qty"].dtype == "float64"
+    assert out.to_csv(index=False, header=False).splitlines()[0] == "1,3.5"
@@ -0,0 +1,51 @@
+﻿import os
+import numpy as np
+import pytest
+from services.local_vectorstore import LocalIndex
+
+def _items(ids, seed=0):
+    vecs = np.random.default_rng(seed).normal(size=(len(ids), 8))
+    return [{"id": i, "values": v.tolist(), "metadata": {"table": "t"}} for i, v in zip(ids, vecs)]
+
+def _log_lines(path):
+    with open(os.path.join(path, "items.jsonl"), encoding="utf-8") as f:
+        return f.read().splitlines()
+
+def test_torn_write_does_not_swallow_later_writes(tmp_path):
+    path = str(tmp_path / "ix")
+    ix = LocalIndex(path, 8)
+    ix.upsert(_items([f"v{i}" for i in range(50)]))
+    ix.close()
+    with open(os.path.join(path, "items.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "id": "torn", "ro')
+    ix = LocalIndex(path, 8)
+    assert ix.count() == 50
+    ix.upsert(_items(["new1"], seed=1))
+    assert ix.count() == 51
+    ix.close()
+    ix = LocalIndex(path, 8)
+    assert ix.count() == 51
+    hit = ix.query_batch(np.asarray([_items(["new1"], seed=1)[0]["values"]]), top_k=1)[0]["matches"][0]
+    assert hit["id"] == "new1"
+    ix.close()
+
+def test_log_is_compacted_on_reopen(tmp_path):
+    path = str(tmp_path / "ix")
+    ix = LocalIndex(path, 8)
+    ids = [f"v{i}" for i in range(20)]
+    ix.upsert(_items(ids))
+    ix.upsert(_items(ids[:10], seed=2))
+    ix.delete(ids[10:15])
+    ix.close()
+    assert len(_log_lines(path)) == 35
+    ix = LocalIndex(path, 8)
+    assert ix.count() == 15 and len(_log_lines(path)) == 15
+    ix.close()
+
+def test_index_is_single_process(tmp_path):
+    path = str(tmp_path / "ix")
+    ix = LocalIndex(path, 8)
+    with pytest.raises(RuntimeError, match="single-process"):
+        LocalIndex(path, 8)
+    ix.close()
+    LocalIndex(path, 8).close()
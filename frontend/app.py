@@ -1,6 +1,10 @@
 ﻿import os
 import json
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import pandas as pd
 import plotly.express as px
@@ -11,6 +15,7 @@ st.title("caffeinate — Analytics + RAG Assistant (MVP)")
 # Sidebar settings (runs INSIDE Docker)
 DEFAULT_BACKEND = os.getenv("BACKEND_URL", "http://backend:8000")
 DEFAULT_API_KEY = os.getenv("ADMIN_API_KEY", "")
+TENANT = os.getenv("TENANT_ID", "demo")
 if "backend_url" not in st.session_state:
     st.session_state.backend_url = DEFAULT_BACKEND
 if "api_key" not in st.session_state:
@@ -29,28 +34,158 @@ with st.sidebar:
         type="password",
         help="Needed for Upload & Index (ADMIN_API_KEY in .env)",
     )
-    st.caption("Tenant: " + os.getenv("TENANT_ID","demo"))
+    st.caption("Tenant: " + TENANT)
 
 backend = st.session_state.backend_url
 api_key = st.session_state.api_key or ""
+# sent with every request: tenants other than the backend's default need a key to be read as well
+auth = {"X-API-Key": api_key} if api_key else {}
+
+HTTP_POOL_SIZE = int(os.getenv("FRONTEND_HTTP_POOL", "32"))
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "1500"))  # the backend downsamples longer series
+JOB_QUEUED_SECONDS = float(os.getenv("JOB_QUEUED_SECONDS", "120"))  # give up on a job no worker picks up
+JOB_WAIT_SECONDS = float(os.getenv("JOB_WAIT_SECONDS", "3600"))     # and stop watching one after this long
+
+@st.cache_resource
+def http_session() -> requests.Session:
+    # one keep-alive pool per Streamlit server, shared by all browser sessions
+    s = requests.Session()
+    s.headers["X-Tenant-ID"] = TENANT  # the backend resolves tables (and vector namespaces) per tenant
+    retry = Retry(total=2, connect=2, read=0, backoff_factor=0.2, allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+@st.cache_resource
+def known_etags() -> dict:
+    # (backend, path, params) -> last ETag seen, shared across sessions
+    return {}
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _cached_body(path: str, params_key: str, table: str, etag: str, _raw: bytes | None):
+    if _raw is None:
+        raise KeyError(etag)  # not cached; exceptions are not memoized
+    return json.loads(_raw)
 
 def fetch_json(path: str, params: dict | None = None, method: str = "GET", files=None, body=None, headers: dict | None = None):
     url = f"{backend}{path}"
+    http = http_session()
+    headers = {**auth, **(headers or {})}
     try:
         if method == "GET":
-            r = requests.get(url, params=params, headers=headers, timeout=120)
+            r = http.get(url, params=params, headers=headers, timeout=120)
         elif method == "POST" and files is not None:
-            r = requests.post(url, params=params, files=files, headers=headers, timeout=300)
+            r = http.post(url, params=params, files=files, headers=headers, timeout=300)
         elif method == "POST" and body is not None:
-            r = requests.post(url, headers={"Content-Type":"application/json", **(headers or {})}, data=json.dumps(body), timeout=300)
+            r = http.post(url, headers={"Content-Type":"application/json", **headers}, data=json.dumps(body), timeout=300)
         else:
-            r = requests.post(url, params=params, headers=headers, timeout=120)
+            r = http.post(url, params=params, headers=headers, timeout=120)
         if not r.ok:
             return {"error": f"{r.status_code}: {r.text}"}
         return r.json()
     except Exception as e:
         return {"error": str(e)}
 
+def fetch_cached(path: str, params: dict):
+    """
+    GET with If-None-Match: a 304 from the backend is served from
+    st.cache_data, keyed by table and ETag, without downloading the body.
+    """
+    url = f"{backend}{path}"
+    params_key = json.dumps(params, sort_keys=True)
+    slot = (backend, path, params_key)
+    etag = known_etags().get(slot)
+    try:
+        r = http_session().get(url, params=params, headers={**auth, "If-None-Match": etag} if etag else auth, timeout=120)
+        if r.status_code == 304:
+            try:
+                return _cached_body(path, params_key, params.get("table", ""), etag, None)
+            except KeyError:
+                r = http_session().get(url, params=params, headers=auth, timeout=120)  # evicted locally: fetch in full
+        if not r.ok:
+            return {"error": f"{r.status_code}: {r.text}"}
+        new_etag = r.headers.get("ETag")
+        if not new_etag:
+            return r.json()
+        known_etags()[slot] = new_etag
+        return _cached_body(path, params_key, params.get("table", ""), new_etag, r.content)
+    except Exception as e:
+        return {"error": str(e)}
+
+def fetch_many(requests_by_name: dict) -> dict:
+    # independent panels load side by side over the pooled session
+    with ThreadPoolExecutor(max_workers=max(1, len(requests_by_name))) as pool:
+        futures = {name: pool.submit(fetch_cached, path, params) for name, (path, params) in requests_by_name.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+def invalidate_table(table: str):
+    # after an upload the backend ETags change anyway; drop ours so nothing stale is revalidated
+    slots = known_etags()
+    for slot in [s for s in slots if json.loads(s[2]).get("table") == table]:
+        slots.pop(slot, None)
+    _cached_body.clear()
+
+def fetch_dashboard(table: str, granularity: str, limit: int) -> dict:
+    dash = fetch_cached("/metrics/dashboard", {"table": table, "granularity": granularity, "limit": limit,
+                                               "max_points": CHART_MAX_POINTS})
+    if not str(dash.get("error", "")).startswith("404"):
+        return dash
+    # backend without /metrics/dashboard: fetch the three panels in parallel
+    parts = fetch_many({
+        "kpis": ("/metrics/kpis", {"table": table}),
+        "daily": ("/metrics/daily", {"table": table, "granularity": granularity, "max_points": CHART_MAX_POINTS}),
+        "top_products": ("/metrics/top_products", {"table": table, "limit": limit}),
+    })
+    errors = [p["error"] for p in parts.values() if "error" in p]
+    return {"error": errors[0]} if errors else parts
+
+def stream_events(path: str, body: dict):
+    # yields (event, data) pairs from a Server-Sent Events endpoint
+    url = f"{backend}{path}"
+    headers = {**auth, "Content-Type": "application/json", "Accept": "text/event-stream"}
+    with http_session().post(url, headers=headers, data=json.dumps(body), stream=True, timeout=300) as r:
+        if not r.ok:
+            yield "error", {"detail": f"{r.status_code}: {r.text}"}
+            return
+        event, data = "message", []
+        for line in r.iter_lines(decode_unicode=True):
+            if line:
+                field, _, value = line.partition(":")
+                if field == "event":
+                    event = value.strip()
+                elif field == "data":
+                    data.append(value.lstrip())
+            elif data:
+                yield event, json.loads("\n".join(data))
+                event, data = "message", []
+
+def wait_for_job(resp: dict, label: str) -> dict:
+    # the backend answers 202 with a job id; poll it and show progress until it ends
+    if "job_id" not in resp:
+        return resp
+    bar = st.progress(0.0, text=label)
+    start = time.monotonic()
+    while True:
+        job = fetch_json(f"/jobs/{resp['job_id']}")
+        if "error" in job:
+            return job
+        frac = job.get("fraction") or 0.0
+        eta = f", ~{job['eta_s']:.0f}s left" if job.get("eta_s") is not None else ""
+        bar.progress(min(frac, 1.0), text=f"{label}: {job['status']} — {job.get('rows_done', 0):,} rows{eta}")
+        if job["status"] == "succeeded":
+            return job.get("result") or {}
+        if job["status"] in ("failed", "cancelled"):
+            return {"error": f"job {job['status']}: {job.get('error') or ''}"}
+        waited = time.monotonic() - start
+        if job["status"] == "queued" and waited > JOB_QUEUED_SECONDS:
+            return {"error": f"job {job['id']} was not picked up by a worker in {waited:.0f}s "
+                             "(are JOB_WORKERS running?); it is still queued"}
+        if waited > JOB_WAIT_SECONDS:
+            return {"error": f"job {job['id']} still {job['status']} after {waited:.0f}s; "
+                             f"see /jobs/{job['id']} for its progress"}
+        time.sleep(0.5)
+
 tab_upload, tab_overview, tab_ask = st.tabs(["📤 Upload dataset", "📈 Overview", "💬 Ask assistant"])
 
 # ------------------ Upload ------------------
@@ -58,16 +193,25 @@ with tab_upload:
     st.markdown("Upload a CSV and choose the destination **logical** table name (we’ll prefix with tenant).")
     table = st.text_input("Table name", value="coffee_sales")
     file = st.file_uploader("CSV file", type=["csv"])
+    c1, c2 = st.columns(2)
+    mode = c1.selectbox("Mode", ["replace", "append", "upsert"], index=0,
+                        help="append adds rows, upsert also updates rows with a matching key")
+    keys = c2.text_input("Key columns", value="", help="comma-separated; rows with a known key are "
+                                                       "skipped on append and updated on upsert")
     if st.button("Upload"):
         if not file or not table:
             st.error("Please provide both a CSV file and a table name.")
         else:
             files = {"file": (file.name, file.getvalue(), "text/csv")}
-            headers = {"X-API-Key": api_key} if api_key else {}
-            resp = fetch_json("/ingest_dataset", params={"table": table}, method="POST", files=files, headers=headers)
+            params = {"table": table, "stream": "true", "background": "true", "mode": mode}
+            if keys.strip():
+                params["keys"] = keys
+            resp = fetch_json("/ingest_dataset", params=params, method="POST", files=files)
+            resp = wait_for_job(resp, "Loading")
             if "error" in resp:
                 st.error(resp["error"])
             else:
+                invalidate_table(table)
                 st.success("Upload successful.")
                 st.json(resp)
                 st.session_state["last_table"] = table
@@ -76,58 +220,81 @@ with tab_upload:
 with tab_overview:
     st.markdown("See KPIs, daily trend, and top products.")
     table2 = st.text_input("Table to analyze", value=st.session_state.get("last_table","coffee_sales"))
+    granularity = st.selectbox("Trend granularity", ["hour", "day", "week", "month"], index=1)
+    top_lim = st.number_input("Top N products", min_value=1, max_value=50, value=10)
     if st.button("Fetch overview"):
-        # KPIs
-        k = fetch_json("/metrics/kpis", params={"table": table2})
-        if "error" in k:
-            st.error(k["error"])
+        st.session_state["overview_table"] = table2
+    # once fetched, reruns (e.g. a new granularity) redraw from the ETag cache
+    if st.session_state.get("overview_table") == table2:
+        dash = fetch_dashboard(table2, granularity, int(top_lim))
+        if "error" in dash:
+            st.error(dash["error"])
         else:
+            # KPIs
+            k = dash["kpis"]
             c1, c2, c3 = st.columns([1,1,1])
             with c1: st.metric("Rows", k.get("row_count") or 0)
             with c2: st.metric("Total Qty", (k.get("total_qty") or 0))
             with c3: st.metric("Total Revenue", (k.get("total_revenue") or 0.0))
             st.caption(f"Columns: {', '.join(k.get('columns', []))}")
-        # Daily series
-        d = fetch_json("/metrics/daily", params={"table": table2})
-        if "error" in d:
-            st.error(d["error"])
-        else:
+            # Daily series
+            d = dash["daily"]
             pts = d.get("points", [])
             if pts:
                 df = pd.DataFrame(pts)
                 metric_key = d.get("metric","value")
-                st.plotly_chart(px.line(df, x="date", y=metric_key, title=f"Daily {metric_key}"), use_container_width=True)
+                st.plotly_chart(px.line(df, x="date", y=metric_key, title=f"{granularity.capitalize()} {metric_key}"), use_container_width=True)
             else:
                 st.info("No daily series available (missing date column?).")
-        # Top products
-        top_lim = st.number_input("Top N products", min_value=1, max_value=50, value=10)
-        t = fetch_json("/metrics/top_products", params={"table": table2, "limit": int(top_lim)})
-        if "error" in t:
-            st.error(t["error"])
-        else:
-            items = t.get("items", [])
+            # Top products
+            items = dash["top_products"].get("items", [])
             if items:
                 df2 = pd.DataFrame(items)
                 st.plotly_chart(px.bar(df2, x="product", y="qty", title="Top products", text_auto=True), use_container_width=True)
             else:
                 st.info("No product breakdown available (missing product column?).")
     rag_limit = st.number_input("Index row limit (optional)", min_value=0, max_value=1000000, value=2000, step=100)
+    rag_granularity = st.selectbox("Index documents", ["row", "chunk", "summary"], index=0,
+                                   help="row: one per row · chunk: groups of rows · summary: per day/product/customer")
     if st.button("Build RAG index (optional)"):
-        headers = {"X-API-Key": api_key} if api_key else {}
-        st.json(fetch_json("/rag/index", params={"table": table2, "limit": int(rag_limit)}, method="POST", headers=headers))
+        resp = fetch_json("/rag/index", params={"table": table2, "limit": int(rag_limit), "background": "true",
+                                                "granularity": rag_granularity},
+                          method="POST")
+        resp = wait_for_job(resp, "Indexing")
+        if "error" in resp:
+            st.error(resp["error"])
+        else:
+            st.json(resp)
 
 # ------------------ Ask assistant ------------------
 with tab_ask:
-    st.markdown("RAG will activate once Gemini & Pinecone keys are set in `.env` and the table is indexed.")
-    q_table = st.text_input("Context table (optional)", value=st.session_state.get("last_table",""))
+    st.markdown("Totals, counts, averages and top products are answered from SQL on the table. "
+                "Other questions use RAG once Gemini & Pinecone keys are set in `.env` and the table is indexed.")
+    q_table = st.text_input("Table", value=st.session_state.get("last_table",""))
     question = st.text_area("Your question", placeholder="e.g., What were total latte sales last week?")
-    if st.button("Ask"):
-        payload = {"question": question, "table": (q_table or None)}
-        resp = fetch_json("/ask", method="POST", body=payload)
+    asked = st.button("Ask")
+    if asked and not q_table:
+        st.error("Please provide the table to ask about.")
+    elif asked:
+        payload = {"question": question, "table": q_table}
+        answer_box = st.empty()
+        resp, partial = None, ""
+        try:
+            for event, data in stream_events("/ask/stream", payload):
+                if event == "token":
+                    partial += data
+                    answer_box.subheader(partial)
+                elif event == "done":
+                    resp = data
+                elif event == "error":
+                    resp = {"error": data.get("detail")}
+        except Exception as e:
+            resp = {"error": str(e)}
         if isinstance(resp, dict) and resp.get("status") == "ok" and resp.get("answer"):
-            st.subheader(resp["answer"])
+            answer_box.subheader(resp["answer"])
             with st.expander("Details"):
                 st.json(resp)
         else:
+            answer_box.empty()
             st.json(resp)
 